@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CouchManagementConfig(AppConfig):
@@ -6,4 +7,11 @@ class CouchManagementConfig(AppConfig):
     name = 'couch_management'
 
     def ready(self):
-        import couch_management.signals
\ No newline at end of file
+        import couch_management.signals
+        from couch_management.runtime import configure_thread_pools
+
+        configure_thread_pools()
+
+        if settings.KERAS_WARMUP_ON_READY:
+            from couch_management.keras import get_model_registry
+            get_model_registry().warm_up()
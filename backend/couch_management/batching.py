@@ -0,0 +1,102 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from couch_management.metrics import INFERENCE_BATCH_SIZE, INFERENCE_QUEUE_DELAY
+
+
+class MicroBatcher:
+    """
+    Collects inputs submitted by concurrent request threads and runs them together.
+
+    A background thread takes the first waiting input, then keeps collecting
+    inputs until `max_batch_size` are waiting or `max_wait` seconds have passed
+    since the first one was submitted, and passes them to `run_batch` in one
+    call. Every caller gets its own result through a future, so under load many
+    single-image requests share one forward pass at the cost of at most
+    `max_wait` extra latency.
+
+    Usage:
+        batcher = MicroBatcher('classifier', run_batch, max_batch_size=16, max_wait=0.005)
+        result = batcher.submit(item).result()
+    """
+
+    def __init__(self, name, run_batch, max_batch_size, max_wait):
+        """
+        Args:
+            name (str): The name reported in the batching metrics.
+            run_batch (callable): Takes a list of inputs and returns one result per input, in order.
+            max_batch_size (int): Most inputs passed to one `run_batch` call.
+            max_wait (float): Seconds an input waits for others to join its batch.
+        """
+        self.name = name
+        self.run_batch = run_batch
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max(max_wait, 0)
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        """
+        Queue an input for the next batch.
+
+        Args:
+            item: One input of `run_batch`.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result for `item`, or to
+            the exception raised by the batch it ran in.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so a forked server worker starts its own; a thread that died is replaced.
+        if self._needs_thread():
+            with self._lock:
+                if self._needs_thread():
+                    if self._pid != os.getpid():
+                        self._queue = queue.SimpleQueue()
+                    self._thread = threading.Thread(target=self._run, name=f'{self.name}-batcher', daemon=True)
+                    self._pid = os.getpid()
+                    self._thread.start()
+
+    def _needs_thread(self):
+        return self._thread is None or self._pid != os.getpid() or not self._thread.is_alive()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [entry for entry in self._collect() if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            INFERENCE_BATCH_SIZE.observe(len(batch), batcher=self.name)
+            for _, _, submitted_at in batch:
+                INFERENCE_QUEUE_DELAY.observe(started - submitted_at, batcher=self.name)
+
+            try:
+                results = self.run_batch([item for item, _, _ in batch])
+            except BaseException as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,268 @@
+import io
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from django.conf import settings
+from django.test import RequestFactory
+from PIL import Image
+
+from couch_management.catalog_index import CatalogIndex
+from couch_management.embeddings import EmbeddingIndex, normalize_embeddings
+from couch_management.imaging import decode_image, decode_upload, remove_background
+from couch_management.models import Sofa
+from couch_management.serializers import SofaSerializer
+from couch_management.utils import (calculate_sofa_similarity,
+                                    closest_css3_color, get_dominant_color)
+
+SYNTHETIC_SOFA_TYPES = ['1-Seater', '2-Seater', '3-Seater', 'L-Shape', 'Recliner']
+
+
+def summarize(timings):
+    """
+    Summarize the durations of repeated runs in milliseconds.
+
+    Args:
+        timings (list): Durations in seconds.
+
+    Returns:
+        dict: The number of runs and the mean, median, p95 and minimum duration.
+    """
+    timings = 1000 * np.asarray(timings, dtype=np.float64)
+    return {
+        'runs': len(timings),
+        'mean_ms': float(timings.mean()),
+        'median_ms': float(np.median(timings)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'min_ms': float(timings.min()),
+    }
+
+
+def measure(func, repeat, warmup=1):
+    """
+    Time repeated calls of a function after some untimed warm-up calls.
+
+    Returns:
+        dict: The summary returned by `summarize`.
+    """
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
+
+
+def synthetic_sofa_image(size, color, seed=0):
+    """
+    Draw a sofa-like shape of one noisy color on a white studio background.
+
+    Args:
+        size (int): Width and height in pixels.
+        color (tuple): The RGB color of the sofa.
+        seed (int): Seed of the color noise.
+
+    Returns:
+        tuple: The RGB image and the RGBA cutout whose alpha is the sofa mask.
+    """
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=bool)
+    mask[int(0.35 * size):int(0.8 * size), int(0.1 * size):int(0.9 * size)] = True
+    mask[int(0.2 * size):int(0.5 * size), int(0.2 * size):int(0.8 * size)] = True
+
+    noise = rng.integers(-12, 13, size=(size, size, 3))
+    sofa = np.clip(np.asarray(color, dtype=np.int64) + noise, 0, 255).astype(np.uint8)
+    image = np.full((size, size, 3), 255, dtype=np.uint8)
+    image[mask] = sofa[mask]
+
+    cutout = np.zeros((size, size, 4), dtype=np.uint8)
+    cutout[..., :3] = image
+    cutout[..., 3] = mask * 255
+    return image, cutout
+
+
+def encode_jpeg(image, quality=90):
+    output = io.BytesIO()
+    Image.fromarray(image).save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def synthetic_catalog(count, seed=0):
+    """
+    Generate the matching columns of a random catalog.
+
+    Args:
+        count (int): Number of sofas.
+        seed (int): Seed of the generator.
+
+    Returns:
+        tuple: Ids, sofa types, (count, 3) RGB colors and prices.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.arange(1, count + 1, dtype=np.int64)
+    types = rng.choice(SYNTHETIC_SOFA_TYPES, size=count)
+    colors = rng.integers(0, 256, size=(count, 3))
+    prices = rng.uniform(100, 5000, size=count).round(2)
+    return ids, types, colors, prices
+
+
+def legacy_similarity_loop(sofas, sofa_type, rgb_color, color_threshold):
+    """
+    The original matching loop: one Python iteration and similarity call per sofa of the type.
+    """
+    matches = []
+    for sofa in sofas:
+        if sofa.features['sofa_type'] != sofa_type:
+            continue
+        sofa_rgb_color = sofa.features.get('rgb_color')
+        if sofa_rgb_color and np.linalg.norm(np.array(rgb_color) - np.array(sofa_rgb_color)) <= color_threshold:
+            matches.append((sofa, calculate_sofa_similarity(sofa_type, rgb_color, sofa)))
+    matches.sort(key=lambda match: match[1], reverse=True)
+    return matches
+
+
+def benchmark_image_stages(image_size, repeat, stages):
+    """
+    Time the per-image stages of the pipeline on a synthetic image.
+
+    Stages whose dependencies are unavailable (e.g. the rembg model cannot be
+    downloaded) are reported with an "error" instead of timings.
+
+    Args:
+        image_size (int): Width and height of the synthetic image.
+        repeat (int): Timed runs per stage.
+        stages (callable): Returns whether a stage name is selected.
+
+    Returns:
+        dict: Timing summaries by stage name.
+    """
+    image, cutout = synthetic_sofa_image(image_size, (150, 75, 40))
+    encoded = encode_jpeg(image)
+    upload = decode_upload(encoded)
+    colors = np.random.default_rng(0).integers(0, 256, size=(1000, 3))
+
+    benchmarks = {
+        'decode_image': lambda: decode_image(encoded),
+        'decode_upload': lambda: decode_upload(encoded),
+        'remove_background': lambda: remove_background(upload, full_resolution=False),
+        'predict_image_class': lambda: _predict_image_class(upload),
+        'predict_image_classes_batch': lambda: _predict_image_classes([upload] * settings.KERAS_BATCH_SIZE),
+        'get_dominant_color': lambda: get_dominant_color(cutout),
+        'closest_css3_color_x1000': lambda: [closest_css3_color(color) for color in colors],
+    }
+
+    results = {}
+    for name, func in benchmarks.items():
+        if not stages(name):
+            continue
+        try:
+            results[name] = measure(func, repeat)
+        except Exception as e:
+            results[name] = {'error': f'{type(e).__name__}: {e}'}
+    return results
+
+
+def benchmark_catalog_stages(size, repeat, stages):
+    """
+    Time matching and serialization over a synthetic catalog.
+
+    Args:
+        size (int): Number of sofas in the catalog.
+        repeat (int): Timed runs per stage.
+        stages (callable): Returns whether a stage name is selected.
+
+    Returns:
+        dict: Timing summaries by stage name, suffixed with the catalog size.
+    """
+    ids, types, colors, prices = synthetic_catalog(size)
+    query_type, query_color = SYNTHETIC_SOFA_TYPES[0], [150, 75, 40]
+    color_threshold = settings.MATCH_COLOR_THRESHOLD
+    results = {}
+
+    if stages(f'similarity_loop_{size}'):
+        sofas = [
+            SimpleNamespace(features={'sofa_type': sofa_type, 'rgb_color': color.tolist()})
+            for sofa_type, color in zip(types, colors)
+        ]
+        results[f'similarity_loop_{size}'] = measure(
+            lambda: legacy_similarity_loop(sofas, query_type, query_color, color_threshold), repeat,
+        )
+
+    if stages(f'catalog_index_search_{size}'):
+        index = CatalogIndex(from_database=False)
+        index.load(zip(ids.tolist(), prices.tolist(), types.tolist(), *colors.T.tolist()))
+        results[f'catalog_index_search_{size}'] = measure(
+            lambda: index.search(query_type, query_color, budget=2500, color_threshold=color_threshold), repeat,
+        )
+
+    if stages(f'embedding_index_search_{size}'):
+        rng = np.random.default_rng(0)
+        embeddings = normalize_embeddings(rng.normal(size=(size, 100)))
+        index = EmbeddingIndex(from_database=False)
+        index.load(ids, embeddings, prices)
+        results[f'embedding_index_search_{size}'] = measure(
+            lambda: index.search(embeddings[0], limit=settings.EMBEDDING_MATCH_LIMIT), repeat,
+        )
+
+    if stages(f'serialize_{size}'):
+        request = RequestFactory().get('/api/sofas/')
+        sofas = [
+            Sofa(
+                id=int(sofa_id), name=f'Sofa {sofa_id}', image=f'sofa_images/sofa_{sofa_id}.jpg',
+                price=float(price), original_price=float(price), quantity=1, discount=0, description='',
+                image_derivatives={'thumbnail': f'sofa_derivatives/{sofa_id}.jpg'},
+            )
+            for sofa_id, price in zip(ids, prices)
+        ]
+        results[f'serialize_{size}'] = measure(
+            lambda: SofaSerializer(sofas, many=True, context={'request': request}).data, repeat,
+        )
+
+    return results
+
+
+def compare_results(current, baseline, tolerance):
+    """
+    Compare the median timings of two benchmark runs.
+
+    Args:
+        current (dict): Stage results of this run.
+        baseline (dict): Stage results of the saved baseline.
+        tolerance (float): Relative change treated as noise, e.g. 0.2 for 20%.
+
+    Returns:
+        dict: For each stage timed in both runs, the baseline and current
+        median, their ratio and "regression", "improvement" or "unchanged".
+    """
+    comparison = {}
+    for name, result in current.items():
+        previous = baseline.get(name)
+        if not previous or 'median_ms' not in previous or 'median_ms' not in result:
+            continue
+        ratio = result['median_ms'] / max(previous['median_ms'], 1e-9)
+        if ratio > 1 + tolerance:
+            verdict = 'regression'
+        elif ratio < 1 - tolerance:
+            verdict = 'improvement'
+        else:
+            verdict = 'unchanged'
+        comparison[name] = {
+            'baseline_ms': previous['median_ms'],
+            'current_ms': result['median_ms'],
+            'ratio': ratio,
+            'verdict': verdict,
+        }
+    return comparison
+
+
+# TensorFlow is only imported when a classifier stage runs.
+def _predict_image_class(image):
+    from couch_management.keras import predict_image_class
+    return predict_image_class(image)
+
+
+def _predict_image_classes(images):
+    from couch_management.keras import predict_image_classes
+    return predict_image_classes(images)
@@ -0,0 +1,318 @@
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from couch_management.models import Sofa
+
+SOFA_TYPE_WEIGHT = 0.4
+COLOR_SIMILARITY_WEIGHT = 0.6
+
+
+def rank_matches(ids, colors, rgb_color, color_threshold, limit=None):
+    """
+    Score candidate sofas of the query type and keep those within the color threshold.
+
+    The score is the same as `calculate_sofa_similarity`: a 40% weight for the
+    matching type plus a 60% weight for the normalized RGB color similarity.
+
+    Args:
+        ids (np.ndarray): Candidate sofa ids.
+        colors (np.ndarray): An (N, 3) array with the RGB color of each candidate.
+        rgb_color (tuple): The query color (R, G, B).
+        color_threshold (float): Maximum RGB distance.
+        limit (int): Maximum number of results, or None for all.
+
+    Returns:
+        list: (sofa id, similarity percentage) pairs sorted by decreasing similarity.
+    """
+    differences = np.asarray(colors, dtype=np.float32) - np.asarray(rgb_color, dtype=np.float32)
+    distances = np.sqrt(np.einsum('ij,ij->i', differences, differences))
+    within = distances <= color_threshold
+    ids = np.asarray(ids, dtype=np.int64)[within]
+    distances = distances[within]
+
+    color_similarity = np.maximum(0, 1 - distances / 255.0)
+    scores = (SOFA_TYPE_WEIGHT + COLOR_SIMILARITY_WEIGHT * color_similarity) * 100
+
+    if limit is not None and limit < len(scores):
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        ids, scores = ids[top], scores[top]
+
+    order = np.lexsort((ids, -scores))
+    return [(int(ids[i]), float(scores[i])) for i in order]
+
+
+class CatalogIndex:
+    """
+    In-memory, column-oriented copy of the sofa features used for matching.
+
+    Ids, type codes, RGB colors and prices live in contiguous NumPy arrays, so a
+    match query is a single vectorized pass instead of a loop over model instances.
+    The index is loaded from the database on first use, kept up to date by the
+    Sofa signals of this process and reloaded after settings.CATALOG_INDEX_MAX_AGE
+    seconds to pick up changes made by other processes. A reload builds the new
+    arrays without holding the lock, so searches keep using the current contents
+    until they are swapped in.
+    """
+
+    def __init__(self, capacity=1024, from_database=True):
+        """
+        Args:
+            capacity (int): Number of sofas the arrays are allocated for initially.
+            from_database (bool): Load the sofas from the database on first use and
+                reload them after settings.CATALOG_INDEX_MAX_AGE. Without it, the index
+                only holds what is passed to `load`, e.g. a synthetic catalog for a benchmark.
+        """
+        self.from_database = from_database
+        self._lock = threading.RLock()
+        self._built_at = None
+        # Changes synced while a reload reads the database, replayed onto its result.
+        self._changes = None
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self._size = 0
+        self._rows = {}
+        self._type_codes = {}
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._types = np.empty(capacity, dtype=np.int32)
+        self._colors = np.empty((capacity, 3), dtype=np.float32)
+        self._prices = np.empty(capacity, dtype=np.float64)
+
+    def _grow(self):
+        capacity = 2 * len(self._ids)
+        self._ids = np.resize(self._ids, capacity)
+        self._types = np.resize(self._types, capacity)
+        self._colors = np.resize(self._colors, (capacity, 3))
+        self._prices = np.resize(self._prices, capacity)
+
+    def _type_code(self, sofa_type):
+        return self._type_codes.setdefault(sofa_type, len(self._type_codes))
+
+    def _upsert(self, sofa_id, sofa_type, rgb_color, price):
+        row = self._rows.get(sofa_id)
+        if row is None:
+            if self._size == len(self._ids):
+                self._grow()
+            row = self._size
+            self._size += 1
+            self._rows[sofa_id] = row
+        self._ids[row] = sofa_id
+        self._types[row] = self._type_code(sofa_type)
+        self._colors[row] = rgb_color
+        self._prices[row] = price
+
+    def _discard(self, sofa_id):
+        row = self._rows.pop(sofa_id, None)
+        if row is None:
+            return
+        last = self._size - 1
+        if row != last:
+            moved_id = int(self._ids[last])
+            self._ids[row] = self._ids[last]
+            self._types[row] = self._types[last]
+            self._colors[row] = self._colors[last]
+            self._prices[row] = self._prices[last]
+            self._rows[moved_id] = row
+        self._size = last
+
+    def build(self):
+        """
+        Load every sofa with features from the database, replacing the current contents.
+
+        Does nothing if another thread is already reloading the index.
+        """
+        with self._lock:
+            if self._changes is not None:
+                return
+            self._changes = []
+        try:
+            rows = Sofa.objects.exclude(sofa_type=None).exclude(color_red=None).values_list(
+                'id', 'original_price', 'sofa_type', 'color_red', 'color_green', 'color_blue',
+            )
+            self.load(rows)
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def load(self, rows):
+        """
+        Replace the contents of the index.
+
+        Args:
+            rows (iterable): (id, price, sofa type, red, green, blue) tuples.
+        """
+        ids, prices, sofa_types, red, green, blue = list(zip(*rows)) or [()] * 6
+        size = len(ids)
+        type_names, types = np.unique(np.array(sofa_types, dtype=object), return_inverse=True)
+
+        capacity = max(size, 1024)
+        id_array = np.empty(capacity, dtype=np.int64)
+        type_array = np.empty(capacity, dtype=np.int32)
+        color_array = np.empty((capacity, 3), dtype=np.float32)
+        price_array = np.empty(capacity, dtype=np.float64)
+        id_array[:size] = ids
+        type_array[:size] = types
+        color_array[:size] = np.column_stack([red, green, blue])
+        price_array[:size] = prices
+        rows = dict(zip(id_array[:size].tolist(), range(size)))
+        type_codes = {sofa_type: code for code, sofa_type in enumerate(type_names.tolist())}
+
+        with self._lock:
+            self._size = size
+            self._rows = rows
+            self._type_codes = type_codes
+            self._ids, self._types, self._colors, self._prices = id_array, type_array, color_array, price_array
+            self._built_at = time.monotonic()
+            for change in self._changes or []:
+                self._apply(*change)
+
+    def _ensure_fresh(self):
+        if not self.from_database:
+            return
+        if self._built_at is None:
+            with self._lock:
+                if self._built_at is None:
+                    self.build()
+            return
+        max_age = settings.CATALOG_INDEX_MAX_AGE
+        if max_age and time.monotonic() - self._built_at > max_age:
+            self.build()
+
+    def _apply(self, sofa_id, price, features):
+        if features and features.get('sofa_type') and features.get('rgb_color'):
+            self._upsert(sofa_id, features['sofa_type'], features['rgb_color'], price)
+        else:
+            self._discard(sofa_id)
+
+    def sync(self, sofa_id, price, features):
+        """
+        Add, update or remove one sofa after it changed in the database.
+
+        Does nothing if the index has not been loaded yet, since loading reads the current rows anyway.
+
+        Args:
+            sofa_id (int): The sofa primary key.
+            price (float): The price the budget filter applies to.
+            features (dict): The sofa features, or None if it has none.
+        """
+        with self._lock:
+            if self._built_at is None:
+                return
+            self._apply(sofa_id, price, features)
+            if self._changes is not None:
+                self._changes.append((sofa_id, price, features))
+
+    def remove(self, sofa_id):
+        """
+        Remove one sofa after it was deleted from the database.
+        """
+        with self._lock:
+            self._discard(sofa_id)
+            if self._changes is not None:
+                self._changes.append((sofa_id, None, None))
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def search(self, sofa_type, rgb_color, budget=None, color_threshold=None, limit=None):
+        """
+        Find the sofas of a type within a color distance and budget, best match first.
+
+        Args:
+            sofa_type (str): The sofa type the candidates must have.
+            rgb_color (tuple): The query color (R, G, B).
+            budget (float): Maximum price, or None for no limit.
+            color_threshold (float): Maximum RGB distance. Defaults to settings.MATCH_COLOR_THRESHOLD.
+            limit (int): Maximum number of results, or None for all.
+
+        Returns:
+            list: (sofa id, similarity percentage) pairs sorted by decreasing similarity.
+        """
+        if color_threshold is None:
+            color_threshold = settings.MATCH_COLOR_THRESHOLD
+
+        self._ensure_fresh()
+        with self._lock:
+            type_code = self._type_codes.get(sofa_type)
+            if type_code is None:
+                return []
+
+            size = self._size
+            mask = self._types[:size] == type_code
+            if budget is not None:
+                mask &= self._prices[:size] <= budget
+            candidates = np.flatnonzero(mask)
+
+            ids = self._ids[candidates]
+            colors = self._colors[candidates]
+
+        return rank_matches(ids, colors, rgb_color, color_threshold, limit)
+
+
+_catalog_index = None
+_catalog_index_lock = threading.Lock()
+
+
+def get_catalog_index():
+    """
+    Return the process-wide catalog index, creating it on first access.
+
+    Returns:
+        CatalogIndex: The shared index.
+    """
+    global _catalog_index
+    if _catalog_index is None:
+        with _catalog_index_lock:
+            if _catalog_index is None:
+                _catalog_index = CatalogIndex()
+    return _catalog_index
+
+
+def search_database(sofa_type, rgb_color, budget=None, color_threshold=None, limit=None):
+    """
+    Find matching sofas with the candidate filter running in the database.
+
+    Type, budget and a bounding box around the color are filtered through the
+    indexed feature columns, so only the few rows near the query color are read.
+
+    Args:
+        sofa_type (str): The sofa type the candidates must have.
+        rgb_color (tuple): The query color (R, G, B).
+        budget (float): Maximum price, or None for no limit.
+        color_threshold (float): Maximum RGB distance. Defaults to settings.MATCH_COLOR_THRESHOLD.
+        limit (int): Maximum number of results, or None for all.
+
+    Returns:
+        list: (sofa id, similarity percentage) pairs sorted by decreasing similarity.
+    """
+    if color_threshold is None:
+        color_threshold = settings.MATCH_COLOR_THRESHOLD
+
+    rows = list(
+        Sofa.objects.matching_candidates(sofa_type, rgb_color, color_threshold, budget=budget)
+        .values_list('id', 'color_red', 'color_green', 'color_blue')
+    )
+    if not rows:
+        return []
+
+    candidates = np.array(rows, dtype=np.int64)
+    return rank_matches(candidates[:, 0], candidates[:, 1:], rgb_color, color_threshold, limit)
+
+
+def search_catalog(sofa_type, rgb_color, budget=None, color_threshold=None, limit=None):
+    """
+    Find matching sofas with the backend selected by settings.MATCH_BACKEND.
+
+    "index" searches this process's in-memory CatalogIndex, "database" filters
+    candidates in SQL. Both return the same results.
+
+    Returns:
+        list: (sofa id, similarity percentage) pairs sorted by decreasing similarity.
+    """
+    if settings.MATCH_BACKEND == 'database':
+        return search_database(sofa_type, rgb_color, budget, color_threshold, limit)
+    return get_catalog_index().search(sofa_type, rgb_color, budget, color_threshold, limit)
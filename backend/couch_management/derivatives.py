@@ -0,0 +1,124 @@
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from couch_management.models import Sofa
+
+DERIVATIVES_DIR = 'sofa_derivatives'
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+
+def flatten(image):
+    """
+    Convert an image to RGB, compositing transparent areas onto a white background.
+
+    Args:
+        image (PIL.Image.Image): The image, in any mode.
+
+    Returns:
+        PIL.Image.Image: The RGB image.
+    """
+    if image.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return image.convert('RGB')
+
+
+def render_derivatives(data):
+    """
+    Resize and re-encode an image into every derivative of settings.IMAGE_DERIVATIVES.
+
+    JPEGs are decoded at a reduced scale close to the largest derivative, so a
+    3840px original is never fully decoded to produce a 720px card. The EXIF
+    orientation is applied, since re-encoding drops it, and transparent areas
+    become white.
+
+    Args:
+        data (bytes): The encoded original image.
+
+    Returns:
+        dict: The encoded bytes and file extension of each derivative, by name.
+    """
+    largest = max(size for size, _ in settings.IMAGE_DERIVATIVES.values())
+    with Image.open(io.BytesIO(data)) as original:
+        original.draft('RGB', (largest, largest))
+        original = flatten(ImageOps.exif_transpose(original))
+
+    rendered = {}
+    for name, (size, image_format) in settings.IMAGE_DERIVATIVES.items():
+        image = original.copy()
+        image.thumbnail((size, size), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=settings.IMAGE_DERIVATIVE_QUALITY, optimize=True)
+        rendered[name] = (output.getvalue(), EXTENSIONS[image_format])
+    return rendered
+
+
+def store_derivatives(data):
+    """
+    Render the derivatives of an image and store them under content-hashed names.
+
+    A derivative's name changes whenever its content changes, so it can be
+    cached forever and identical derivatives are only stored once.
+
+    Args:
+        data (bytes): The encoded original image.
+
+    Returns:
+        dict: The storage name of each derivative, by name.
+    """
+    names = {}
+    for name, (content, extension) in render_derivatives(data).items():
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        storage_name = f'{DERIVATIVES_DIR}/{digest}.{extension}'
+        if not default_storage.exists(storage_name):
+            storage_name = default_storage.save(storage_name, ContentFile(content))
+        names[name] = storage_name
+    return names
+
+
+def generate_image_derivatives(sofa, data=None):
+    """
+    Generate and store the image derivatives of one sofa.
+
+    Args:
+        sofa (Sofa): The sofa, with its image loaded.
+        data (bytes): The encoded image, if it was already read.
+
+    Returns:
+        dict: The storage name of each derivative, by name.
+    """
+    if data is None:
+        with sofa.image.open('rb') as image_file:
+            data = image_file.read()
+
+    derivatives = store_derivatives(data)
+    sofa.updated_at = timezone.now()
+    Sofa.objects.filter(pk=sofa.pk).update(image_derivatives=derivatives, updated_at=sofa.updated_at)
+    sofa.image_derivatives = derivatives
+    return derivatives
+
+
+def derivative_urls(sofa, request=None):
+    """
+    Return the URLs of a sofa's image derivatives.
+
+    Args:
+        sofa (Sofa): The sofa.
+        request: The current request, used to build absolute URLs.
+
+    Returns:
+        dict: The URL of each derivative, by name. Empty until the derivatives are generated.
+    """
+    urls = {}
+    for name, storage_name in (sofa.image_derivatives or {}).items():
+        url = default_storage.url(storage_name)
+        urls[name] = request.build_absolute_uri(url) if request else url
+    return urls
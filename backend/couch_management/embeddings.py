@@ -0,0 +1,327 @@
+import os
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from couch_management.models import Sofa
+
+EMBEDDING_DTYPE = np.float16
+
+
+def normalize_embeddings(embeddings):
+    """
+    Scale embeddings to unit length so that dot products are cosine similarities.
+
+    Args:
+        embeddings (np.ndarray): A (D,) or (N, D) array.
+
+    Returns:
+        np.ndarray: The normalized float32 embeddings.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def encode_embedding(embedding):
+    """
+    Serialize an embedding for Sofa.embedding as normalized float16 bytes.
+    """
+    return normalize_embeddings(embedding).astype(EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embedding(data):
+    """
+    Deserialize an embedding stored by `encode_embedding` into a float32 array.
+    """
+    return np.frombuffer(data, dtype=EMBEDDING_DTYPE).astype(np.float32)
+
+
+def spherical_kmeans(vectors, clusters, iterations=10, seed=0):
+    """
+    Cluster unit vectors by cosine similarity.
+
+    Args:
+        vectors (np.ndarray): An (N, D) array of normalized vectors.
+        clusters (int): Number of clusters.
+        iterations (int): Number of refinement iterations.
+        seed (int): Seed for picking the initial centroids.
+
+    Returns:
+        np.ndarray: The (clusters, D) normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(clusters):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        centroids = normalize_embeddings(centroids)
+    return centroids
+
+
+class _InvertedList:
+    """
+    The ids, vectors and prices of the sofas assigned to one centroid.
+    """
+
+    def __init__(self, dimension, capacity=16):
+        self.size = 0
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.vectors = np.empty((capacity, dimension), dtype=np.float32)
+        self.prices = np.empty(capacity, dtype=np.float64)
+
+    def append(self, sofa_id, vector, price):
+        if self.size == len(self.ids):
+            capacity = 2 * len(self.ids)
+            self.ids = np.resize(self.ids, capacity)
+            self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+            self.prices = np.resize(self.prices, capacity)
+        self.ids[self.size] = sofa_id
+        self.vectors[self.size] = vector
+        self.prices[self.size] = price
+        self.size += 1
+        return self.size - 1
+
+    def pop(self, row):
+        """
+        Remove a row by moving the last row into its place.
+
+        Returns:
+            int: The id of the sofa that moved into `row`, or None.
+        """
+        last = self.size - 1
+        moved_id = None
+        if row != last:
+            self.ids[row] = self.ids[last]
+            self.vectors[row] = self.vectors[last]
+            self.prices[row] = self.prices[last]
+            moved_id = int(self.ids[row])
+        self.size = last
+        return moved_id
+
+
+class EmbeddingIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index over sofa image embeddings.
+
+    The embeddings are grouped into lists around coarse centroids. A query only
+    scans the `nprobe` lists whose centroids are closest to it, so its cost grows
+    with about nprobe / nlist of the catalog instead of the whole catalog.
+
+    The centroids are persisted at settings.EMBEDDING_INDEX_PATH and reused by
+    other processes and restarts. Sofas are added and removed incrementally. The
+    centroids are retrained once the catalog has grown to four times the size they
+    were trained on.
+    """
+
+    def __init__(self, path=None, from_database=True):
+        """
+        Args:
+            path (str): Where the centroids are persisted, or None to keep them in memory.
+            from_database (bool): Load the sofa embeddings from the database on first use and
+                reload them after settings.CATALOG_INDEX_MAX_AGE. Without it, the index only
+                holds what is passed to `load`, e.g. synthetic embeddings for a benchmark.
+        """
+        self.path = path
+        self.from_database = from_database
+        self._lock = threading.RLock()
+        self._centroids = None
+        self._trained_size = 0
+        self._lists = []
+        self._locations = {}
+        self._built_at = None
+
+    def _train(self, vectors):
+        clusters = int(np.clip(np.sqrt(len(vectors)), 1, 4096))
+        sample = vectors
+        if len(vectors) > 256 * clusters:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(len(vectors), size=256 * clusters, replace=False)]
+        self._centroids = spherical_kmeans(sample, clusters)
+        self._trained_size = len(vectors)
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temporary_path = f'{self.path}.tmp.npz'
+            np.savez(temporary_path, centroids=self._centroids, trained_size=self._trained_size)
+            os.replace(temporary_path, self.path)
+
+    def _load_centroids(self, dimension):
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as saved:
+            if saved['centroids'].shape[1] != dimension:
+                return False
+            self._centroids = saved['centroids']
+            self._trained_size = int(saved['trained_size'])
+        return True
+
+    def _reset_lists(self):
+        dimension = self._centroids.shape[1]
+        self._lists = [_InvertedList(dimension) for _ in range(len(self._centroids))]
+        self._locations = {}
+
+    def _add(self, sofa_id, vector, price):
+        self._remove(sofa_id)
+        cluster = int(np.argmax(self._centroids @ vector))
+        row = self._lists[cluster].append(sofa_id, vector, price)
+        self._locations[sofa_id] = (cluster, row)
+
+    def _remove(self, sofa_id):
+        location = self._locations.pop(sofa_id, None)
+        if location is None:
+            return
+        cluster, row = location
+        moved_id = self._lists[cluster].pop(row)
+        if moved_id is not None:
+            self._locations[moved_id] = (cluster, row)
+
+    def build(self):
+        """
+        Load every sofa embedding from the database and assign it to its list.
+
+        Persisted centroids are reused when they fit the embeddings and the
+        catalog has not outgrown them; otherwise the centroids are retrained.
+        """
+        rows = list(Sofa.objects.exclude(embedding=None).values_list('id', 'original_price', 'embedding').iterator())
+        if not rows:
+            with self._lock:
+                self._built_at = time.monotonic()
+                self._centroids = None
+                self._lists, self._locations = [], {}
+            return
+
+        self.load(
+            np.array([row[0] for row in rows], dtype=np.int64),
+            np.stack([decode_embedding(row[2]) for row in rows]),
+            np.array([row[1] for row in rows], dtype=np.float64),
+        )
+
+    def load(self, ids, vectors, prices):
+        """
+        Replace the contents of the index with the given embeddings.
+
+        Args:
+            ids (np.ndarray): The sofa ids.
+            vectors (np.ndarray): The (N, D) normalized embeddings.
+            prices (np.ndarray): The sofa prices.
+        """
+        with self._lock:
+            self._built_at = time.monotonic()
+            if not self._load_centroids(vectors.shape[1]) or len(vectors) > 4 * self._trained_size:
+                self._train(vectors)
+            self._reset_lists()
+
+            clusters = np.argmax(vectors @ self._centroids.T, axis=1)
+            for sofa_id, vector, price, cluster in zip(ids, vectors, prices, clusters):
+                row = self._lists[cluster].append(sofa_id, vector, price)
+                self._locations[int(sofa_id)] = (int(cluster), row)
+
+    def _ensure_fresh(self):
+        if not self.from_database:
+            return
+        max_age = settings.CATALOG_INDEX_MAX_AGE
+        if self._built_at is None or (max_age and time.monotonic() - self._built_at > max_age):
+            self.build()
+
+    def sync(self, sofa_id, price, embedding):
+        """
+        Add, update or remove one sofa after it changed in the database.
+
+        Does nothing if the index has not been loaded yet.
+
+        Args:
+            sofa_id (int): The sofa primary key.
+            price (float): The price the budget filter applies to.
+            embedding (bytes): The stored embedding, or None if the sofa has none.
+        """
+        with self._lock:
+            if self._built_at is None:
+                return
+            if embedding is None:
+                self._remove(sofa_id)
+            elif self._centroids is None:
+                self._built_at = None
+            else:
+                self._add(sofa_id, decode_embedding(embedding), price)
+                if len(self._locations) > 4 * self._trained_size:
+                    self.build()
+
+    def remove(self, sofa_id):
+        """
+        Remove one sofa after it was deleted from the database.
+        """
+        with self._lock:
+            self._remove(sofa_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locations)
+
+    def _scan(self, lists, query, budget, limit):
+        ids = np.concatenate([inverted.ids[:inverted.size] for inverted in lists])
+        vectors = np.concatenate([inverted.vectors[:inverted.size] for inverted in lists])
+        prices = np.concatenate([inverted.prices[:inverted.size] for inverted in lists])
+        similarities = vectors @ query
+        if budget is not None:
+            within_budget = prices <= budget
+            ids, similarities = ids[within_budget], similarities[within_budget]
+
+        if limit < len(similarities):
+            top = np.argpartition(-similarities, limit - 1)[:limit]
+            ids, similarities = ids[top], similarities[top]
+        order = np.lexsort((ids, -similarities))
+        return [(int(ids[i]), float(similarities[i])) for i in order]
+
+    def search(self, embedding, limit=10, budget=None, nprobe=None, exact=False):
+        """
+        Find the sofas whose image embeddings are most similar to a query embedding.
+
+        Args:
+            embedding (np.ndarray): The query embedding.
+            limit (int): Maximum number of results.
+            budget (float): Maximum price, or None for no limit.
+            nprobe (int): Number of lists scanned. Defaults to settings.EMBEDDING_INDEX_NPROBE.
+            exact (bool): Scan every list, i.e. exact search.
+
+        Returns:
+            list: (sofa id, cosine similarity) pairs sorted by decreasing similarity.
+        """
+        query = normalize_embeddings(embedding)
+        nprobe = nprobe or settings.EMBEDDING_INDEX_NPROBE
+        with self._lock:
+            self._ensure_fresh()
+            if self._centroids is None:
+                return []
+            if exact or nprobe >= len(self._lists):
+                lists = self._lists
+            else:
+                closest = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+                lists = [self._lists[cluster] for cluster in closest]
+            lists = [inverted for inverted in lists if inverted.size]
+            if not lists:
+                return []
+            return self._scan(lists, query, budget, limit)
+
+
+_embedding_index = None
+_embedding_index_lock = threading.Lock()
+
+
+def get_embedding_index():
+    """
+    Return the process-wide embedding index, creating it on first access.
+
+    Returns:
+        EmbeddingIndex: The shared index.
+    """
+    global _embedding_index
+    if _embedding_index is None:
+        with _embedding_index_lock:
+            if _embedding_index is None:
+                _embedding_index = EmbeddingIndex(settings.EMBEDDING_INDEX_PATH)
+    return _embedding_index
@@ -0,0 +1,207 @@
+import functools
+import hashlib
+import io
+import json
+import threading
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+from PIL import Image
+
+from couch_management.keras import file_digest, resolve_inference_backend
+from couch_management.models import ImageFeatures
+
+# Bump when the feature extraction code changes in a way that changes its results.
+FEATURE_PIPELINE_REVISION = 1
+
+# Writes between two checks of the store size.
+EVICTION_INTERVAL = 100
+
+# last_used_at is only refreshed when it is older than this, so hits rarely write.
+TOUCH_INTERVAL = timedelta(hours=1)
+
+_writes = 0
+_writes_lock = threading.Lock()
+
+
+def _fingerprint(values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=None)
+def mask_version():
+    """
+    Returns:
+        str: The version of the background removal, which changes with the rembg model and mask size.
+    """
+    return _fingerprint({
+        'rembg_model': settings.REMBG_MODEL_NAME,
+        'mask_size': settings.REMBG_MASK_MAX_SIZE,
+    })
+
+
+@functools.lru_cache(maxsize=None)
+def pipeline_version():
+    """
+    Return the version of the feature pipeline.
+
+    It changes with FEATURE_PIPELINE_REVISION, the background removal, the
+    classifier model file that is run and its labels, and the color extraction settings.
+
+    Returns:
+        str: The version, 16 hex characters.
+    """
+    model_paths = {
+        'keras': settings.KERAS_MODEL_PATH,
+        'onnx': settings.ONNX_MODEL_PATH,
+        'tflite': settings.TFLITE_MODEL_PATH,
+    }
+    return _fingerprint({
+        'revision': FEATURE_PIPELINE_REVISION,
+        'mask': mask_version(),
+        'classifier': file_digest(model_paths[resolve_inference_backend(settings.INFERENCE_BACKEND)]),
+        'labels': file_digest(settings.KERAS_LABELS_PATH),
+        'color_method': settings.DOMINANT_COLOR_METHOD,
+        'color_max_pixels': settings.DOMINANT_COLOR_MAX_PIXELS,
+    })
+
+
+def encode_mask(mask):
+    output = io.BytesIO()
+    Image.fromarray(mask, 'L').save(output, format='PNG')
+    return output.getvalue()
+
+
+def decode_mask(data):
+    with Image.open(io.BytesIO(data)) as mask:
+        return np.asarray(mask.convert('L'))
+
+
+def build_record(digest, sofa_type, confidence, palette, embedding, mask):
+    """
+    Build an unsaved feature store record.
+
+    Args:
+        digest (str): The SHA-256 hex digest of the encoded image.
+        sofa_type (str): The predicted sofa type.
+        confidence (float): The classifier's confidence.
+        palette (list): (RGB tuple, proportion) pairs from `get_color_palette`.
+        embedding (bytes): The encoded image embedding.
+        mask (np.ndarray): The foreground mask.
+
+    Returns:
+        ImageFeatures: The record.
+    """
+    palette = [[list(rgb_color), proportion] for rgb_color, proportion in palette]
+    mask = encode_mask(mask)
+    return ImageFeatures(
+        digest=digest,
+        pipeline_version=pipeline_version(),
+        mask_version=mask_version(),
+        sofa_type=sofa_type,
+        confidence=float(confidence),
+        palette=palette,
+        embedding=embedding,
+        mask=mask,
+        size=len(embedding) + len(mask) + len(json.dumps(palette)) + len(digest),
+        last_used_at=timezone.now(),
+    )
+
+
+def lookup_features(digests):
+    """
+    Look up the records of the current pipeline version for image digests.
+
+    Args:
+        digests (iterable): SHA-256 hex digests.
+
+    Returns:
+        dict: The records found, by digest.
+    """
+    if not settings.FEATURE_STORE_ENABLED:
+        return {}
+
+    records = {
+        record.digest: record
+        for record in ImageFeatures.objects.filter(digest__in=set(digests), pipeline_version=pipeline_version())
+    }
+
+    now = timezone.now()
+    stale = [record.pk for record in records.values() if record.last_used_at < now - TOUCH_INTERVAL]
+    if stale:
+        ImageFeatures.objects.filter(pk__in=stale).update(last_used_at=now)
+    return records
+
+
+def lookup_masks(digests):
+    """
+    Look up foreground masks computed by the current background removal for image
+    digests, e.g. by an earlier pipeline version with another classifier.
+
+    Args:
+        digests (iterable): SHA-256 hex digests.
+
+    Returns:
+        dict: The decoded masks found, by digest.
+    """
+    if not settings.FEATURE_STORE_ENABLED:
+        return {}
+
+    masks = ImageFeatures.objects.filter(digest__in=set(digests), mask_version=mask_version()).values_list('digest', 'mask')
+    return {digest: decode_mask(bytes(mask)) for digest, mask in masks}
+
+
+def store_features(records):
+    """
+    Save new records, ignoring images that another process stored meanwhile,
+    and keep the store below settings.FEATURE_STORE_MAX_MB.
+
+    Args:
+        records (list): Unsaved ImageFeatures records.
+    """
+    global _writes
+    if not settings.FEATURE_STORE_ENABLED or not records:
+        return
+
+    ImageFeatures.objects.bulk_create(records, ignore_conflicts=True)
+
+    with _writes_lock:
+        _writes += len(records)
+        check = _writes >= EVICTION_INTERVAL
+        if check:
+            _writes = 0
+    if check:
+        evict_features(settings.FEATURE_STORE_MAX_MB * 2 ** 20)
+
+
+def evict_features(max_bytes, dry_run=False):
+    """
+    Delete the least recently used records until the store holds at most `max_bytes`.
+
+    Args:
+        max_bytes (int): The size bound, 0 for no bound.
+        dry_run (bool): Only count the records that would be deleted.
+
+    Returns:
+        tuple: The number of deleted records and the bytes they held.
+    """
+    if not max_bytes:
+        return 0, 0
+    excess = (ImageFeatures.objects.aggregate(total=Sum('size'))['total'] or 0) - max_bytes
+    if excess <= 0:
+        return 0, 0
+
+    ids, freed = [], 0
+    for record_id, size in ImageFeatures.objects.order_by('last_used_at', 'id').values_list('id', 'size').iterator():
+        if freed >= excess:
+            break
+        ids.append(record_id)
+        freed += size
+
+    if not dry_run:
+        for start in range(0, len(ids), 1000):
+            ImageFeatures.objects.filter(pk__in=ids[start:start + 1000]).delete()
+    return len(ids), freed
@@ -0,0 +1,182 @@
+from pathlib import Path
+
+from django.utils import timezone
+
+from couch_management.catalog_index import get_catalog_index
+from couch_management.derivatives import store_derivatives
+from couch_management.embeddings import encode_embedding, get_embedding_index
+from couch_management.feature_store import (build_record, lookup_features,
+                                            lookup_masks, pipeline_version,
+                                            store_features)
+from couch_management.imaging import (BackgroundRemovalError, apply_mask,
+                                      decode_image, remove_background)
+from couch_management.keras import predict_image_classes
+from couch_management.match_cache import content_hash
+from couch_management.metrics import span
+from couch_management.models import FeatureStatus, Sofa
+from couch_management.utils import describe_color, get_color_palette
+
+# The columns written by `generate_sofa_features`.
+FEATURE_FIELDS = [
+    'features', *Sofa.feature_columns(None), 'embedding', 'features_status', 'features_error',
+    'image_derivatives', 'image_hash', 'features_version', 'updated_at',
+]
+
+
+def cut_out(images, decode=decode_image, masks=None):
+    """
+    Decode images and remove their backgrounds the way feature extraction does.
+
+    The stored mask of an image is reused if the current background removal
+    computed one before.
+
+    Args:
+        images (list): (SHA-256 hex digest, encoded image) pairs.
+        decode (callable): Decodes an encoded image into an RGB array.
+        masks (dict): Stored masks by digest, if they were already looked up.
+
+    Returns:
+        list: The cutouts as RGBA uint8 arrays, in the order of `images`.
+
+    Raises:
+        BackgroundRemovalError: If the background of an image could not be removed.
+    """
+    if masks is None:
+        with span('feature_store'):
+            masks = lookup_masks(digest for digest, _ in images)
+
+    cutouts = []
+    for digest, data in images:
+        with span('decode'):
+            image = decode(data)
+        if digest in masks:
+            cutouts.append(apply_mask(image, masks[digest]))
+            continue
+        try:
+            with span('background_removal'):
+                cutouts.append(remove_background(image, full_resolution=False))
+        except Exception as e:
+            raise BackgroundRemovalError(str(e)) from e
+    return cutouts
+
+
+def extract_image_features(images, decode=decode_image, batch_size=None, store=True, micro_batch=False):
+    """
+    Return the feature store records of images, computing only those that are not stored yet.
+
+    Missing images are decoded and their backgrounds removed one by one (or
+    their stored mask is reused, if only the classifier or color settings
+    changed), the cutouts are classified and embedded together with batched
+    forward passes and the color palette is extracted per cutout.
+
+    Args:
+        images (list): (SHA-256 hex digest, encoded image) pairs.
+        decode (callable): Decodes an encoded image into an RGB array.
+        batch_size (int): Number of images per classifier forward pass.
+        store (bool): Save the computed records in the feature store. Uploaded
+            query images are decoded at a reduced resolution, so their records
+            must not be reused for the same image imported as a catalog sofa.
+        micro_batch (bool): Classify a single query image together with those of concurrent
+            requests when INFERENCE_BATCHING is enabled.
+
+    Returns:
+        dict: The ImageFeatures records, by digest.
+
+    Raises:
+        BackgroundRemovalError: If the background of an image could not be removed.
+    """
+    with span('feature_store'):
+        records = lookup_features(digest for digest, _ in images)
+        missing = {digest: data for digest, data in images if digest not in records}
+        masks = lookup_masks(missing) if missing else {}
+    if not missing:
+        return records
+
+    cutouts = cut_out(list(missing.items()), decode=decode, masks=masks)
+
+    with span('classification'):
+        predictions, embeddings = predict_image_classes(
+            cutouts, batch_size=batch_size, return_embeddings=True, micro_batch=micro_batch,
+        )
+
+    computed = []
+    for digest, cutout, (sofa_type, confidence), embedding in zip(missing, cutouts, predictions, embeddings):
+        with span('dominant_color'):
+            palette = get_color_palette(cutout)
+        computed.append(build_record(digest, sofa_type, confidence, palette, encode_embedding(embedding), cutout[..., 3]))
+
+    if store:
+        with span('feature_store'):
+            store_features(computed)
+    records.update((record.digest, record) for record in computed)
+    return records
+
+
+def generate_sofa_features(sofas, batch_size=None):
+    """
+    Generate and store image features for several sofas at once.
+
+    The resized image derivatives are stored per image, unless the image did
+    not change since they were generated. The features come from the feature
+    store for images that were processed before and are extracted with
+    `extract_image_features` otherwise. All sofas are written with one
+    `bulk_update` and stamped with the image hash and the pipeline version.
+
+    Args:
+        sofas (iterable): Sofa instances whose images should be processed.
+        batch_size (int): Number of images per classifier forward pass.
+
+    Returns:
+        list: The ids of the sofas whose features were updated.
+    """
+    images = []
+    for sofa in sofas:
+        if not sofa.image:
+            continue
+
+        image_path = Path(sofa.image.path)
+        if not image_path.exists():
+            continue
+
+        with span('read'), open(image_path, 'rb') as input_file:
+            data = input_file.read()
+        digest = content_hash(data)
+        if digest != sofa.image_hash or not sofa.image_derivatives:
+            with span('derivatives'):
+                sofa.image_derivatives = store_derivatives(data)
+        images.append((sofa, digest, data))
+
+    if not images:
+        return []
+
+    records = extract_image_features([(digest, data) for _, digest, data in images], batch_size=batch_size)
+
+    version = pipeline_version()
+    updated_at = timezone.now()
+    for sofa, digest, _ in images:
+        record = records[digest]
+        color = describe_color(record.dominant_color)
+
+        sofa.features = {
+            "sofa_type": record.sofa_type,
+            "color_name": color.name,
+            "hex_color": color.hex,
+            "rgb_color": color.rgb,
+        }
+        for column, value in Sofa.feature_columns(sofa.features).items():
+            setattr(sofa, column, value)
+        sofa.embedding = bytes(record.embedding)
+        sofa.features_status = FeatureStatus.DONE
+        sofa.features_error = ''
+        sofa.image_hash = digest
+        sofa.features_version = version
+        sofa.updated_at = updated_at
+
+    with span('db_update'):
+        Sofa.objects.bulk_update([sofa for sofa, _, _ in images], FEATURE_FIELDS)
+
+    for sofa, _, _ in images:
+        get_catalog_index().sync(sofa.pk, sofa.original_price, sofa.features)
+        get_embedding_index().sync(sofa.pk, sofa.original_price, sofa.embedding)
+
+    return [sofa.pk for sofa, _, _ in images]
@@ -0,0 +1,186 @@
+import io
+import threading
+
+import numpy as np
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from couch_management.lazy import lazy_import
+
+# rembg imports onnxruntime, scipy and numba, so it is only imported by the first background removal.
+rembg = lazy_import('rembg')
+
+
+class BackgroundRemovalError(Exception):
+    """
+    Raised when the background of an uploaded image could not be removed.
+    """
+
+
+class UploadTooLargeError(ValueError):
+    """
+    Raised when an uploaded image exceeds the configured byte or pixel limits.
+    """
+
+
+_rembg_session = None
+_rembg_session_lock = threading.Lock()
+
+
+def decode_image(data, max_size=None, max_pixels=None):
+    """
+    Decode encoded image bytes into an RGB array.
+
+    The EXIF orientation is applied, so photos taken with a rotated phone are upright.
+
+    Args:
+        data (bytes): The encoded image (JPEG, PNG, ...).
+        max_size (int): Downscale the image so that its longest side is at most
+            this many pixels. JPEGs are decoded directly at a reduced scale.
+        max_pixels (int): Reject images with more pixels, from their header and before decoding.
+
+    Returns:
+        np.ndarray: The decoded image as an RGB uint8 array.
+
+    Raises:
+        UploadTooLargeError: If the image has more than `max_pixels` pixels.
+        ValueError: If the data is not a valid image.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            if max_pixels and source.width * source.height > max_pixels:
+                raise UploadTooLargeError(
+                    f"The uploaded image has more than {max_pixels / 1e6:g} megapixels."
+                )
+            if max_size:
+                source.draft('RGB', (max_size, max_size))
+
+            image = ImageOps.exif_transpose(source).convert("RGB")
+            if max_size:
+                image.thumbnail((max_size, max_size), Image.BILINEAR)
+            return np.asarray(image)
+    except Image.DecompressionBombError:
+        raise UploadTooLargeError("The uploaded image has too many pixels.")
+    except (UnidentifiedImageError, OSError):
+        raise ValueError("The uploaded file is not a valid image.")
+
+
+def check_upload_size(size):
+    """
+    Reject an upload larger than settings.UPLOAD_MAX_BYTES.
+
+    Args:
+        size (int): The size of the upload in bytes.
+
+    Raises:
+        UploadTooLargeError: If the upload is too large.
+    """
+    if settings.UPLOAD_MAX_BYTES and size > settings.UPLOAD_MAX_BYTES:
+        raise UploadTooLargeError(
+            f"The uploaded image is larger than {round(settings.UPLOAD_MAX_BYTES / (1024 * 1024), 1):g} MB."
+        )
+
+
+def decode_upload(data):
+    """
+    Decode an uploaded query image at the working resolution of the matching pipeline.
+
+    The byte and pixel limits are checked before the image is decoded, so
+    oversized uploads and decompression bombs are rejected cheaply.
+
+    Args:
+        data (bytes): The encoded uploaded image.
+
+    Returns:
+        np.ndarray: The RGB image, at most settings.UPLOAD_WORKING_SIZE pixels on its longest side.
+
+    Raises:
+        UploadTooLargeError: If the upload exceeds the byte or pixel limits.
+        ValueError: If the data is not a valid image.
+    """
+    check_upload_size(len(data))
+    return decode_image(data, max_size=settings.UPLOAD_WORKING_SIZE, max_pixels=settings.UPLOAD_MAX_PIXELS)
+
+
+def get_rembg_session():
+    """
+    Return the process-wide rembg session, creating it on first access.
+
+    The segmentation model named by settings.REMBG_MODEL_NAME is resolved and
+    loaded into onnxruntime once and reused by every call.
+
+    Returns:
+        BaseSession: The shared rembg session.
+    """
+    global _rembg_session
+    if _rembg_session is None:
+        with _rembg_session_lock:
+            if _rembg_session is None:
+                _rembg_session = rembg.new_session(settings.REMBG_MODEL_NAME)
+    return _rembg_session
+
+
+def is_rembg_session_loaded():
+    return _rembg_session is not None
+
+
+def remove_background(image, mask_size=None, full_resolution=True):
+    """
+    Remove the background of an image.
+
+    When the image is larger than `mask_size`, the foreground mask is computed on
+    a downscaled copy. The segmentation model works at 320x320 anyway, so this
+    mostly saves resampling the full-resolution image and mask.
+
+    Args:
+        image (np.ndarray): The image as an RGB uint8 array.
+        mask_size (int): Longest side of the copy the mask is computed on. 0 uses the full
+            resolution. Defaults to settings.REMBG_MASK_MAX_SIZE.
+        full_resolution (bool): If True, the mask is upsampled and applied to the original
+            image. If False, the downscaled cutout is returned, which is enough for
+            classification and color extraction.
+
+    Returns:
+        np.ndarray: The cutout as an RGBA uint8 array with a transparent background.
+    """
+    session = get_rembg_session()
+    mask_size = settings.REMBG_MASK_MAX_SIZE if mask_size is None else mask_size
+
+    height, width = image.shape[:2]
+    if not mask_size or max(height, width) <= mask_size:
+        return rembg.remove(image, session=session)
+
+    scale = mask_size / max(height, width)
+    source = Image.fromarray(image).convert("RGBA")
+    small = source.resize((max(round(width * scale), 1), max(round(height * scale), 1)), Image.Resampling.BILINEAR)
+    mask = rembg.remove(small, session=session, only_mask=True)
+
+    if full_resolution:
+        mask = mask.resize(source.size, Image.Resampling.BILINEAR)
+    else:
+        source = small
+
+    return apply_mask(source, mask)
+
+
+def apply_mask(image, mask):
+    """
+    Cut an image out with a foreground mask, e.g. one kept from an earlier background removal.
+
+    Args:
+        image (np.ndarray | Image.Image): The RGB(A) image. It is resized to the mask if their sizes differ.
+        mask (np.ndarray | Image.Image): The foreground mask, 255 where the sofa is.
+
+    Returns:
+        np.ndarray: The cutout as an RGBA uint8 array with a transparent background.
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    if isinstance(mask, np.ndarray):
+        mask = Image.fromarray(mask, "L")
+
+    image = image.convert("RGBA")
+    if image.size != mask.size:
+        image = image.resize(mask.size, Image.Resampling.BILINEAR)
+    empty = Image.new("RGBA", image.size, 0)
+    return np.asarray(Image.composite(image, empty, mask))
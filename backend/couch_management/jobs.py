@@ -0,0 +1,219 @@
+import logging
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from couch_management.features import generate_sofa_features
+from couch_management.models import FeatureStatus, Sofa
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_sofas(sofas):
+    """
+    Queue sofas for (re)extraction of their image features.
+
+    Args:
+        sofas (QuerySet): The sofas to queue.
+
+    Returns:
+        int: The number of queued sofas.
+    """
+    return sofas.update(
+        features_status=FeatureStatus.PENDING,
+        features_attempts=0,
+        features_error='',
+        features_next_attempt_at=None,
+        features_claimed_at=None,
+    )
+
+
+def release_stale_claims():
+    """
+    Put jobs back in the queue whose worker stopped before finishing them.
+
+    Returns:
+        int: The number of released jobs.
+    """
+    stale_before = timezone.now() - timedelta(seconds=settings.FEATURE_CLAIM_TIMEOUT)
+    return Sofa.objects.filter(
+        features_status=FeatureStatus.PROCESSING,
+        features_claimed_at__lt=stale_before,
+    ).update(features_status=FeatureStatus.PENDING, features_claimed_at=None)
+
+
+def claim_sofas(limit):
+    """
+    Atomically take up to `limit` due jobs off the queue.
+
+    Rows locked by another worker are skipped, so concurrent workers never claim the same sofa.
+
+    Args:
+        limit (int): Maximum number of sofas to claim.
+
+    Returns:
+        list: The claimed Sofa instances.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            Sofa.objects.select_for_update(skip_locked=True)
+            .filter(features_status=FeatureStatus.PENDING)
+            .filter(Q(features_next_attempt_at__isnull=True) | Q(features_next_attempt_at__lte=now))
+            .order_by('id')
+            .values_list('id', flat=True)[:limit]
+        )
+        Sofa.objects.filter(id__in=ids).update(features_status=FeatureStatus.PROCESSING, features_claimed_at=now)
+    return list(Sofa.objects.filter(id__in=ids).order_by('id'))
+
+
+def claim_for_reprocessing(sofa_ids):
+    """
+    Atomically claim sofas with extracted features for reprocessing.
+
+    Sofas that are queued, being processed or locked by another worker are
+    skipped. Claimed sofas are released again after FEATURE_CLAIM_TIMEOUT if
+    the caller stops before finishing them.
+
+    Args:
+        sofa_ids (list): Primary keys of the sofas to claim.
+
+    Returns:
+        list: The primary keys of the claimed sofas.
+    """
+    with transaction.atomic():
+        ids = list(
+            Sofa.objects.select_for_update(skip_locked=True)
+            .filter(id__in=sofa_ids, features_status=FeatureStatus.DONE)
+            .values_list('id', flat=True)
+        )
+        Sofa.objects.filter(id__in=ids).update(
+            features_status=FeatureStatus.PROCESSING, features_claimed_at=timezone.now(),
+        )
+    return ids
+
+
+def reprocess_sofas(sofa_ids, batch_size=None):
+    """
+    Claim sofas and extract their features again, e.g. in a pool worker process.
+
+    Args:
+        sofa_ids (list): Primary keys of the sofas to reprocess.
+        batch_size (int): Number of images per classifier forward pass.
+
+    Returns:
+        tuple: The number of succeeded and failed sofas, and the seconds spent.
+    """
+    close_old_connections()
+    return extract_features_for_ids(claim_for_reprocessing(sofa_ids), batch_size)
+
+
+def record_failure(sofa, error):
+    """
+    Record a failed attempt, scheduling a retry with exponential backoff or
+    marking the job as failed once settings.FEATURE_MAX_ATTEMPTS is reached.
+
+    Args:
+        sofa (Sofa): The sofa whose feature extraction failed.
+        error (Exception | str): The failure.
+    """
+    attempts = sofa.features_attempts + 1
+    if attempts >= settings.FEATURE_MAX_ATTEMPTS:
+        status, next_attempt_at = FeatureStatus.FAILED, None
+    else:
+        delay = settings.FEATURE_RETRY_BACKOFF * 2 ** (attempts - 1)
+        status, next_attempt_at = FeatureStatus.PENDING, timezone.now() + timedelta(seconds=delay)
+
+    Sofa.objects.filter(pk=sofa.pk).update(
+        features_status=status,
+        features_attempts=F('features_attempts') + 1,
+        features_error=str(error),
+        features_next_attempt_at=next_attempt_at,
+        features_claimed_at=None,
+    )
+    logger.warning("Feature extraction failed for sofa %s (attempt %s): %s", sofa.pk, attempts, error)
+
+
+def process_sofas(sofas, batch_size=None):
+    """
+    Extract features for claimed sofas and record the outcome of each job.
+
+    The batch is processed with batched inference. If it fails, each sofa is retried
+    on its own so one bad image does not fail the others.
+
+    Args:
+        sofas (list): The claimed Sofa instances.
+        batch_size (int): Number of images per classifier forward pass.
+
+    Returns:
+        int: The number of sofas processed successfully.
+    """
+    failed = set()
+    try:
+        done = set(generate_sofa_features(sofas, batch_size=batch_size))
+    except Exception:
+        done = set()
+        for sofa in sofas:
+            try:
+                done.update(generate_sofa_features([sofa]))
+            except Exception as e:
+                record_failure(sofa, e)
+                failed.add(sofa.pk)
+
+    for sofa in sofas:
+        if sofa.pk not in done and sofa.pk not in failed:
+            error = f"Image file '{sofa.image.name}' not found." if sofa.image else "Sofa has no image."
+            record_failure(sofa, error)
+    return len(done)
+
+
+def run_worker(batch_size, poll_interval, once=False):
+    """
+    Process queued feature extraction jobs until interrupted.
+
+    Args:
+        batch_size (int): Number of sofas claimed and classified together.
+        poll_interval (float): Seconds to wait when the queue is empty.
+        once (bool): Stop as soon as the queue is empty.
+    """
+    connections.close_all()
+    logger.info("Feature worker %s started", os.getpid())
+    try:
+        while True:
+            close_old_connections()
+            release_stale_claims()
+            sofas = claim_sofas(batch_size)
+            if sofas:
+                process_sofas(sofas, batch_size=batch_size)
+            elif once:
+                break
+            else:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connections.close_all()
+        logger.info("Feature worker %s stopped", os.getpid())
+
+
+def extract_features_for_ids(sofa_ids, batch_size=None):
+    """
+    Extract features for the given sofas in a pool worker process.
+
+    Args:
+        sofa_ids (list): Primary keys of sofas claimed by the caller.
+        batch_size (int): Number of images per classifier forward pass.
+
+    Returns:
+        tuple: The number of succeeded and failed sofas, and the seconds spent.
+    """
+    start = time.perf_counter()
+    close_old_connections()
+    sofas = list(Sofa.objects.filter(id__in=sofa_ids).order_by('id'))
+    succeeded = process_sofas(sofas, batch_size=batch_size)
+    return succeeded, len(sofas) - succeeded, time.perf_counter() - start
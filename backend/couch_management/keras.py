@@ -1,10 +1,27 @@
+import functools
+import hashlib
+import importlib.util
+import json
+import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import numpy as np
 from django.conf import settings
 from PIL import Image, ImageOps
 
-from keras.models import load_model
+from couch_management.batching import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SIZE = (224, 224)
+
+INFERENCE_BACKENDS = ('auto', 'onnx', 'tflite', 'keras')
+
+# Output names of the models written by `manage.py export_inference_model`.
+SCORES_OUTPUT = 'scores'
+EMBEDDING_OUTPUT = 'embedding'
 
 
 def load_keras_model(model_path):
@@ -17,42 +34,524 @@ def load_keras_model(model_path):
     Returns:
         model: The loaded Keras model.
     """
+    from keras.models import load_model
+
     model = load_model(model_path, compile=False)
     return model
 
-def predict_image_class(image_path):
+
+def build_embedding_model(model):
     """
-    Predict the class of the input image using the trained Keras model.
+    Build a model that returns both the class scores and the penultimate-layer embedding.
+
+    The classifier is a feature extractor followed by a small dense head (the
+    layout exported by Teachable Machine). The embedding is the output of the
+    head's last hidden layer, so both outputs come from a single forward pass.
 
     Args:
-        image_path (str): Path to the image you want to predict.
+        model: The loaded Keras classifier.
 
     Returns:
-        str: The predicted class name.
-        float: The confidence score of the prediction.
+        Model: A Keras model with outputs [class scores, embedding].
     """
-    model_path = os.path.join(settings.BASE_DIR, 'couch_management/keras_model.h5')
-    labels_path = os.path.join(settings.BASE_DIR, 'couch_management/labels.txt')
+    from keras.layers import Input
+    from keras.models import Model
+
+    inputs = Input(shape=(*IMAGE_SIZE, 3))
+    embedding = model.layers[0](inputs)
+    head = model.layers[-1]
+    for layer in head.layers[:-1]:
+        embedding = layer(embedding)
+    outputs = head.layers[-1](embedding)
+    return Model(inputs, [outputs, embedding])
+
+
+class KerasBackend:
+    """
+    Runs the original Keras model with TensorFlow.
+    """
+    name = 'keras'
+
+    def __init__(self, model_path):
+        self.model = load_keras_model(model_path)
+        self._embedding_model = None
+        self._lock = threading.Lock()
+
+    def predict(self, data, return_embeddings=False):
+        """
+        Run the classifier on a preprocessed batch.
+
+        Args:
+            data (np.ndarray): A float32 array of shape (N, 224, 224, 3) scaled to [-1, 1].
+            return_embeddings (bool): Also return the image embeddings.
+
+        Returns:
+            np.ndarray: The softmax output of shape (N, number of classes), and
+            only if return_embeddings is set, the float32 embeddings of shape (N, embedding size).
+        """
+        if not return_embeddings:
+            return self.model.predict(data, verbose=0)
+
+        if self._embedding_model is None:
+            with self._lock:
+                if self._embedding_model is None:
+                    self._embedding_model = build_embedding_model(self.model)
+        prediction, embeddings = self._embedding_model.predict(data, verbose=0)
+        return prediction, embeddings.astype(np.float32)
 
-    model = load_keras_model(model_path)
 
+class OnnxBackend:
+    """
+    Runs the exported ONNX model with onnxruntime, without importing TensorFlow.
+    """
+    name = 'onnx'
+
+    def __init__(self, model_path, threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=onnxruntime.get_available_providers(),
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, data, return_embeddings=False):
+        if not return_embeddings:
+            return self.session.run([SCORES_OUTPUT], {self.input_name: data})[0]
+        prediction, embeddings = self.session.run([SCORES_OUTPUT, EMBEDDING_OUTPUT], {self.input_name: data})
+        return prediction, embeddings.astype(np.float32)
+
+
+class TFLiteBackend:
+    """
+    Runs the exported TFLite model with tflite_runtime, or with TensorFlow's
+    interpreter if tflite_runtime is not installed.
+
+    An interpreter is not thread-safe, so calls are serialized.
+    """
+    name = 'tflite'
+
+    def __init__(self, model_path, threads=0):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=model_path, num_threads=threads or None)
+        self.runner = self.interpreter.get_signature_runner()
+        self.input_name = next(iter(self.runner.get_input_details()))
+        self._lock = threading.Lock()
+
+    def predict(self, data, return_embeddings=False):
+        with self._lock:
+            outputs = self.runner(**{self.input_name: data})
+        if not return_embeddings:
+            return outputs[SCORES_OUTPUT]
+        return outputs[SCORES_OUTPUT], outputs[EMBEDDING_OUTPUT].astype(np.float32)
+
+
+@functools.lru_cache(maxsize=32)
+def _file_digest(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """
+    Return the SHA-256 hex digest of a file, computed again only when the file changes.
+    """
+    stat = os.stat(path)
+    return _file_digest(path, stat.st_mtime_ns, stat.st_size)
+
+
+def export_metadata_path(model_path):
+    """
+    Return the path of the metadata that `manage.py export_inference_model` writes next to an exported model.
+    """
+    return f'{model_path}.json'
+
+
+def is_current_export(model_path):
+    """
+    Check whether an exported model was exported from the current Keras model and passed the parity checks.
+
+    The export command writes the SHA-256 of the source .h5 file into the
+    metadata only once the exported model has passed, so a stale export, a
+    failed one or a model copied in by hand does not qualify.
+
+    Args:
+        model_path (str): The path of the exported model.
+
+    Returns:
+        bool: Whether the model and its metadata exist and the metadata names the current Keras model.
+    """
+    try:
+        with open(export_metadata_path(model_path)) as file:
+            metadata = json.load(file)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(model_path) and metadata.get('source_digest') == file_digest(settings.KERAS_MODEL_PATH)
+
+
+def resolve_inference_backend(name):
+    """
+    Resolve the "auto" inference backend to the fastest one available.
+
+    "auto" picks ONNX if the current Keras model was exported to ONNX and
+    onnxruntime is installed, then TFLite if it was exported to TFLite and
+    tflite_runtime is installed, and Keras otherwise. The catalog embeddings
+    were computed by one of these models, so an export of another Keras
+    model is never picked. Neither check imports TensorFlow.
+
+    Args:
+        name (str): One of INFERENCE_BACKENDS.
+
+    Returns:
+        str: "onnx", "tflite" or "keras".
+    """
+    if name not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend {name!r}, expected one of {', '.join(INFERENCE_BACKENDS)}.")
+    if name != 'auto':
+        return name
+    if is_current_export(settings.ONNX_MODEL_PATH) and importlib.util.find_spec('onnxruntime'):
+        return 'onnx'
+    if is_current_export(settings.TFLITE_MODEL_PATH) and importlib.util.find_spec('tflite_runtime'):
+        return 'tflite'
+    return 'keras'
+
+
+def load_inference_backend(name):
+    """
+    Load the classifier with an inference backend.
+
+    Args:
+        name (str): One of INFERENCE_BACKENDS.
+
+    Returns:
+        KerasBackend | OnnxBackend | TFLiteBackend: The loaded backend.
+    """
+    name = resolve_inference_backend(name)
+    if name != 'keras':
+        model_path = settings.ONNX_MODEL_PATH if name == 'onnx' else settings.TFLITE_MODEL_PATH
+        if not is_current_export(model_path):
+            logger.warning(
+                "%s was not exported from %s by export_inference_model; its predictions and embeddings "
+                "may not match the catalog", model_path, settings.KERAS_MODEL_PATH,
+            )
+    if name == 'onnx':
+        return OnnxBackend(settings.ONNX_MODEL_PATH, threads=settings.INFERENCE_THREADS)
+    if name == 'tflite':
+        return TFLiteBackend(settings.TFLITE_MODEL_PATH, threads=settings.INFERENCE_THREADS)
+    return KerasBackend(settings.KERAS_MODEL_PATH)
+
+
+def load_labels(labels_path):
+    """
+    Load the class labels that belong to the Keras model.
+
+    Args:
+        labels_path (str): The path to the labels file, one "<index> <name>" per line.
+
+    Returns:
+        list: The class names ordered by model output index.
+    """
     with open(labels_path, "r") as f:
-        sofa_types = [line.strip().split(" ", 1)[1] for line in f.readlines()]
+        return [line.strip().split(" ", 1)[1] for line in f.readlines() if line.strip()]
+
+
+class ModelRegistry:
+    """
+    Holds the classifier and its labels for the lifetime of the process.
 
-    image = Image.open(image_path).convert("RGB")
-    size = (224, 224)
-    image = ImageOps.fit(image, size, Image.Resampling.LANCZOS)
-    image_array = np.asarray(image)
-    normalized_image_array = (image_array.astype(np.float32) / 127.5) - 1
+    The model is loaded with the configured inference backend on first use (or
+    eagerly via `warm_up`) and then shared by every request thread, so only the
+    first caller pays the load cost.
+    """
+
+    def __init__(self, labels_path, backend_name='auto'):
+        self.labels_path = labels_path
+        self.backend_name = backend_name
+        self._backend = None
+        self._labels = None
+        self._warmed_up = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the model and labels if they have not been loaded yet.
+
+        Returns:
+            tuple: The inference backend and the list of class names.
+        """
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    labels = load_labels(self.labels_path)
+                    backend = load_inference_backend(self.backend_name)
+                    logger.info("Loaded the classifier with the %s backend", backend.name)
+                    self._labels = labels
+                    self._backend = backend
+        return self._backend, self._labels
+
+    @property
+    def backend(self):
+        return self.load()[0]
+
+    @property
+    def labels(self):
+        return self.load()[1]
+
+    def predict(self, data):
+        """
+        Run the classifier on a preprocessed batch.
+
+        Args:
+            data (np.ndarray): A float32 array of shape (N, 224, 224, 3) scaled to [-1, 1].
+
+        Returns:
+            np.ndarray: The softmax output of shape (N, number of classes).
+        """
+        prediction = self.backend.predict(data)
+        self._warmed_up = True
+        return prediction
+
+    def predict_with_embeddings(self, data):
+        """
+        Run the classifier on a preprocessed batch and also return the image embeddings.
+
+        Args:
+            data (np.ndarray): A float32 array of shape (N, 224, 224, 3) scaled to [-1, 1].
+
+        Returns:
+            tuple: The softmax output of shape (N, number of classes) and the
+            float32 embeddings of shape (N, embedding size).
+        """
+        prediction, embeddings = self.backend.predict(data, return_embeddings=True)
+        self._warmed_up = True
+        return prediction, embeddings
+
+    def warm_up(self):
+        """
+        Load the model and run one dummy inference so graph tracing and
+        allocator setup happen before the first real request.
+        """
+        if not self._warmed_up:
+            self.predict(np.zeros((1, *IMAGE_SIZE, 3), dtype=np.float32))
+
+    @property
+    def is_ready(self):
+        """
+        bool: Whether the model is loaded and has served at least one inference.
+        """
+        return self._backend is not None and self._warmed_up
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry():
+    """
+    Return the process-wide model registry, creating it on first access.
+
+    Returns:
+        ModelRegistry: The shared registry.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry(settings.KERAS_LABELS_PATH, settings.INFERENCE_BACKEND)
+    return _registry
+
+
+def is_model_ready():
+    """
+    Check whether the classifier is loaded and warmed up in this process.
+
+    Returns:
+        bool: True if requests will not pay the model load cost.
+    """
+    return _registry is not None and _registry.is_ready
+
+
+def _predict_batch(items):
+    # One forward pass for the whole batch: the embedding head only runs if any caller asked for embeddings.
+    registry = get_model_registry()
+    data = np.stack([image for image, _ in items])
+    if any(return_embedding for _, return_embedding in items):
+        prediction, embeddings = registry.predict_with_embeddings(data)
+    else:
+        prediction, embeddings = registry.predict(data), [None] * len(items)
+    return [
+        (scores, embedding if return_embedding else None)
+        for (_, return_embedding), scores, embedding in zip(items, prediction, embeddings)
+    ]
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_inference_batcher():
+    """
+    Return the process-wide classifier micro-batcher, creating it on first access.
+
+    Returns:
+        MicroBatcher: Runs (preprocessed image, return embedding) inputs of concurrent requests through
+        one forward pass, resolving to a (class scores, embedding or None) pair per input.
+    """
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(
+                    'classifier', _predict_batch,
+                    max_batch_size=settings.INFERENCE_BATCH_MAX_SIZE,
+                    max_wait=settings.INFERENCE_BATCH_MAX_WAIT_MS / 1000,
+                )
+    return _batcher
+
+
+def predict_micro_batched(data, return_embeddings=False):
+    """
+    Classify a query image together with the images of concurrent requests.
+
+    If the batch does not complete within INFERENCE_BATCH_TIMEOUT_MS, because the
+    batcher is backed up or its thread is stuck, the images are cancelled and
+    classified directly instead.
+
+    Args:
+        data (np.ndarray): A float32 array of shape (N, 224, 224, 3) scaled to [-1, 1].
+        return_embeddings (bool): Also compute the embeddings.
+
+    Returns:
+        tuple: The softmax output of shape (N, number of classes) and, only if
+        return_embeddings is set, the float32 embeddings of shape (N, embedding size), otherwise None.
+    """
+    batcher = get_inference_batcher()
+    futures = [batcher.submit((image, return_embeddings)) for image in data]
+    done, not_done = wait(futures, timeout=settings.INFERENCE_BATCH_TIMEOUT_MS / 1000)
+    if not_done:
+        for future in futures:
+            future.cancel()
+        logger.warning("Micro-batched inference timed out, classifying %d image(s) directly", len(data))
+        registry = get_model_registry()
+        if return_embeddings:
+            return registry.predict_with_embeddings(data)
+        return registry.predict(data), None
+
+    results = [future.result() for future in futures]
+    prediction = np.stack([scores for scores, _ in results])
+    if return_embeddings:
+        return prediction, np.stack([embedding for _, embedding in results])
+    return prediction, None
+
+
+def preprocess_image(image):
+    """
+    Resize and normalize an image into the classifier's input format.
+
+    Args:
+        image (str | np.ndarray): Path to an image file, or an RGB/RGBA uint8 array.
+
+    Returns:
+        np.ndarray: A float32 array of shape (224, 224, 3) scaled to [-1, 1].
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    else:
+        image = Image.open(image)
+    image = ImageOps.fit(image.convert("RGB"), IMAGE_SIZE, Image.Resampling.LANCZOS)
+    return (np.asarray(image, dtype=np.float32) / 127.5) - 1
+
+
+def predict_image_classes(images, batch_size=None, return_embeddings=False, micro_batch=False):
+    """
+    Predict the class of many images with batched forward passes.
+
+    Images are decoded and resized in a thread pool, stacked into one contiguous
+    float32 array per batch and classified with a single `predict` call. With
+    INFERENCE_BATCHING enabled, the single query image of a match request
+    (`micro_batch`) shares its forward pass with concurrent requests instead.
+
+    Args:
+        images (iterable): Image paths and/or RGB(A) uint8 arrays.
+        batch_size (int): Number of images per forward pass. Defaults to settings.KERAS_BATCH_SIZE.
+        return_embeddings (bool): Also return the penultimate-layer embedding of each image.
+        micro_batch (bool): The images are query images that may be micro-batched. Only
+            a single image is; larger inputs are already batched.
+
+    Returns:
+        list: A (class name, confidence score) tuple for each input image, in input order.
+        np.ndarray: Only if return_embeddings is set, the (N, embedding size) float32 embeddings.
+    """
+    images = list(images)
+    batch_size = batch_size or settings.KERAS_BATCH_SIZE
+    registry = get_model_registry()
+    sofa_types = registry.labels
+
+    micro_batch = micro_batch and settings.INFERENCE_BATCHING and len(images) == 1
+
+    results = []
+    embeddings = []
+    workers = min(settings.KERAS_PREPROCESS_WORKERS, len(images))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            data = np.empty((len(chunk), *IMAGE_SIZE, 3), dtype=np.float32)
+            for i, image_array in enumerate(executor.map(preprocess_image, chunk)):
+                data[i] = image_array
+
+            if micro_batch:
+                prediction, batch_embeddings = predict_micro_batched(data, return_embeddings)
+            elif return_embeddings:
+                prediction, batch_embeddings = registry.predict_with_embeddings(data)
+            else:
+                prediction, batch_embeddings = registry.predict(data), None
+            if return_embeddings:
+                embeddings.append(batch_embeddings)
+            indices = np.argmax(prediction, axis=1)
+            results.extend(
+                (sofa_types[index].strip(), prediction[row][index])
+                for row, index in enumerate(indices)
+            )
+
+    if return_embeddings:
+        return results, np.concatenate(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+    return results
+
+
+def predict_image_class(image_path):
+    """
+    Predict the class of the input image using the trained Keras model.
+
+    Args:
+        image_path (str | np.ndarray): Path to the image you want to predict, or an RGB(A) array.
+
+    Returns:
+        str: The predicted class name.
+        float: The confidence score of the prediction.
+    """
+    registry = get_model_registry()
+    sofa_types = registry.labels
 
-    data = np.ndarray(shape=(1, 224, 224, 3), dtype=np.float32)
-    data[0] = normalized_image_array
+    data = preprocess_image(image_path)[np.newaxis]
 
-    prediction = model.predict(data)
+    if settings.INFERENCE_BATCHING:
+        prediction, _ = predict_micro_batched(data)
+    else:
+        prediction = registry.predict(data)
     index = np.argmax(prediction)
     sofa_type = sofa_types[index].strip()
     confidence_score = prediction[0][index]
 
-    print(f"Predicted Type: {sofa_type}, Confidence: {confidence_score}")
+    logger.debug("Predicted type: %s, confidence: %s", sofa_type, confidence_score)
 
     return sofa_type, confidence_score
@@ -0,0 +1,50 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stands in for a heavy module and imports it on first attribute access.
+
+    Management commands, migrations and admin-only processes that never touch
+    the ML stack then never pay for importing it.
+    """
+
+    def __init__(self, name, on_import=None):
+        self._name = name
+        self._on_import = on_import
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            # The import system serializes concurrent imports of the same module.
+            module = importlib.import_module(self._name)
+            if self._on_import is not None:
+                self._on_import(module)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<LazyModule {self._name!r} ({state})>'
+
+
+def lazy_import(name, on_import=None):
+    """
+    Return a module that is only imported when one of its attributes is first used.
+
+    Usage:
+        rembg = lazy_import('rembg')
+        ...
+        rembg.remove(image)  # rembg is imported here
+
+    Args:
+        name (str): The absolute module name.
+        on_import (callable): Called with the module once it is imported, e.g. to configure it.
+
+    Returns:
+        LazyModule: The lazy module.
+    """
+    return LazyModule(name, on_import)
@@ -0,0 +1,90 @@
+import json
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from couch_management.utils import get_color_palette, load_rgb_image
+
+
+def reference_dominant_color(image, k=3):
+    """
+    The original dominant color implementation: k-means with 10 random restarts over every foreground pixel.
+    """
+    if image.shape[2] == 4:
+        rgb_image, mask = image[:, :, :3], image[:, :, 3] > 0
+    else:
+        rgb_image = image
+        mask = np.all(rgb_image != [255, 255, 255], axis=-1)
+
+    sofa_pixels = np.float32(rgb_image[mask])
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
+    _, labels, palette = cv2.kmeans(sofa_pixels, k, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+    _, counts = np.unique(labels, return_counts=True)
+    return tuple(map(int, palette[np.argmax(counts)]))
+
+
+class Command(BaseCommand):
+    help = 'Compares the speed and color agreement of the dominant color extractors against the original implementation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'images', nargs='*',
+            help='Image files to benchmark. Defaults to the catalog images in MEDIA_ROOT/sofa_images.',
+        )
+        parser.add_argument('--limit', type=int, default=5, help='Maximum number of images to use.')
+        parser.add_argument('--max-pixels', type=int, default=None, help='Pixel sampling budget for the new extractors.')
+        parser.add_argument('--threshold', type=float, default=20, help='RGB distance counted as agreement.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **kwargs):
+        paths = kwargs['images'] or sorted(str(path) for path in Path(settings.MEDIA_ROOT, 'sofa_images').glob('*.jpg'))
+        paths = paths[:kwargs['limit']]
+        if not paths:
+            self.stdout.write(self.style.ERROR('No images found.'))
+            return
+
+        images = [load_rgb_image(path) for path in paths]
+        extractors = {
+            'reference': reference_dominant_color,
+            'histogram': lambda image: get_color_palette(image, method='histogram', max_pixels=kwargs['max_pixels'])[0][0],
+            'kmeans': lambda image: get_color_palette(image, method='kmeans', max_pixels=kwargs['max_pixels'])[0][0],
+        }
+
+        colors = {}
+        results = {}
+        for name, extractor in extractors.items():
+            timings = []
+            colors[name] = []
+            for image in images:
+                start = time.perf_counter()
+                colors[name].append(extractor(image))
+                timings.append(time.perf_counter() - start)
+            results[name] = {
+                'mean_ms': 1000 * float(np.mean(timings)),
+                'p95_ms': 1000 * float(np.percentile(timings, 95)),
+            }
+
+        reference = np.array(colors['reference'], dtype=np.float64)
+        for name in extractors:
+            distances = np.linalg.norm(np.array(colors[name], dtype=np.float64) - reference, axis=1)
+            results[name].update({
+                'mean_distance': float(distances.mean()),
+                'max_distance': float(distances.max()),
+                'agreement': float((distances <= kwargs['threshold']).mean()),
+            })
+
+        if kwargs['json']:
+            self.stdout.write(json.dumps({'images': len(images), 'results': results}, indent=2))
+            return
+
+        self.stdout.write(f'{len(images)} images, agreement threshold {kwargs["threshold"]}')
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:>10}: {result["mean_ms"]:8.1f} ms mean, {result["p95_ms"]:8.1f} ms p95, '
+                f'distance to reference {result["mean_distance"]:6.1f} mean / {result["max_distance"]:6.1f} max, '
+                f'agreement {100 * result["agreement"]:5.1f}%'
+            )
@@ -0,0 +1,75 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from couch_management.embeddings import EmbeddingIndex, normalize_embeddings
+
+
+def synthetic_embeddings(count, dimension, clusters, seed=0):
+    """
+    Generate clustered unit vectors that resemble image embeddings of a catalog.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension))
+    members = rng.integers(0, clusters, size=count)
+    return normalize_embeddings(centers[members] + 0.5 * rng.normal(size=(count, dimension)))
+
+
+class Command(BaseCommand):
+    help = 'Measures recall and latency of the approximate embedding index against exact search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000', help='Comma-separated catalog sizes.')
+        parser.add_argument('--dimension', type=int, default=100, help='Embedding size.')
+        parser.add_argument('--queries', type=int, default=200, help='Number of queries per catalog size.')
+        parser.add_argument('--limit', type=int, default=10, help='Number of neighbours per query (k).')
+        parser.add_argument('--nprobe', default='1,4,8,16,32', help='Comma-separated nprobe values.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **kwargs):
+        limit = kwargs['limit']
+        results = []
+
+        for size in [int(value) for value in kwargs['sizes'].split(',')]:
+            vectors = synthetic_embeddings(size + kwargs['queries'], kwargs['dimension'], clusters=max(size // 50, 1))
+            catalog, queries = vectors[:size], vectors[size:]
+
+            # A standalone index: it is never reloaded from the database in the middle of a measurement.
+            index = EmbeddingIndex(from_database=False)
+            build_started = time.perf_counter()
+            index.load(np.arange(size, dtype=np.int64), catalog, np.zeros(size))
+            build_seconds = time.perf_counter() - build_started
+
+            exact_results, exact_seconds = self.run_queries(index, queries, limit, exact=True)
+            results.append({
+                'size': size, 'nprobe': 'exact', 'build_s': build_seconds,
+                'latency_ms': 1000 * exact_seconds / len(queries), 'recall': 1.0,
+            })
+
+            for nprobe in [int(value) for value in kwargs['nprobe'].split(',')]:
+                approximate_results, seconds = self.run_queries(index, queries, limit, nprobe=nprobe)
+                recall = np.mean([
+                    len(set(exact) & set(approximate)) / max(len(exact), 1)
+                    for exact, approximate in zip(exact_results, approximate_results)
+                ])
+                results.append({
+                    'size': size, 'nprobe': nprobe, 'build_s': build_seconds,
+                    'latency_ms': 1000 * seconds / len(queries), 'recall': float(recall),
+                })
+
+        if kwargs['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f'{"size":>8} {"nprobe":>7} {"latency ms":>11} {"recall@" + str(limit):>10}')
+        for result in results:
+            self.stdout.write(
+                f'{result["size"]:>8} {result["nprobe"]:>7} {result["latency_ms"]:>11.3f} {result["recall"]:>10.3f}'
+            )
+
+    def run_queries(self, index, queries, limit, **kwargs):
+        started = time.perf_counter()
+        matches = [[sofa_id for sofa_id, _ in index.search(query, limit=limit, **kwargs)] for query in queries]
+        return matches, time.perf_counter() - started
@@ -0,0 +1,82 @@
+import json
+import platform
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from couch_management.benchmarks import (benchmark_catalog_stages,
+                                         benchmark_image_stages,
+                                         compare_results)
+
+
+class Command(BaseCommand):
+    help = 'Times every stage of the matching pipeline on synthetic images and catalogs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000', help='Comma-separated synthetic catalog sizes.')
+        parser.add_argument('--image-size', type=int, default=1024, help='Width and height of the synthetic image.')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per stage.')
+        parser.add_argument(
+            '--stages', default='',
+            help='Comma-separated stage name prefixes to run, e.g. "decode,similarity_loop". Defaults to all stages.',
+        )
+        parser.add_argument('--output', help='Write the results as JSON to this file, e.g. to save a baseline.')
+        parser.add_argument('--baseline', help='Compare with the results saved in this JSON file.')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown reported as a regression.')
+        parser.add_argument('--fail-on-regression', action='store_true', help='Exit with an error if a stage regressed.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+
+    def handle(self, *args, **kwargs):
+        prefixes = [prefix.strip() for prefix in kwargs['stages'].split(',') if prefix.strip()]
+
+        def selected(name):
+            return not prefixes or any(name.startswith(prefix) for prefix in prefixes)
+
+        sizes = [int(size) for size in kwargs['sizes'].split(',')]
+        stages = benchmark_image_stages(kwargs['image_size'], kwargs['repeat'], selected)
+        for size in sizes:
+            stages.update(benchmark_catalog_stages(size, kwargs['repeat'], selected))
+
+        report = {
+            'meta': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'image_size': kwargs['image_size'],
+                'sizes': sizes,
+                'repeat': kwargs['repeat'],
+            },
+            'stages': stages,
+        }
+        if kwargs['baseline']:
+            baseline = json.loads(Path(kwargs['baseline']).read_text())
+            report['comparison'] = compare_results(stages, baseline['stages'], kwargs['tolerance'])
+
+        if kwargs['output']:
+            Path(kwargs['output']).write_text(json.dumps(report, indent=2))
+
+        if kwargs['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_table(report)
+
+        regressions = [name for name, result in report.get('comparison', {}).items() if result['verdict'] == 'regression']
+        if regressions and kwargs['fail_on_regression']:
+            raise CommandError(f'Regressions in: {", ".join(regressions)}')
+
+    def write_table(self, report):
+        comparison = report.get('comparison', {})
+        for name, result in report['stages'].items():
+            if 'error' in result:
+                self.stdout.write(f'{name:>32}: {self.style.WARNING(result["error"])}')
+                continue
+
+            line = f'{name:>32}: {result["median_ms"]:10.3f} ms median, {result["p95_ms"]:10.3f} ms p95'
+            if name in comparison:
+                change = comparison[name]
+                text = f' ({change["ratio"]:.2f}x baseline, {change["verdict"]})'
+                if change['verdict'] == 'regression':
+                    text = self.style.ERROR(text)
+                elif change['verdict'] == 'improvement':
+                    text = self.style.SUCCESS(text)
+                line += text
+            self.stdout.write(line)
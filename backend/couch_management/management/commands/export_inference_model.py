@@ -0,0 +1,116 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from couch_management.keras import (KerasBackend, OnnxBackend, TFLiteBackend,
+                                    export_metadata_path, load_labels)
+from couch_management.model_export import (build_export_model,
+                                           catalog_images, check_parity,
+                                           export_onnx, export_tflite,
+                                           preprocess_cutouts,
+                                           write_export_metadata)
+
+EXPORTERS = {
+    'onnx': (export_onnx, OnnxBackend, 'ONNX_MODEL_PATH'),
+    'tflite': (export_tflite, TFLiteBackend, 'TFLITE_MODEL_PATH'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Exports the classifier to ONNX and/or TFLite and checks that the exported model agrees with Keras'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', action='append', choices=sorted(EXPORTERS), dest='formats',
+            help='Format to export, repeatable (default: onnx and tflite).',
+        )
+        parser.add_argument(
+            '--int8', action='store_true',
+            help='Apply int8 post-training quantization, calibrated on the cutouts of catalog images.',
+        )
+        parser.add_argument(
+            '--calibration-images', type=int, default=200,
+            help='Number of catalog images used to calibrate int8 quantization.',
+        )
+        parser.add_argument(
+            '--parity-images', type=int, default=200,
+            help='Number of catalog images on whose background-removed cutouts the exported model is compared '
+                 'with Keras.',
+        )
+        parser.add_argument(
+            '--min-agreement', type=float, default=0.98,
+            help='Minimum share of images whose predicted class must agree with Keras.',
+        )
+        parser.add_argument(
+            '--min-embedding-cosine', type=float, default=0.99,
+            help='Minimum mean cosine similarity of the embeddings to those of Keras, which the catalog '
+                 'embeddings were computed with.',
+        )
+
+    def handle(self, *args, **kwargs):
+        formats = kwargs['formats'] or sorted(EXPORTERS)
+
+        calibration = None
+        if kwargs['int8']:
+            images = catalog_images(kwargs['calibration_images'])
+            if not images:
+                raise CommandError('int8 quantization needs catalog images to calibrate on, but none were found.')
+            calibration = preprocess_cutouts(images)
+            self.stdout.write(f'Calibrating on the cutouts of {len(calibration)} catalog images')
+
+        parity_images = catalog_images(kwargs['parity_images'])
+        if not parity_images:
+            raise CommandError('No catalog images found to check the exported model against Keras.')
+        self.stdout.write(f'Removing the backgrounds of {len(parity_images)} catalog images to check parity on')
+        parity_data = preprocess_cutouts(parity_images)
+
+        model = build_export_model(settings.KERAS_MODEL_PATH)
+        reference = KerasBackend(settings.KERAS_MODEL_PATH)
+        labels = load_labels(settings.KERAS_LABELS_PATH)
+        if model.outputs[0].shape[-1] != len(labels):
+            raise CommandError(f'The model has {model.outputs[0].shape[-1]} classes but there are {len(labels)} labels.')
+
+        failed = []
+        for name in formats:
+            exporter, backend_class, setting = EXPORTERS[name]
+            output_path = getattr(settings, setting)
+            # Until the new model passed its checks, INFERENCE_BACKEND=auto must not pick it up.
+            if os.path.exists(export_metadata_path(output_path)):
+                os.remove(export_metadata_path(output_path))
+
+            started = time.perf_counter()
+            try:
+                exporter(model, output_path, calibration=calibration)
+            except ImportError as e:
+                raise CommandError(f'Exporting to {name} requires {e.name}: pip install {e.name}') from e
+            self.stdout.write(
+                f'Exported {output_path} ({os.path.getsize(output_path) / 2 ** 20:.1f} MB) '
+                f'in {time.perf_counter() - started:.1f}s'
+            )
+
+            parity = check_parity(reference, backend_class(output_path), parity_data, settings.KERAS_BATCH_SIZE)
+            self.stdout.write(
+                f'{name}: predicted class agrees on {100 * parity["top1_agreement"]:.1f}% of {parity["images"]} images, '
+                f'max score difference {parity["max_score_difference"]:.4f}, '
+                f'mean embedding cosine {parity["mean_embedding_cosine"]:.4f}'
+            )
+            if (
+                parity['top1_agreement'] < kwargs['min_agreement']
+                or parity['mean_embedding_cosine'] < kwargs['min_embedding_cosine']
+            ):
+                os.remove(output_path)
+                failed.append(name)
+            else:
+                write_export_metadata(output_path, settings.KERAS_MODEL_PATH, kwargs['int8'], parity)
+
+        if failed:
+            raise CommandError(
+                f'{", ".join(failed)} agreed with Keras on fewer than {100 * kwargs["min_agreement"]:.0f}% of '
+                f'the images or had a mean embedding cosine below {kwargs["min_embedding_cosine"]} and '
+                f'{"was" if len(failed) == 1 else "were"} removed.'
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Exported models are used when INFERENCE_BACKEND is "auto" and their runtime is installed.'
+        ))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from couch_management.derivatives import generate_image_derivatives
+from couch_management.models import Sofa
+
+
+class Command(BaseCommand):
+    help = 'Generates the resized image derivatives of sofas that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Regenerate the derivatives of every sofa, e.g. after IMAGE_DERIVATIVES changed.',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=200,
+            help='Number of sofas read from the database at a time.',
+        )
+
+    def handle(self, *args, **kwargs):
+        sofas = Sofa.objects.exclude(image='').only('id', 'image', 'image_derivatives').order_by('id')
+        if not kwargs['all']:
+            sofas = sofas.filter(image_derivatives={})
+
+        started = time.perf_counter()
+        generated, failed = 0, 0
+        for sofa in sofas.iterator(chunk_size=kwargs['chunk_size']):
+            try:
+                generate_image_derivatives(sofa)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'Sofa {sofa.pk}: {e}')
+                continue
+
+            generated += 1
+            if generated % 100 == 0:
+                self.stdout.write(f'Generated derivatives for {generated} sofas')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated derivatives for {generated} sofas ({failed} failed) in {time.perf_counter() - started:.1f}s'
+        ))
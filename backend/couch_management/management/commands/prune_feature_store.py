@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from couch_management.feature_store import evict_features, pipeline_version
+from couch_management.models import ImageFeatures
+
+
+class Command(BaseCommand):
+    help = 'Deletes old feature store records and evicts the least recently used ones beyond the size bound'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-mb', type=int, default=settings.FEATURE_STORE_MAX_MB,
+            help='Size bound of the store in MB (default FEATURE_STORE_MAX_MB, 0 = unbounded).',
+        )
+        parser.add_argument(
+            '--stale', action='store_true',
+            help='Delete the records of other pipeline versions. They are otherwise kept to reuse their '
+                 'background removal masks.',
+        )
+        parser.add_argument(
+            '--unused-days', type=int, default=0,
+            help='Delete the records not used for this many days.',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted.')
+
+    def handle(self, *args, **kwargs):
+        dry_run = kwargs['dry_run']
+        before = ImageFeatures.objects.aggregate(records=Count('id'), size=Sum('size'))
+        self.stdout.write(f'The store holds {before["records"]} records ({(before["size"] or 0) / 2 ** 20:.1f} MB)')
+
+        if kwargs['stale']:
+            self.delete('of other pipeline versions', ImageFeatures.objects.exclude(pipeline_version=pipeline_version()), dry_run)
+        if kwargs['unused_days']:
+            unused_since = timezone.now() - timedelta(days=kwargs['unused_days'])
+            self.delete(f'unused for {kwargs["unused_days"]} days', ImageFeatures.objects.filter(last_used_at__lt=unused_since), dry_run)
+
+        evicted, freed = evict_features(kwargs['max_mb'] * 2 ** 20, dry_run=dry_run)
+        self.stdout.write(
+            f'{"Would evict" if dry_run else "Evicted"} {evicted} least recently used records ({freed / 2 ** 20:.1f} MB)'
+        )
+
+    def delete(self, reason, records, dry_run):
+        if dry_run:
+            count = records.count()
+        else:
+            count, _ = records.delete()
+        self.stdout.write(f'{"Would delete" if dry_run else "Deleted"} {count} records {reason}')
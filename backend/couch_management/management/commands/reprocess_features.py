@@ -0,0 +1,141 @@
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from couch_management.feature_store import pipeline_version
+from couch_management.jobs import reprocess_sofas
+from couch_management.match_cache import content_hash
+from couch_management.models import FeatureStatus, Sofa
+
+
+class Command(BaseCommand):
+    help = (
+        'Extracts the features of sofas again whose features come from an older feature pipeline version '
+        'or whose image changed'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=settings.FEATURE_WORKERS,
+            help='Number of worker processes.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.FEATURE_WORKER_BATCH_SIZE,
+            help='Number of images per classifier forward pass.',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=64,
+            help='Number of sofas claimed, processed and written with one bulk_update at a time.',
+        )
+        parser.add_argument(
+            '--verify-images', action='store_true',
+            help='Also hash the image files of up-to-date sofas to find images replaced on disk.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many sofas are stale and would be reprocessed.',
+        )
+
+    def handle(self, *args, **kwargs):
+        self.verbosity = kwargs['verbosity']
+        version = pipeline_version()
+        sofas = Sofa.objects.filter(features_status=FeatureStatus.DONE).exclude(image='')
+        outdated = sofas.exclude(features_version=version)
+
+        unstamped = outdated.filter(features_version='').count()
+        older = outdated.count() - unstamped
+        changed = self.changed_images(sofas.filter(features_version=version)) if kwargs['verify_images'] else []
+
+        self.stdout.write(
+            f'Pipeline version {version}: {older} sofas have features of an older version, '
+            f'{unstamped} have unversioned features'
+            + (f' and {len(changed)} have a changed image' if kwargs['verify_images'] else '')
+        )
+        if kwargs['dry_run']:
+            self.stdout.write(f'{older + unstamped + len(changed)} sofas would be reprocessed')
+            return
+
+        self.stats = {'done': 0, 'failed': 0, 'seconds': 0.0}
+        self.executor = None
+        self.pending = set()
+        if kwargs['workers'] > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=kwargs['workers'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+        self.max_pending = 2 * kwargs['workers']
+
+        started = time.perf_counter()
+        try:
+            for chunk in self.chunks(outdated, changed, kwargs['chunk_size']):
+                self.submit(chunk, kwargs['batch_size'])
+        finally:
+            self.collect(wait_for_all=True)
+            if self.executor is not None:
+                self.executor.shutdown()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Reprocessed {self.stats["done"]} sofas ({self.stats["failed"]} failed) in {elapsed:.1f}s'
+        ))
+
+    def changed_images(self, sofas):
+        """
+        Return the ids of sofas whose image file no longer matches the hash their features were extracted from.
+        """
+        changed = []
+        for sofa in sofas.only('id', 'image', 'image_hash').order_by('id').iterator(chunk_size=500):
+            try:
+                with sofa.image.open('rb') as image_file:
+                    digest = content_hash(image_file.read())
+            except FileNotFoundError:
+                continue
+            if digest != sofa.image_hash:
+                changed.append(sofa.pk)
+        return changed
+
+    def chunks(self, outdated, changed, chunk_size):
+        """
+        Yield the ids of stale sofas in chunks, reading outdated ones in id order.
+
+        Reprocessed sofas are stamped with the current version, so an interrupted
+        run picks up where it stopped when it is started again.
+        """
+        last_id = 0
+        while True:
+            ids = list(outdated.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            yield ids
+            last_id = ids[-1]
+
+        for start in range(0, len(changed), chunk_size):
+            yield changed[start:start + chunk_size]
+
+    def submit(self, sofa_ids, batch_size):
+        if self.executor is None:
+            self.record(*reprocess_sofas(sofa_ids, batch_size))
+            return
+        self.collect(wait_for_all=False)
+        self.pending.add(self.executor.submit(reprocess_sofas, sofa_ids, batch_size))
+
+    def collect(self, wait_for_all):
+        """
+        Collect finished chunks, waiting until fewer than max_pending are in flight (or none, if wait_for_all is set).
+        """
+        while self.pending and (wait_for_all or len(self.pending) >= self.max_pending):
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                self.record(*future.result())
+
+    def record(self, succeeded, failed, seconds):
+        self.stats['done'] += succeeded
+        self.stats['failed'] += failed
+        self.stats['seconds'] += seconds
+        if self.verbosity >= 1:
+            self.stdout.write(f'{self.stats["done"]} reprocessed, {self.stats["failed"]} failed')
@@ -0,0 +1,66 @@
+import multiprocessing
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+def start_worker(*args):
+    """
+    Entry point of a spawned worker process.
+
+    Workers are spawned rather than forked, so every process sets up Django and
+    its native thread pools (TensorFlow, onnxruntime, numba) from scratch.
+    """
+    django.setup()
+    from couch_management.jobs import run_worker
+    run_worker(*args)
+
+
+class Command(BaseCommand):
+    help = 'Runs a pool of worker processes that extract image features for queued sofas'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=settings.FEATURE_WORKERS,
+            help='Number of worker processes.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.FEATURE_WORKER_BATCH_SIZE,
+            help='Number of sofas each worker claims and classifies together.',
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=settings.FEATURE_WORKER_POLL_INTERVAL,
+            help='Seconds to wait when the queue is empty.',
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit when the queue is empty instead of waiting for new jobs.',
+        )
+
+    def handle(self, *args, **kwargs):
+        worker_args = (kwargs['batch_size'], kwargs['poll_interval'], kwargs['once'])
+
+        if kwargs['workers'] <= 1:
+            from couch_management.jobs import run_worker
+            self.stdout.write('Starting 1 feature worker')
+            run_worker(*worker_args)
+            return
+
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(target=start_worker, args=worker_args, name=f'feature-worker-{index}')
+            for index in range(kwargs['workers'])
+        ]
+        self.stdout.write(f'Starting {len(processes)} feature workers')
+        for process in processes:
+            process.start()
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
+
+        self.stdout.write(self.style.SUCCESS('Feature workers stopped'))
@@ -1,46 +1,284 @@
 import json
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 
-from django.core.files import File
+import django
+from django.core.files.base import ContentFile
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
 
-from couch_management.models import Sofa
+from couch_management.jobs import extract_features_for_ids, process_sofas
+from couch_management.metrics import record_span, span
+from couch_management.models import FeatureStatus, ImportCheckpoint, Sofa
+from couch_management.utils import calculate_original_price
+
+
+def iter_json_records(file, chunk_size=1 << 16):
+    """
+    Stream the records of a JSON array, or of a JSON Lines file, without loading the whole file.
+
+    Args:
+        file: A text file object.
+        chunk_size (int): Number of characters read at a time.
+
+    Yields:
+        dict: One record at a time.
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    in_array = buffer.startswith('[')
+    if in_array:
+        buffer = buffer[1:]
+    eof = False
+
+    while True:
+        buffer = buffer.lstrip()
+        if in_array and buffer.startswith(']'):
+            return
+        if in_array and buffer.startswith(','):
+            buffer = buffer[1:]
+            continue
+        if not buffer and eof:
+            if in_array:
+                raise json.JSONDecodeError('Unterminated JSON array', buffer, 0)
+            return
+
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more = file.read(chunk_size)
+            eof = not more
+            buffer += more
+            continue
+
+        yield record
+        buffer = buffer[end:]
+        if len(buffer) < chunk_size and not eof:
+            more = file.read(chunk_size)
+            eof = not more
+            buffer += more
 
 
 class Command(BaseCommand):
     help = 'Imports sofas data from a JSON file and creates entries in the database'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file', default='sofa_data.json',
+            help='JSON array or JSON Lines file with the sofas to import.',
+        )
+        parser.add_argument(
+            '--images-dir', default='sofa_images',
+            help='Directory containing the images referenced by image_name.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=32,
+            help='Number of sofas inserted with one bulk_create and classified together.',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes extracting image features. 1 extracts them in this process.',
+        )
+        parser.add_argument(
+            '--defer-features', action='store_true',
+            help='Only insert the sofas and leave feature extraction to run_feature_workers.',
+        )
+        parser.add_argument(
+            '--checkpoint', default=None,
+            help='Name under which import progress is recorded. Defaults to the absolute path of the file.',
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore an existing checkpoint and import from the first record.',
+        )
+
     def handle(self, *args, **kwargs):
-        try:
-            with open('sofa_data.json', 'r', encoding='utf-8') as file:
-                json_data = json.load(file)
-        except FileNotFoundError:
+        self.verbosity = kwargs['verbosity']
+        source = Path(kwargs['file'])
+        images_dir = Path(kwargs['images_dir'])
+        self.checkpoint = kwargs['checkpoint'] or str(source.resolve())
+        batch_size = kwargs['batch_size']
+
+        if not source.is_file():
             self.stdout.write(self.style.ERROR('File not found. Please check the path to your JSON file.'))
             return
+
+        if kwargs['restart']:
+            ImportCheckpoint.objects.filter(source=self.checkpoint).delete()
+        position = self.read_checkpoint()
+        if position:
+            self.stdout.write(f'Resuming after record {position} of {self.checkpoint}')
+
+        self.stats = {
+            'records': 0, 'created': 0, 'missing_images': 0, 'invalid': 0,
+            'features_done': 0, 'features_failed': 0,
+            'read_seconds': 0.0, 'insert_seconds': 0.0, 'feature_seconds': 0.0,
+        }
+        self.defer_features = kwargs['defer_features']
+        self.executor = None
+        self.pending = set()
+        if kwargs['workers'] > 1 and not self.defer_features:
+            self.executor = ProcessPoolExecutor(
+                max_workers=kwargs['workers'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+        self.max_pending = 2 * kwargs['workers']
+
+        started = time.perf_counter()
+        try:
+            with open(source, 'r', encoding='utf-8') as file:
+                batch = []
+                read_started = time.perf_counter()
+                for index, sofa_data in enumerate(iter_json_records(file)):
+                    if index < position:
+                        continue
+                    self.stats['records'] += 1
+                    sofa = self.build_sofa(sofa_data, images_dir)
+                    if sofa is not None:
+                        batch.append(sofa)
+
+                    if len(batch) >= batch_size:
+                        self.record_read(read_started)
+                        self.create_batch(batch, batch_size, index + 1)
+                        batch = []
+                        read_started = time.perf_counter()
+
+                self.record_read(read_started)
+                if batch:
+                    self.create_batch(batch, batch_size, position + self.stats['records'])
         except json.JSONDecodeError:
             self.stdout.write(self.style.ERROR('Error decoding the JSON file. Please check its format.'))
             return
+        finally:
+            self.collect_features(wait_for_all=True)
+            if self.executor is not None:
+                self.executor.shutdown()
+
+        elapsed = time.perf_counter() - started
+        self.report(elapsed)
+        ImportCheckpoint.objects.filter(source=self.checkpoint).delete()
 
-        for sofa_data in json_data:
+    def build_sofa(self, sofa_data, images_dir):
+        """
+        Build an unsaved Sofa from one record, or return None if it cannot be imported.
+        """
+        try:
             name = sofa_data.get('name', '').strip()
-            price = sofa_data.get('price', '').replace(',', '')
-            discount = sofa_data.get('discount', '0')
+            price = float(str(sofa_data.get('price', '')).replace(',', ''))
+            discount = float(sofa_data.get('discount', '0'))
             image_name = sofa_data.get('image_name', '').strip()
             description = sofa_data.get('description', '')
+        except (AttributeError, TypeError, ValueError):
+            self.stats['invalid'] += 1
+            return None
+
+        image_path = images_dir / image_name
+        if not image_name or not image_path.is_file():
+            self.stats['missing_images'] += 1
+            return None
+
+        with open(image_path, 'rb') as img:
+            image_file = ContentFile(img.read(), name=image_name)
+
+        status = FeatureStatus.PENDING if self.defer_features else FeatureStatus.PROCESSING
+        return Sofa(
+            name=name,
+            price=price,
+            discount=discount,
+            original_price=calculate_original_price(price, discount),
+            image=image_file,
+            description=description,
+            features_status=status,
+            features_claimed_at=None if self.defer_features else timezone.now(),
+        )
+
+    def create_batch(self, batch, batch_size, position):
+        """
+        Insert a batch of sofas and extract their features with batched inference.
+
+        The checkpoint is moved to `position`, the number of records read so far,
+        in the transaction that inserts the batch.
+
+        `bulk_create` does not send `post_save`, so features are extracted here,
+        in this process or in the worker pool. The rows are inserted as already
+        claimed so that feature workers do not pick them up at the same time.
+        If the import stops, run_feature_workers picks them up again after
+        FEATURE_CLAIM_TIMEOUT.
+        """
+        with span('import_insert') as timing, transaction.atomic():
+            sofas = Sofa.objects.bulk_create(batch)
+            ImportCheckpoint.objects.update_or_create(source=self.checkpoint, defaults={'position': position})
+        self.stats['insert_seconds'] += timing.duration
+        self.stats['created'] += len(sofas)
+
+        if self.defer_features:
+            return
+
+        if self.executor is None:
+            with span('import_features') as timing:
+                succeeded = process_sofas(sofas, batch_size=batch_size)
+            self.stats['feature_seconds'] += timing.duration
+            self.stats['features_done'] += succeeded
+            self.stats['features_failed'] += len(sofas) - succeeded
+        else:
+            self.collect_features(wait_for_all=False)
+            self.pending.add(self.executor.submit(extract_features_for_ids, [sofa.pk for sofa in sofas], batch_size))
+
+        if self.verbosity >= 2:
+            self.stdout.write(
+                f'{self.stats["created"]} created, {self.stats["features_done"]} features done, '
+                f'{self.stats["features_failed"]} failed'
+            )
+
+    def record_read(self, read_started):
+        seconds = time.perf_counter() - read_started
+        self.stats['read_seconds'] += seconds
+        record_span('import_read', seconds)
 
+    def collect_features(self, wait_for_all):
+        """
+        Collect finished feature extraction tasks, waiting until fewer than
+        max_pending are in flight (or none, if wait_for_all is set).
+        """
+        while self.pending and (wait_for_all or len(self.pending) >= self.max_pending):
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                succeeded, failed, seconds = future.result()
+                self.stats['features_done'] += succeeded
+                self.stats['features_failed'] += failed
+                self.stats['feature_seconds'] += seconds
 
-            image_path = Path('sofa_images') / image_name
+    def read_checkpoint(self):
+        """
+        Return the number of records already imported by an interrupted run.
+        """
+        checkpoint = ImportCheckpoint.objects.filter(source=self.checkpoint).first()
+        return checkpoint.position if checkpoint else 0
 
-            if image_path.is_file():
-                with open(image_path, 'rb') as img:
-                    image_file = File(img, name=image_name)
+    def report(self, elapsed):
+        stats = self.stats
 
-                    Sofa.objects.create(
-                        name=name,
-                        price=float(price),
-                        discount=float(discount),
-                        image=image_file,
-                        description=description
-                    )
+        def rate(count, seconds):
+            return f'{count / seconds:.1f}/s' if seconds else 'n/a'
 
-        self.stdout.write(self.style.SUCCESS(f'Successfully imported {len(json_data)} sofas'))
+        self.stdout.write(f'Read {stats["records"]} records ({rate(stats["records"], stats["read_seconds"])})')
+        self.stdout.write(f'Inserted {stats["created"]} sofas ({rate(stats["created"], stats["insert_seconds"])})')
+        if not self.defer_features:
+            processed = stats['features_done'] + stats['features_failed']
+            self.stdout.write(
+                f'Extracted features for {stats["features_done"]} sofas, {stats["features_failed"]} failed '
+                f'({rate(processed, stats["feature_seconds"])} per worker)'
+            )
+        if stats['missing_images'] or stats['invalid']:
+            self.stdout.write(self.style.WARNING(
+                f'Skipped {stats["missing_images"]} records with missing images and {stats["invalid"]} invalid records'
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully imported {stats["created"]} sofas in {elapsed:.1f}s ({rate(stats["created"], elapsed)})'
+        ))
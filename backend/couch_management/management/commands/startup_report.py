@@ -0,0 +1,92 @@
+import json
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+# The heavy modules behind couch_management.lazy, imported with --ml.
+ML_MODULES = ['rembg', 'cv2', 'onnxruntime', 'keras']
+
+PROBE = '''
+import json, resource, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+setup_seconds = time.perf_counter() - started
+for name in sys.argv[1:]:
+    __import__(name)
+print(json.dumps({
+    'setup_seconds': setup_seconds,
+    'total_seconds': time.perf_counter() - started,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+'''
+
+
+def parse_importtime(output):
+    """
+    Parse the `python -X importtime` report.
+
+    Args:
+        output (str): The stderr of the interpreter.
+
+    Returns:
+        list: (module, self seconds, cumulative seconds, nesting depth) per imported module, in import order.
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, depth))
+    return imports
+
+
+class Command(BaseCommand):
+    help = 'Reports how long a fresh process takes to start and which imports the time goes to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'modules', nargs='*', default=['couch_matcher.urls'],
+            help='Modules imported after django.setup(), e.g. the URLconf (the default) or a management command.',
+        )
+        parser.add_argument('--ml', action='store_true', help=f'Also import the ML stack ({", ".join(ML_MODULES)}).')
+        parser.add_argument('--top', type=int, default=15, help='Number of slowest top-level imports to list.')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+
+    def handle(self, *args, **kwargs):
+        modules = kwargs['modules'] + (ML_MODULES if kwargs['ml'] else [])
+        # Measured in a new interpreter: everything is already imported in this one.
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', PROBE, *modules],
+            capture_output=True, text=True,
+        )
+        if process.returncode:
+            raise CommandError(f'The startup probe failed:\n{process.stderr[-2000:]}')
+
+        summary = json.loads(process.stdout.strip().splitlines()[-1])
+        imports = parse_importtime(process.stderr)
+        top_level = sorted((item for item in imports if item[3] == 0), key=lambda item: item[2], reverse=True)
+        heavy = [name for name in ML_MODULES if any(item[0] == name for item in imports)]
+
+        if kwargs['json']:
+            self.stdout.write(json.dumps({
+                **summary,
+                'modules': modules,
+                'ml_modules_imported': heavy,
+                'imports': [
+                    {'module': name, 'self_s': self_seconds, 'cumulative_s': cumulative}
+                    for name, self_seconds, cumulative, _ in top_level[:kwargs['top']]
+                ],
+            }, indent=2))
+            return
+
+        self.stdout.write(
+            f'django.setup(): {summary["setup_seconds"]:.2f}s, total: {summary["total_seconds"]:.2f}s, '
+            f'peak RSS: {summary["max_rss_mb"]:.0f} MB'
+        )
+        self.stdout.write(f'ML modules imported: {", ".join(heavy) or "none"}')
+        self.stdout.write(f'{"cumulative":>12} {"self":>10}  module')
+        for name, self_seconds, cumulative, _ in top_level[:kwargs['top']]:
+            self.stdout.write(f'{1000 * cumulative:10.1f}ms {1000 * self_seconds:8.1f}ms  {name}')
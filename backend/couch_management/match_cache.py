@@ -0,0 +1,166 @@
+import hashlib
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from PIL import Image
+
+from couch_management.metrics import MATCH_CACHE_LOOKUPS
+from couch_management.models import Sofa
+
+
+def content_hash(data):
+    """
+    Hash the exact bytes of an uploaded image.
+
+    Args:
+        data (bytes): The encoded image.
+
+    Returns:
+        str: The SHA-256 hex digest.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(image, size=8):
+    """
+    Compute a difference hash that survives re-encoding and resizing of a photo.
+
+    Args:
+        image (np.ndarray): The decoded RGB image.
+        size (int): The hash has size * size bits.
+
+    Returns:
+        str: The hash as a hex string.
+    """
+    gray = Image.fromarray(image).convert('L').resize((size + 1, size), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+
+class MatchCache:
+    """
+    Cache of query features and ranked matches for uploaded images.
+
+    Query features (sofa type and color, or the image embedding) depend only on
+    the image, so they are kept for MATCH_CACHE_FEATURES_TTL and reused when only
+    the budget changes. Ranked matches also depend on the budget and the catalog;
+    they are stored under the current catalog version, which is read from the
+    database, so a sofa changed by any process (e.g. a feature worker) makes
+    them stale for every worker.
+
+    Entries live in the "matching" Django cache, whose backend and size are set
+    by MATCH_CACHE_BACKEND, MATCH_CACHE_LOCATION and MATCH_CACHE_MAX_ENTRIES.
+    """
+
+    def __init__(self, alias='matching'):
+        self.alias = alias
+        self._stats_lock = threading.Lock()
+        self._stats = {'features_hits': 0, 'features_misses': 0, 'results_hits': 0, 'results_misses': 0}
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+        lookup, result = name.split('_')
+        MATCH_CACHE_LOOKUPS.inc(lookup=lookup, result=result)
+
+    def stats(self):
+        """
+        Return this process's hit and miss counters.
+
+        Returns:
+            dict: Hits and misses of the feature and result lookups.
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def image_key(self, data, image=None):
+        """
+        Return the cache key of an uploaded image.
+
+        Args:
+            data (bytes): The encoded image.
+            image (np.ndarray): The decoded image. Required when
+                settings.MATCH_CACHE_PERCEPTUAL_HASH is enabled.
+
+        Returns:
+            str: The perceptual hash if enabled, otherwise the content hash.
+        """
+        if settings.MATCH_CACHE_PERCEPTUAL_HASH:
+            return f'p{perceptual_hash(image)}'
+        return f's{content_hash(data)}'
+
+    def catalog_version(self):
+        """
+        Return the current catalog version that ranked matches are stored under.
+
+        Returns:
+            str: `SofaQuerySet.version_stamp` of the catalog, or None if the cache is disabled.
+        """
+        if not settings.MATCH_CACHE_ENABLED:
+            return None
+        return Sofa.objects.version_stamp()
+
+    def get_features(self, mode, image_key):
+        """
+        Return the cached query features of an image, or None.
+        """
+        if not settings.MATCH_CACHE_ENABLED:
+            return None
+        features = self.cache.get(f'match:features:{mode}:{image_key}')
+        self._count('features_misses' if features is None else 'features_hits')
+        return features
+
+    def set_features(self, mode, image_key, features):
+        if settings.MATCH_CACHE_ENABLED:
+            self.cache.set(f'match:features:{mode}:{image_key}', features, settings.MATCH_CACHE_FEATURES_TTL)
+
+    def get_results(self, mode, image_key, budget, version):
+        """
+        Return the cached ranked matches of an image and budget, or None.
+
+        Args:
+            mode (str): The matching mode.
+            image_key (str): The key returned by `image_key`.
+            budget (float): Maximum price, or None for no limit.
+            version (str): The catalog version returned by `catalog_version`.
+
+        Returns:
+            list: (sofa id, score) pairs, or None on a miss.
+        """
+        if not settings.MATCH_CACHE_ENABLED:
+            return None
+        matches = self.cache.get(f'match:results:{mode}:{image_key}:{budget}', version=version)
+        self._count('results_misses' if matches is None else 'results_hits')
+        return matches
+
+    def set_results(self, mode, image_key, budget, version, matches):
+        if settings.MATCH_CACHE_ENABLED:
+            self.cache.set(
+                f'match:results:{mode}:{image_key}:{budget}', matches,
+                settings.MATCH_CACHE_RESULTS_TTL, version=version,
+            )
+
+
+_match_cache = None
+_match_cache_lock = threading.Lock()
+
+
+def get_match_cache():
+    """
+    Return the process-wide matching cache, creating it on first access.
+
+    Returns:
+        MatchCache: The shared cache.
+    """
+    global _match_cache
+    if _match_cache is None:
+        with _match_cache_lock:
+            if _match_cache is None:
+                _match_cache = MatchCache()
+    return _match_cache
@@ -0,0 +1,209 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """
+    A monotonically increasing count per label combination, in the Prometheus text format.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count of observed values per label combination.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total, observations = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value, observations + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, observations) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", bound)])} {count}')
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", "+Inf")])} {observations}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {observations}')
+        return lines
+
+
+REQUESTS = Counter('couch_matcher_requests_total', 'HTTP requests by view, method and status.', ['view', 'method', 'status'])
+REQUEST_DURATION = Histogram('couch_matcher_request_duration_seconds', 'HTTP request latency by view.', ['view'])
+STAGE_DURATION = Histogram('couch_matcher_stage_duration_seconds', 'Latency of pipeline stages.', ['stage'])
+STAGE_ERRORS = Counter('couch_matcher_stage_errors_total', 'Pipeline stages that raised an exception.', ['stage'])
+MATCH_CACHE_LOOKUPS = Counter(
+    'couch_matcher_match_cache_lookups_total', 'Matching cache lookups by kind and result.', ['lookup', 'result'],
+)
+INFERENCE_BATCH_SIZE = Histogram(
+    'couch_matcher_inference_batch_size', 'Inputs per micro-batched inference call.', ['batcher'],
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+INFERENCE_QUEUE_DELAY = Histogram(
+    'couch_matcher_inference_queue_delay_seconds', 'Time inputs waited for their micro-batch to run.', ['batcher'],
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+METRICS = [
+    REQUESTS, REQUEST_DURATION, STAGE_DURATION, STAGE_ERRORS, MATCH_CACHE_LOOKUPS,
+    INFERENCE_BATCH_SIZE, INFERENCE_QUEUE_DELAY,
+]
+
+
+def render_metrics():
+    """
+    Render every metric of this process in the Prometheus text exposition format.
+
+    Returns:
+        str: The metrics document.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+_request_spans = contextvars.ContextVar('request_spans', default=None)
+_span_listeners = []
+
+
+def add_span_listener(listener):
+    """
+    Register a callable that receives the name and duration in seconds of every finished span,
+    e.g. to forward spans to a tracing system.
+    """
+    _span_listeners.append(listener)
+
+
+def start_request_spans():
+    """
+    Start collecting the spans of the current request.
+
+    Returns:
+        contextvars.Token: The token to pass to `finish_request_spans`.
+    """
+    return _request_spans.set([])
+
+
+def finish_request_spans(token):
+    """
+    Stop collecting spans for the current request.
+
+    Returns:
+        list: The (name, duration) pairs recorded during the request.
+    """
+    spans = _request_spans.get()
+    _request_spans.reset(token)
+    return spans or []
+
+
+def record_span(name, duration, failed=False):
+    """
+    Record a finished stage in the metrics, the current request and the span listeners.
+
+    Args:
+        name (str): The stage name.
+        duration (float): The duration in seconds.
+        failed (bool): Whether the stage raised an exception.
+    """
+    STAGE_DURATION.observe(duration, stage=name)
+    if failed:
+        STAGE_ERRORS.inc(stage=name)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, duration))
+    for listener in _span_listeners:
+        listener(name, duration)
+
+
+class SpanTiming:
+    duration = 0.0
+
+
+@contextmanager
+def span(name):
+    """
+    Time a stage of the pipeline.
+
+    Usage:
+        with span('decode') as timing:
+            ...
+        timing.duration  # seconds
+
+    Args:
+        name (str): The stage name, reported in Server-Timing and the stage metrics.
+    """
+    timing = SpanTiming()
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield timing
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        timing.duration = time.perf_counter() - started
+        record_span(name, timing.duration, failed)
+
+
+def server_timing_header(spans):
+    """
+    Format request spans as a Server-Timing header, adding up repeated stages.
+
+    Args:
+        spans (list): (name, duration in seconds) pairs.
+
+    Returns:
+        str: The header value, with durations in milliseconds.
+    """
+    totals = {}
+    for name, duration in spans:
+        totals[name] = totals.get(name, 0.0) + duration
+    return ', '.join(f'{name};dur={1000 * duration:.1f}' for name, duration in totals.items())
@@ -0,0 +1,60 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from couch_management.metrics import (REQUEST_DURATION, REQUESTS,
+                                      finish_request_spans,
+                                      server_timing_header,
+                                      start_request_spans)
+
+
+class ServerTimingMiddleware:
+    """
+    Collect the timing spans of each request and count and time requests per view.
+
+    The spans recorded while the request was processed are returned in a
+    Server-Timing header (unless SERVER_TIMING_HEADER is disabled), so the
+    browser's developer tools show where the time of a slow match went.
+    Works for both sync and async views. For a streamed response, the
+    header and the request duration only cover the time until the response
+    starts; the streaming itself is recorded as the `stream` stage.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        token = start_request_spans()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            spans = finish_request_spans(token)
+        return self.finish(request, response, spans, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        token = start_request_spans()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            spans = finish_request_spans(token)
+        return self.finish(request, response, spans, time.perf_counter() - started)
+
+    def finish(self, request, response, spans, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unmatched'
+        REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        REQUEST_DURATION.observe(duration, view=view)
+
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = server_timing_header(spans + [('total', duration)])
+        return response
@@ -0,0 +1,104 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:56
+
+from django.db import migrations, models
+
+FEATURE_COLUMNS = ['sofa_type', 'color_red', 'color_green', 'color_blue', 'lab_l', 'lab_a', 'lab_b']
+
+
+def rgb_to_lab(rgb_color):
+    """
+    Convert an sRGB color to CIE L*a*b* (D65 white point).
+
+    A frozen copy of `couch_management.utils.rgb_to_lab`, so that later changes
+    to the app code do not change this migration.
+    """
+    linear = [
+        ((channel / 255 + 0.055) / 1.055) ** 2.4 if channel / 255 > 0.04045 else channel / 255 / 12.92
+        for channel in rgb_color
+    ]
+    matrix = [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+    white = [0.95047, 1.0, 1.08883]
+    xyz = [sum(weight * value for weight, value in zip(row, linear)) / reference for row, reference in zip(matrix, white)]
+    f = [value ** (1 / 3) if value > (6 / 29) ** 3 else value / (3 * (6 / 29) ** 2) + 4 / 29 for value in xyz]
+    return 116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2])
+
+
+def backfill_feature_columns(apps, schema_editor):
+    """
+    Copy the type and dominant color of existing sofas from `features` into the new columns.
+    """
+    Sofa = apps.get_model('couch_management', 'Sofa')
+    batch = []
+    for sofa in Sofa.objects.exclude(features=None).only('id', 'features').iterator(chunk_size=1000):
+        rgb_color = sofa.features.get('rgb_color')
+        sofa.sofa_type = sofa.features.get('sofa_type')
+        if rgb_color:
+            sofa.color_red, sofa.color_green, sofa.color_blue = rgb_color
+            sofa.lab_l, sofa.lab_a, sofa.lab_b = rgb_to_lab(rgb_color)
+        batch.append(sofa)
+
+        if len(batch) >= 1000:
+            Sofa.objects.bulk_update(batch, FEATURE_COLUMNS)
+            batch = []
+
+    if batch:
+        Sofa.objects.bulk_update(batch, FEATURE_COLUMNS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sofa',
+            name='color_blue',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='color_green',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='color_red',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='lab_a',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='lab_b',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='lab_l',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='sofa_type',
+            field=models.CharField(blank=True, editable=False, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='sofa',
+            name='original_price',
+            field=models.FloatField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='sofa',
+            index=models.Index(fields=['sofa_type', 'color_red', 'color_green', 'color_blue'], name='sofa_type_color_idx'),
+        ),
+        migrations.RunPython(backfill_feature_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:57
+
+from django.db import migrations, models
+
+
+def mark_extracted_sofas_done(apps, schema_editor):
+    """
+    Existing sofas that already have features do not need a feature extraction job.
+    """
+    Sofa = apps.get_model('couch_management', 'Sofa')
+    Sofa.objects.exclude(features=None).update(features_status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0002_sofa_feature_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sofa',
+            name='features_attempts',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='features_claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='features_error',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='features_next_attempt_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='features_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='sofa',
+            index=models.Index(fields=['features_status', 'features_next_attempt_at'], name='sofa_features_queue_idx'),
+        ),
+        migrations.RunPython(mark_extracted_sofas_done, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0003_sofa_feature_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sofa',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
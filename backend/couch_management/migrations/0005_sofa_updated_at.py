@@ -0,0 +1,20 @@
+# Generated by Django 4.2.18 on 2026-10-18 14:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0004_sofa_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sofa',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0005_sofa_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sofa',
+            name='image_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
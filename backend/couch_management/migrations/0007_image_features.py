@@ -0,0 +1,37 @@
+# Generated by Django 4.2.18 on 2026-10-18 11:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0006_sofa_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageFeatures',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64)),
+                ('pipeline_version', models.CharField(max_length=16)),
+                ('mask_version', models.CharField(max_length=16)),
+                ('sofa_type', models.CharField(max_length=50)),
+                ('confidence', models.FloatField()),
+                ('palette', models.JSONField()),
+                ('embedding', models.BinaryField()),
+                ('mask', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['digest', 'mask_version'], name='image_features_mask_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='imagefeatures',
+            constraint=models.UniqueConstraint(fields=('digest', 'pipeline_version'), name='image_features_key'),
+        ),
+    ]
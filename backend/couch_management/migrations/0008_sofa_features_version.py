@@ -0,0 +1,23 @@
+# Generated by Django 4.2.18 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0007_image_features'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sofa',
+            name='features_version',
+            field=models.CharField(blank=True, default='', editable=False, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='sofa',
+            name='image_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0009_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sofa',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.18 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+def create_catalog_state(apps, schema_editor):
+    CatalogState = apps.get_model('couch_management', 'CatalogState')
+    CatalogState.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('couch_management', '0010_sofa_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deletions', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_catalog_state, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,196 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from couch_management.features import cut_out
+from couch_management.keras import (EMBEDDING_OUTPUT, IMAGE_SIZE,
+                                    SCORES_OUTPUT, build_embedding_model,
+                                    export_metadata_path, file_digest,
+                                    load_keras_model, preprocess_image)
+from couch_management.match_cache import content_hash
+from couch_management.models import Sofa
+
+
+def build_export_model(model_path):
+    """
+    Build the Keras model that is exported: the classifier with named class score and embedding outputs.
+
+    Args:
+        model_path (str): The path to the .h5 model file.
+
+    Returns:
+        Model: A Keras model with outputs "scores" and "embedding".
+    """
+    from keras.layers import Activation
+    from keras.models import Model
+
+    embedding_model = build_embedding_model(load_keras_model(model_path))
+    scores, embedding = embedding_model.outputs
+    return Model(embedding_model.inputs, [
+        Activation('linear', name=SCORES_OUTPUT)(scores),
+        Activation('linear', name=EMBEDDING_OUTPUT)(embedding),
+    ])
+
+
+def catalog_images(limit):
+    """
+    Read up to `limit` catalog images, spread evenly over the catalog.
+
+    Args:
+        limit (int): Maximum number of images.
+
+    Returns:
+        list: (SHA-256 hex digest, encoded image) pairs of the image files that exist.
+    """
+    images = list(Sofa.objects.exclude(image='').order_by('id').values_list('image', flat=True))
+    if len(images) > limit:
+        images = [images[index] for index in np.linspace(0, len(images) - 1, limit).astype(int)]
+
+    storage = Sofa._meta.get_field('image').storage
+    encoded = []
+    for image in images:
+        if not storage.exists(image):
+            continue
+        with storage.open(image, 'rb') as image_file:
+            data = image_file.read()
+        encoded.append((content_hash(data), data))
+    return encoded
+
+
+def preprocess_cutouts(images):
+    """
+    Prepare classifier inputs the way production does: from background-removed cutouts, not the raw photos.
+
+    Args:
+        images (list): (SHA-256 hex digest, encoded image) pairs.
+
+    Returns:
+        np.ndarray: The classifier inputs of the cutouts, of shape (N, 224, 224, 3).
+    """
+    cutouts = cut_out(images)
+    data = np.empty((len(cutouts), *IMAGE_SIZE, 3), dtype=np.float32)
+    for index, cutout in enumerate(cutouts):
+        data[index] = preprocess_image(cutout)
+    return data
+
+
+def export_tflite(model, output_path, calibration=None):
+    """
+    Convert the export model to TFLite.
+
+    Args:
+        model: The model returned by `build_export_model`.
+        output_path (str): Where to write the .tflite file.
+        calibration (np.ndarray): Preprocessed images used to calibrate int8
+            post-training quantization. Without them the model stays float32.
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if calibration is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([image[np.newaxis]] for image in calibration)
+        # Weights and activations are int8; inputs and outputs stay float32 so preprocessing is unchanged.
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    Path(output_path).write_bytes(converter.convert())
+
+
+def export_onnx(model, output_path, calibration=None):
+    """
+    Convert the export model to ONNX.
+
+    Requires the tf2onnx package, and onnx for int8 quantization; neither is
+    needed to run the exported model.
+
+    Args:
+        model: The model returned by `build_export_model`.
+        output_path (str): Where to write the .onnx file.
+        calibration (np.ndarray): Preprocessed images used to calibrate int8
+            post-training quantization. Without them the model stays float32.
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    input_signature = [tf.TensorSpec((None, *IMAGE_SIZE, 3), tf.float32, name='image')]
+    if calibration is None:
+        tf2onnx.convert.from_keras(model, input_signature=input_signature, output_path=output_path)
+        return
+
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat,
+                                          QuantType, quantize_static)
+
+    class CatalogDataReader(CalibrationDataReader):
+        def __init__(self):
+            self.images = iter(calibration)
+
+        def get_next(self):
+            image = next(self.images, None)
+            return None if image is None else {'image': image[np.newaxis]}
+
+    float_path = f'{output_path}.float32'
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, output_path=float_path)
+    try:
+        quantize_static(
+            float_path, output_path, CatalogDataReader(),
+            quant_format=QuantFormat.QDQ, per_channel=True,
+            activation_type=QuantType.QInt8, weight_type=QuantType.QInt8,
+        )
+    finally:
+        os.remove(float_path)
+
+
+def check_parity(reference, candidate, data, batch_size=32):
+    """
+    Compare the outputs of an exported model with the Keras model.
+
+    Args:
+        reference: The Keras inference backend.
+        candidate: The inference backend of the exported model.
+        data (np.ndarray): Preprocessed cutouts, see `preprocess_cutouts`.
+        batch_size (int): Images per forward pass.
+
+    Returns:
+        dict: The number of images, the share of images whose predicted class
+        agrees, the largest absolute class score difference and the mean
+        cosine similarity of the embeddings.
+    """
+    agreements, score_differences, cosines = [], [], []
+    for start in range(0, len(data), batch_size):
+        batch = data[start:start + batch_size]
+        expected_scores, expected_embeddings = reference.predict(batch, return_embeddings=True)
+        scores, embeddings = candidate.predict(batch, return_embeddings=True)
+
+        agreements.append(np.argmax(expected_scores, axis=1) == np.argmax(scores, axis=1))
+        score_differences.append(np.abs(expected_scores - scores).max(axis=1))
+        norms = np.linalg.norm(expected_embeddings, axis=1) * np.linalg.norm(embeddings, axis=1)
+        cosines.append(np.sum(expected_embeddings * embeddings, axis=1) / np.maximum(norms, 1e-12))
+
+    return {
+        'images': len(data),
+        'top1_agreement': float(np.concatenate(agreements).mean()),
+        'max_score_difference': float(np.concatenate(score_differences).max()),
+        'mean_embedding_cosine': float(np.concatenate(cosines).mean()),
+    }
+
+
+def write_export_metadata(output_path, source_path, int8, parity):
+    """
+    Record which Keras model an exported model was exported from and how it compared.
+
+    `resolve_inference_backend` only picks an export whose metadata names the
+    current Keras model, so this is written once the export passed its checks.
+
+    Args:
+        output_path (str): The exported model.
+        source_path (str): The .h5 model it was exported from.
+        int8 (bool): Whether it was quantized.
+        parity (dict): The result of `check_parity`.
+    """
+    metadata = {
+        'source_digest': file_digest(source_path),
+        'int8': int8,
+        'parity': parity,
+    }
+    Path(export_metadata_path(output_path)).write_text(json.dumps(metadata, indent=2))
@@ -1,7 +1,62 @@
 from django.core.validators import MaxValueValidator
 from django.db import models
 
-from couch_management.utils import calculate_original_price
+from couch_management.utils import calculate_original_price, rgb_to_lab
+
+
+class SofaQuerySet(models.QuerySet):
+    def matching_candidates(self, sofa_type, rgb_color, color_threshold, budget=None):
+        """
+        Filter sofas of a type whose color lies in the bounding box around a color.
+
+        The box contains every color within `color_threshold` Euclidean RGB distance,
+        so callers only need to check the exact distance on the returned rows.
+
+        Args:
+            sofa_type (str): The sofa type the candidates must have.
+            rgb_color (tuple): The query color (R, G, B).
+            color_threshold (float): Maximum RGB distance.
+            budget (float): Maximum price, or None for no limit.
+
+        Returns:
+            SofaQuerySet: The candidate sofas.
+        """
+        red, green, blue = rgb_color
+        sofas = self.filter(
+            sofa_type=sofa_type,
+            color_red__range=(red - color_threshold, red + color_threshold),
+            color_green__range=(green - color_threshold, green + color_threshold),
+            color_blue__range=(blue - color_threshold, blue + color_threshold),
+        )
+        if budget is not None:
+            sofas = sofas.filter(original_price__lte=budget)
+        return sofas
+
+    def version_stamp(self):
+        """
+        Return a stamp of the rows that changes when one of them is added, saved or deleted,
+        by any process.
+
+        Both parts are read without scanning the table: the latest modification
+        time from the index on `updated_at` and the deletion counter from its
+        single CatalogState row.
+
+        Returns:
+            str: The number of deleted sofas and the latest modification time of the rows.
+        """
+        updated_at = self.aggregate(updated_at=models.Max('updated_at'))['updated_at']
+        deletions = CatalogState.objects.filter(pk=CatalogState.ROW_ID).values_list('deletions', flat=True).first()
+        return f"{deletions or 0}-{updated_at.timestamp() if updated_at else 0}"
+
+
+class FeatureStatus(models.TextChoices):
+    """
+    State of a sofa's feature extraction job.
+    """
+    PENDING = 'pending', 'Pending'
+    PROCESSING = 'processing', 'Processing'
+    DONE = 'done', 'Done'
+    FAILED = 'failed', 'Failed'
 
 
 class Sofa(models.Model):
@@ -17,24 +72,115 @@ class Sofa(models.Model):
         quantity (int): The quantity of the sofa in stock.
         description (str): A brief description of the sofa.
         features (JSONField): A json field to store image features.
+        sofa_type (str): The predicted sofa type, copied from the features.
+        color_red, color_green, color_blue (int): The dominant RGB color, copied from the features.
+        lab_l, lab_a, lab_b (float): The dominant color in CIE L*a*b*.
+        embedding (bytes): The normalized float16 image embedding of the classifier's penultimate layer.
+        features_status (str): State of the feature extraction job.
+        features_attempts (int): Number of failed feature extraction attempts.
+        features_error (str): The error of the last failed attempt.
+        features_next_attempt_at (datetime): Earliest time a worker may pick up the job.
+        features_claimed_at (datetime): When a worker started processing the job.
+        image_derivatives (dict): Storage names of the resized copies of the image, by derivative name.
+        image_hash (str): The SHA-256 of the image the features were extracted from.
+        features_version (str): The feature pipeline version that extracted the features.
+        updated_at (datetime): When the sofa was last saved.
     """
     name = models.CharField(max_length=255)
     image = models.ImageField(upload_to='sofa_images/')
     price = models.FloatField()
-    original_price = models.FloatField()
+    original_price = models.FloatField(db_index=True)
     discount = models.FloatField(default=0, validators=[MaxValueValidator(100)])
     quantity = models.IntegerField(default=1)
     description = models.TextField(null=True, blank=True)
     features = models.JSONField(null=True, blank=True)
+    sofa_type = models.CharField(max_length=50, null=True, blank=True, editable=False)
+    color_red = models.PositiveSmallIntegerField(null=True, blank=True, editable=False)
+    color_green = models.PositiveSmallIntegerField(null=True, blank=True, editable=False)
+    color_blue = models.PositiveSmallIntegerField(null=True, blank=True, editable=False)
+    lab_l = models.FloatField(null=True, blank=True, editable=False)
+    lab_a = models.FloatField(null=True, blank=True, editable=False)
+    lab_b = models.FloatField(null=True, blank=True, editable=False)
+    embedding = models.BinaryField(null=True, blank=True, editable=False)
+    features_status = models.CharField(max_length=10, choices=FeatureStatus.choices, default=FeatureStatus.PENDING)
+    features_attempts = models.PositiveIntegerField(default=0, editable=False)
+    features_error = models.TextField(blank=True, default='', editable=False)
+    features_next_attempt_at = models.DateTimeField(null=True, blank=True, editable=False)
+    features_claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    image_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
+    features_version = models.CharField(max_length=16, blank=True, default='', editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = SofaQuerySet.as_manager()
+
+    # The image name the instance was loaded with, to tell whether the image was replaced.
+    _loaded_image_name = None
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sofa_type', 'color_red', 'color_green', 'color_blue'], name='sofa_type_color_idx'),
+            models.Index(fields=['features_status', 'features_next_attempt_at'], name='sofa_features_queue_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'image' in field_names:
+            instance._loaded_image_name = values[field_names.index('image')]
+        return instance
+
+    @property
+    def image_replaced(self):
+        """
+        bool: Whether the image of a saved sofa was replaced since it was loaded.
+        """
+        return self._loaded_image_name is not None and self.image.name != self._loaded_image_name
+
+    @staticmethod
+    def feature_columns(features):
+        """
+        Derive the indexed feature columns from a features dict.
+
+        Args:
+            features (dict): The image features, or None.
+
+        Returns:
+            dict: Column values for sofa_type, the RGB color and the Lab color.
+        """
+        features = features or {}
+        rgb_color = features.get('rgb_color')
+        red, green, blue = rgb_color if rgb_color else (None, None, None)
+        lab_l, lab_a, lab_b = rgb_to_lab(rgb_color) if rgb_color else (None, None, None)
+        return {
+            'sofa_type': features.get('sofa_type'),
+            'color_red': red,
+            'color_green': green,
+            'color_blue': blue,
+            'lab_l': lab_l,
+            'lab_a': lab_a,
+            'lab_b': lab_b,
+        }
 
     def save(self, *args, **kwargs):
         """
         Saves the sofa instance to the database.
 
-        Calculates the original price based on the price and discount.
+        Calculates the original price based on the price and discount, and copies
+        the features into their indexed columns. A sofa whose image was replaced
+        is queued for feature extraction again.
         """
         self.original_price = calculate_original_price(self.price, self.discount)
+        for column, value in self.feature_columns(self.features).items():
+            setattr(self, column, value)
+        if self.image_replaced:
+            self.features_status = FeatureStatus.PENDING
+            self.features_attempts = 0
+            self.features_error = ''
+            self.features_next_attempt_at = None
+            self.features_claimed_at = None
         super(Sofa, self).save(*args, **kwargs)
+        self._loaded_image_name = self.image.name
 
     def __str__(self) -> str:
         """
@@ -44,3 +190,100 @@ class Sofa(models.Model):
             str: The name of the sofa.
         """
         return f"{self.name}"
+
+
+class ImageFeatures(models.Model):
+    """
+    The features computed for one image, addressed by the SHA-256 of its bytes and the feature pipeline version.
+
+    Duplicate images (variants, re-imports, queries that are catalog images)
+    reuse the record instead of running background removal, the classifier
+    and color extraction again.
+
+    Attributes:
+        digest (str): The SHA-256 hex digest of the encoded image.
+        pipeline_version (str): The version of the feature pipeline that computed the record.
+        mask_version (str): The version of the background removal that computed the mask.
+        sofa_type (str): The predicted sofa type.
+        confidence (float): The classifier's confidence in the sofa type.
+        palette (list): [[R, G, B], proportion] pairs of the main colors, by decreasing proportion.
+        embedding (bytes): The normalized float16 image embedding.
+        mask (bytes): The PNG-encoded foreground mask of the background removal.
+        size (int): Bytes stored for the record, used for eviction.
+        created_at (datetime): When the record was computed.
+        last_used_at (datetime): When the record was last used, to the hour.
+    """
+    digest = models.CharField(max_length=64)
+    pipeline_version = models.CharField(max_length=16)
+    mask_version = models.CharField(max_length=16)
+    sofa_type = models.CharField(max_length=50)
+    confidence = models.FloatField()
+    palette = models.JSONField()
+    embedding = models.BinaryField()
+    mask = models.BinaryField()
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['digest', 'pipeline_version'], name='image_features_key'),
+        ]
+        indexes = [
+            models.Index(fields=['digest', 'mask_version'], name='image_features_mask_idx'),
+        ]
+
+    @property
+    def dominant_color(self):
+        return tuple(self.palette[0][0])
+
+    def __str__(self) -> str:
+        return f"{self.digest[:12]} ({self.pipeline_version})"
+
+
+class ImportCheckpoint(models.Model):
+    """
+    The progress of a `manage.py sofa_create` import.
+
+    It is saved in the transaction that inserts each batch, so a resumed
+    import neither skips nor repeats records.
+
+    Attributes:
+        source (str): Identifies the import, by default the absolute path of the imported file.
+        position (int): The number of records of the file already imported.
+        updated_at (datetime): When the last batch was inserted.
+    """
+    source = models.CharField(max_length=512, unique=True)
+    position = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.source} ({self.position})"
+
+
+class CatalogState(models.Model):
+    """
+    State of the sofa catalog shared by all processes, kept in a single row.
+
+    Attributes:
+        deletions (int): The number of sofas deleted so far. A deleted sofa
+            leaves no modification time behind, so `SofaQuerySet.version_stamp`
+            counts deletions to notice them.
+    """
+    ROW_ID = 1
+
+    deletions = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def record_deletion(cls):
+        """
+        Increment the deletion counter, creating its row if it is missing.
+        """
+        if cls.objects.filter(pk=cls.ROW_ID).update(deletions=models.F('deletions') + 1):
+            return
+        _, created = cls.objects.get_or_create(pk=cls.ROW_ID, defaults={'deletions': 1})
+        if not created:
+            cls.objects.filter(pk=cls.ROW_ID).update(deletions=models.F('deletions') + 1)
+
+    def __str__(self) -> str:
+        return f"{self.deletions} deletions"
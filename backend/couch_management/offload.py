@@ -0,0 +1,116 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+class InFlightLimiter:
+    """
+    Counts the requests a worker is processing and rejects new ones above a limit.
+
+    Rejecting early keeps the latency of admitted requests bounded instead of
+    letting every request queue behind the CPU-bound pipeline until it times out.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def acquire(self):
+        """
+        Admit one request.
+
+        Returns:
+            bool: False if the limit is reached and the request must be rejected.
+        """
+        with self._lock:
+            if self.limit and self._in_flight >= self.limit:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return self._in_flight
+
+
+_match_executor = None
+_match_limiter = None
+_offload_lock = threading.Lock()
+
+
+def get_match_executor():
+    """
+    Return the process-wide thread pool that runs background removal, classification and color extraction.
+
+    Returns:
+        ThreadPoolExecutor: A pool of settings.MATCH_EXECUTOR_WORKERS threads.
+    """
+    global _match_executor
+    if _match_executor is None:
+        with _offload_lock:
+            if _match_executor is None:
+                _match_executor = ThreadPoolExecutor(
+                    max_workers=settings.MATCH_EXECUTOR_WORKERS, thread_name_prefix='match',
+                )
+    return _match_executor
+
+
+def get_match_limiter():
+    """
+    Return the process-wide limiter of in-flight matching requests.
+
+    Returns:
+        InFlightLimiter: A limiter admitting settings.MATCH_MAX_IN_FLIGHT requests.
+    """
+    global _match_limiter
+    if _match_limiter is None:
+        with _offload_lock:
+            if _match_limiter is None:
+                _match_limiter = InFlightLimiter(settings.MATCH_MAX_IN_FLIGHT)
+    return _match_limiter
+
+
+def call_with_fresh_connections(func, *args):
+    """
+    Call `func` with the database connection handling Django applies around a request.
+
+    The match executor's threads are not request threads, so Django never
+    closes their connections. Closing the unusable and expired ones before and
+    after each call keeps the threads from holding connections forever or
+    reusing dead ones.
+    """
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_match_executor(func, *args):
+    """
+    Run a blocking stage of a match request in the match executor and wait for it.
+
+    The stage runs in a copy of the current context, so its spans reach the
+    request's Server-Timing, and with `call_with_fresh_connections`, since it
+    reads and writes the database (catalog index, feature store).
+
+    Args:
+        func (callable): The stage.
+        args: Its arguments.
+
+    Returns:
+        The result of `func`.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_match_executor(), context.run, call_with_fresh_connections, func, *args)
@@ -0,0 +1,195 @@
+import base64
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.http import StreamingHttpResponse
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+
+from couch_management.metrics import record_span
+
+
+class SofaCursorPagination(CursorPagination):
+    """
+    Keyset pagination over sofas by primary key.
+
+    Every page is read with `WHERE id > last_id ORDER BY id LIMIT n`, so deep
+    pages cost the same as the first one and no `COUNT(*)` is needed.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+
+    @property
+    def max_page_size(self):
+        return settings.MAX_PAGE_SIZE
+
+
+def page_etag(request, sofas, next_url, catalog_stamp):
+    """
+    Compute the ETag of a page of sofas.
+
+    It covers the request URL, the id and modification time of every sofa on
+    the page, the link to the next page and the version stamp of the whole
+    listing. A sofa added after a full last page therefore changes the ETag of
+    that page too, so the client sees the new `next` link, and deleting a sofa
+    changes the stamp even though no modification time moves.
+
+    Args:
+        request: The current request.
+        sofas (list): The sofas of the page, with `id` and `updated_at` loaded.
+        next_url (str): The URL of the next page, or None.
+        catalog_stamp (str): `SofaQuerySet.version_stamp` of the listed sofas.
+
+    Returns:
+        str: The quoted ETag.
+    """
+    digest = hashlib.sha1(request.get_full_path().encode())
+    for sofa in sofas:
+        digest.update(f'{sofa.pk}:{sofa.updated_at.timestamp()};'.encode())
+    digest.update(f'{next_url or ""};{catalog_stamp}'.encode())
+    return f'"{digest.hexdigest()}"'
+
+
+class MatchPagination:
+    """
+    Pagination of ranked matches with a signed continuation token.
+
+    The token carries the matching mode, the query features, the budget and the
+    (score, id) of the last returned match. The next page is the matches ranked
+    after that key, so a follow-up request needs neither the uploaded image nor
+    any server-side session, and pages stay consistent while the catalog changes.
+    """
+    query_param = 'continuation'
+    page_size_query_param = 'page_size'
+    salt = 'couch_management.match-continuation'
+
+    def get_page_size(self, request):
+        page_size = request.GET.get(self.page_size_query_param)
+        if not page_size:
+            return api_settings.PAGE_SIZE
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            raise ValueError("page_size must be an integer.")
+        return max(1, min(page_size, settings.MAX_PAGE_SIZE))
+
+    def decode_token(self, request):
+        """
+        Read the continuation token of a request.
+
+        Returns:
+            dict: The decoded state, or None if the request has no token.
+
+        Raises:
+            ValueError: If the token is invalid or was tampered with.
+        """
+        token = request.GET.get(self.query_param)
+        if not token:
+            return None
+        try:
+            state = signing.loads(token, salt=self.salt)
+        except signing.BadSignature:
+            raise ValueError("Invalid continuation token.")
+
+        features = dict(state['features'])
+        if 'embedding' in features:
+            features['embedding'] = base64.b64decode(features['embedding'])
+        state['features'] = features
+        return state
+
+    def encode_token(self, mode, image_key, budget, features, last_match):
+        if 'embedding' in features:
+            features = {**features, 'embedding': base64.b64encode(features['embedding']).decode('ascii')}
+        state = {
+            'mode': mode,
+            'image_key': image_key,
+            'budget': budget,
+            'features': features,
+            'after': list(last_match),
+        }
+        return signing.dumps(state, salt=self.salt, compress=True)
+
+    def paginate_matches(self, matches, request, mode, image_key, budget, features, after=None):
+        """
+        Return the page of ranked matches that follows `after`.
+
+        Args:
+            matches (list): (sofa id, score) pairs sorted by decreasing score, then id.
+            request: The current request.
+            mode (str): The matching mode.
+            image_key (str): The matching cache key of the uploaded image.
+            budget (float): Maximum price, or None for no limit.
+            features (dict): The query features.
+            after (list): The (score, id) of the last match of the previous page, or None.
+
+        Returns:
+            tuple: The matches of the page and the URL of the next page, or None.
+        """
+        if after is not None:
+            last_score, last_id = after
+            matches = [
+                (sofa_id, score) for sofa_id, score in matches
+                if score < last_score or (score == last_score and sofa_id > last_id)
+            ]
+
+        page_size = self.get_page_size(request)
+        page = matches[:page_size]
+        if len(matches) <= page_size:
+            return page, None
+
+        token = self.encode_token(mode, image_key, budget, features, (page[-1][1], page[-1][0]))
+        return page, replace_query_param(request.build_absolute_uri(), self.query_param, token)
+
+    def get_paginated_response(self, results, next_url):
+        return Response({'next': next_url, 'results': results})
+
+
+def stream_json_array(items):
+    """
+    Encode items as a JSON array piece by piece.
+
+    Args:
+        items (iterable): JSON-serializable items, produced lazily.
+
+    Yields:
+        str: Chunks of the JSON document.
+    """
+    yield '['
+    for position, item in enumerate(items):
+        yield (',' if position else '') + json.dumps(item, cls=JSONEncoder)
+    yield ']'
+
+
+def timed_stream(chunks):
+    """
+    Pass chunks through and record the time spent producing them as the `stream` span.
+
+    A client that disconnects closes the stream early, which is not counted as an error.
+    """
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield from chunks
+    except Exception:
+        failed = True
+        raise
+    finally:
+        record_span('stream', time.perf_counter() - started, failed)
+
+
+def streaming_json_response(items):
+    """
+    Return a response that streams a JSON array while its items are produced.
+
+    The headers, Server-Timing included, are sent before the items are
+    produced. The spans recorded while streaming are the `stream` span, plus
+    the `db` and `serialize` spans of each chunk of matches. They only reach
+    the stage metrics at /metrics, not the Server-Timing header.
+    """
+    return StreamingHttpResponse(timed_stream(stream_json_array(items)), content_type='application/json')
@@ -0,0 +1,136 @@
+import os
+import sys
+
+from django.conf import settings
+
+# Environment variables read by the native thread pools when they start.
+# rembg sizes its onnxruntime sessions from OMP_NUM_THREADS.
+INFERENCE_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']
+
+ML_MODULES = ['tensorflow', 'onnxruntime', 'tflite_runtime', 'rembg', 'cv2']
+
+
+def available_cpus():
+    """
+    Count the CPUs this process may run on.
+
+    Takes the CPU affinity and, in a container, the cgroup CPU quota into
+    account, which os.cpu_count() ignores.
+
+    Returns:
+        int: The number of usable CPUs, at least 1.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as file:
+            quota, period = file.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(int(quota) // int(period), 1))
+    except (OSError, ValueError):
+        pass
+    return max(cpus, 1)
+
+
+def default_worker_count(threads_per_worker=1):
+    """
+    Return how many server worker processes fit the available CPUs.
+
+    Args:
+        threads_per_worker (int): CPU threads each worker uses for inference.
+
+    Returns:
+        int: The number of workers, at least 1.
+    """
+    return max(available_cpus() // max(threads_per_worker, 1), 1)
+
+
+def configure_thread_pools():
+    """
+    Apply the thread count settings to the numeric and ML libraries.
+
+    Must run before TensorFlow, onnxruntime or rembg create their thread pools,
+    which they do when first used. Thread counts set explicitly in the
+    environment take precedence.
+    """
+    if settings.INFERENCE_THREADS:
+        for variable in INFERENCE_THREAD_VARIABLES:
+            os.environ.setdefault(variable, str(settings.INFERENCE_THREADS))
+
+    if settings.BLAS_THREADS:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(settings.BLAS_THREADS, user_api='blas')
+
+
+def configure_opencv(cv2):
+    if settings.OPENCV_THREADS:
+        cv2.setNumThreads(settings.OPENCV_THREADS)
+
+
+def preload_models():
+    """
+    Load the classifier and the rembg session and run one inference through the classifier.
+    """
+    from couch_management.imaging import get_rembg_session
+    from couch_management.keras import get_model_registry
+
+    get_model_registry().warm_up()
+    get_rembg_session()
+
+
+def can_preload_before_fork():
+    """
+    Check whether the models can be loaded in the server's master process and shared with its workers.
+
+    Threads do not survive a fork, so a runtime whose thread pool already
+    exists in the master hangs in the workers. TensorFlow always starts its
+    pools, so the Keras backend is never preloaded; onnxruntime and TFLite only
+    do with more than one inference thread.
+
+    Returns:
+        bool: Whether preloading before the fork is safe.
+    """
+    from couch_management.keras import resolve_inference_backend
+
+    return (
+        settings.INFERENCE_THREADS == 1
+        and resolve_inference_backend(settings.INFERENCE_BACKEND) != 'keras'
+    )
+
+
+def thread_diagnostics():
+    """
+    Report the thread counts and ML runtimes of this process.
+
+    Returns:
+        dict: The CPUs, thread settings, effective thread counts of the loaded
+        libraries and which ML modules are imported.
+    """
+    from threadpoolctl import threadpool_info
+
+    effective = {variable: os.environ.get(variable) for variable in INFERENCE_THREAD_VARIABLES}
+    if 'cv2' in sys.modules:
+        effective['opencv'] = sys.modules['cv2'].getNumThreads()
+    effective['blas'] = [
+        {'library': pool['internal_api'], 'threads': pool['num_threads']}
+        for pool in threadpool_info() if pool['user_api'] == 'blas'
+    ]
+
+    return {
+        'pid': os.getpid(),
+        'available_cpus': available_cpus(),
+        'server_workers': os.environ.get('SERVER_WORKERS'),
+        'settings': {
+            'INFERENCE_THREADS': settings.INFERENCE_THREADS,
+            'OPENCV_THREADS': settings.OPENCV_THREADS,
+            'BLAS_THREADS': settings.BLAS_THREADS,
+            'KERAS_PREPROCESS_WORKERS': settings.KERAS_PREPROCESS_WORKERS,
+            'MATCH_EXECUTOR_WORKERS': settings.MATCH_EXECUTOR_WORKERS,
+            'INFERENCE_BATCHING': settings.INFERENCE_BATCHING,
+        },
+        'effective': effective,
+        'ml_modules_loaded': [name for name in ML_MODULES if name in sys.modules],
+    }
@@ -1,12 +1,18 @@
 from rest_framework import serializers
 
+from couch_management.derivatives import derivative_urls
 from couch_management.models import Sofa
 
 
 class SofaSerializer(serializers.ModelSerializer):
+    image_derivatives = serializers.SerializerMethodField()
+
     class Meta:
         model = Sofa
-        fields = ['name', 'image', 'price', 'original_price', 'quantity', 'discount', 'description']
+        fields = ['name', 'image', 'image_derivatives', 'price', 'original_price', 'quantity', 'discount', 'description']
+
+    def get_image_derivatives(self, obj):
+        return derivative_urls(obj, self.context.get('request'))
     
     def get_image(self, obj):
         request = self.context.get('request')
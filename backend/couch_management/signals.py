@@ -1,20 +1,22 @@
-import os
-from pathlib import Path
-
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from rembg import remove
 
-from couch_management.keras import predict_image_class
-from couch_management.models import Sofa
-from couch_management.utils import get_dominant_color, rgb_to_color_description
+from couch_management.catalog_index import get_catalog_index
+from couch_management.embeddings import get_embedding_index
+from couch_management.features import generate_sofa_features
+from couch_management.jobs import record_failure
+from couch_management.models import CatalogState, Sofa
 
 
 @receiver(post_save, sender=Sofa)
 def generate_features(sender, instance, created, **kwargs):
     """
-    Signal to generate image features for a Sofa instance after it is created.
+    Signal to generate image features for a Sofa instance after it is created or its image is replaced.
+
+    New sofas and sofas with a new image get a pending feature extraction job, which
+    `manage.py run_feature_workers` picks up. With FEATURE_EXTRACTION_ASYNC
+    disabled, the features are generated here before the save returns.
 
     Args:
         sender: The model class sending the signal.
@@ -22,36 +24,50 @@ def generate_features(sender, instance, created, **kwargs):
         created: Boolean indicating if the instance was created.
         kwargs: Additional keyword arguments.
     """
-    if created and instance.image:
+    if (created or instance.image_replaced) and instance.image and not settings.FEATURE_EXTRACTION_ASYNC:
         try:
-            image_path = Path(instance.image.path)
-
-            if image_path.exists():
-                with open(image_path, 'rb') as input_file:
-                    input_data = input_file.read()
-                    output_data = remove(input_data)
-                
-                output_image_path = Path(settings.MEDIA_ROOT) / f"{image_path.stem}_no_bg{image_path.suffix}"
-                with open(output_image_path, 'wb') as output_file:
-                    output_file.write(output_data)
-
-                sofa_type, _ = predict_image_class(output_image_path)
-                dominant_color_rgb = get_dominant_color(str(output_image_path))
-                color_description = rgb_to_color_description(dominant_color_rgb)
-                color_name = color_description.split(" (Hex: ")[0]
-                hex_color = color_description.split(" (Hex: ")[1].split(",")[0]
-
-                features = {
-                    "sofa_type": sofa_type,
-                    "color_name": color_name,
-                    "hex_color": hex_color,
-                    "rgb_color": dominant_color_rgb,
-                }
-
-                Sofa.objects.filter(pk=instance.pk).update(features=features)
-
-                if os.path.exists(output_image_path):
-                    os.remove(output_image_path)
-
+            generate_sofa_features([instance])
         except Exception as e:
+            record_failure(instance, e)
             raise Exception(f"Error generating features for Sofa instance: {e}")
+
+
+@receiver(post_save, sender=Sofa)
+def sync_catalog_index(sender, instance, **kwargs):
+    """
+    Signal to keep this process's catalog and embedding indexes in step with a saved Sofa instance.
+
+    Args:
+        sender: The model class sending the signal.
+        instance: The instance being saved.
+        kwargs: Additional keyword arguments.
+    """
+    get_catalog_index().sync(instance.pk, instance.original_price, instance.features)
+    get_embedding_index().sync(instance.pk, instance.original_price, instance.embedding)
+
+
+@receiver(post_delete, sender=Sofa)
+def remove_from_catalog_index(sender, instance, **kwargs):
+    """
+    Signal to drop a deleted Sofa instance from this process's catalog and embedding indexes.
+
+    Args:
+        sender: The model class sending the signal.
+        instance: The instance being deleted.
+        kwargs: Additional keyword arguments.
+    """
+    get_catalog_index().remove(instance.pk)
+    get_embedding_index().remove(instance.pk)
+
+
+@receiver(post_delete, sender=Sofa)
+def count_deletion(sender, instance, **kwargs):
+    """
+    Signal to count a deleted Sofa instance in the catalog's version stamp.
+
+    Args:
+        sender: The model class sending the signal.
+        instance: The instance being deleted.
+        kwargs: Additional keyword arguments.
+    """
+    CatalogState.record_deletion()
@@ -1,3 +1,689 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from couch_management.catalog_index import CatalogIndex, search_database
+from couch_management.derivatives import render_derivatives
+from couch_management.embeddings import EmbeddingIndex, normalize_embeddings
+from couch_management.feature_store import build_record, pipeline_version, store_features
+from couch_management.features import extract_image_features
+from couch_management.imaging import BackgroundRemovalError, UploadTooLargeError, check_upload_size, decode_upload
+from couch_management.jobs import claim_sofas, record_failure, release_stale_claims
+from couch_management.match_cache import MatchCache
+from couch_management.models import FeatureStatus, ImageFeatures, Sofa
+from couch_management.offload import InFlightLimiter
+from couch_management.pagination import MatchPagination, streaming_json_response
+from couch_management.utils import calculate_sofa_similarity
+from couch_management.views import MatchingMixin
+
+
+def image_file(name='sofa.png', color=(120, 60, 30)):
+    output = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(output, format='PNG')
+    return SimpleUploadedFile(name, output.getvalue(), content_type='image/png')
+
+
+class MediaTestCase(TestCase):
+    """
+    Stores the images of the sofas created by a test in a temporary MEDIA_ROOT.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def create_sofa(self, sofa_type='Sofa', rgb_color=(120, 60, 30), price=500, **kwargs):
+        features = {'sofa_type': sofa_type, 'rgb_color': list(rgb_color)} if sofa_type else None
+        return Sofa.objects.create(
+            name=f'{sofa_type} {rgb_color}', image=image_file(), price=price, features=features, **kwargs
+        )
+
+
+class CatalogIndexTest(MediaTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        for _ in range(60):
+            self.create_sofa(
+                sofa_type=str(rng.choice(['Sofa', 'Sectional', 'Loveseat'])),
+                rgb_color=tuple(int(c) for c in rng.integers(90, 150, size=3)),
+                price=int(rng.integers(100, 1000)),
+            )
+        self.create_sofa(sofa_type=None)
+
+    def old_matches(self, sofa_type, rgb_color, budget=None):
+        """
+        The matching loop the index replaced: every sofa of the type is scored with calculate_sofa_similarity.
+        """
+        sofas = Sofa.objects.filter(features__sofa_type=sofa_type)
+        if budget is not None:
+            sofas = sofas.filter(original_price__lte=budget)
+        matches = []
+        for sofa in sofas:
+            if np.linalg.norm(np.array(rgb_color) - np.array(sofa.features['rgb_color'])) <= 20:
+                matches.append((sofa.pk, calculate_sofa_similarity(sofa_type, rgb_color, sofa)))
+        return sorted(matches, key=lambda match: (-match[1], match[0]))
+
+    def assertSameMatches(self, matches, expected):
+        self.assertEqual([sofa_id for sofa_id, _ in matches], [sofa_id for sofa_id, _ in expected])
+        for (_, score), (_, expected_score) in zip(matches, expected):
+            self.assertAlmostEqual(score, expected_score, places=3)
+
+    def test_search_matches_old_loop(self):
+        index = CatalogIndex()
+        index.build()
+        for sofa_type, rgb_color, budget in [
+            ('Sofa', (120, 120, 120), None),
+            ('Sectional', (100, 130, 110), None),
+            ('Loveseat', (140, 100, 125), 600),
+        ]:
+            with self.subTest(sofa_type=sofa_type, rgb_color=rgb_color, budget=budget):
+                expected = self.old_matches(sofa_type, rgb_color, budget)
+                self.assertTrue(expected)
+                self.assertSameMatches(index.search(sofa_type, rgb_color, budget=budget, color_threshold=20), expected)
+
+    def test_database_search_matches_old_loop(self):
+        for sofa_type, rgb_color, budget in [
+            ('Sofa', (120, 120, 120), None),
+            ('Loveseat', (140, 100, 125), 600),
+        ]:
+            with self.subTest(sofa_type=sofa_type, rgb_color=rgb_color, budget=budget):
+                expected = self.old_matches(sofa_type, rgb_color, budget)
+                self.assertTrue(expected)
+                matches = search_database(sofa_type, rgb_color, budget=budget, color_threshold=20)
+                self.assertSameMatches(matches, expected)
+
+    def test_feature_columns_follow_features(self):
+        sofa = self.create_sofa(rgb_color=(255, 255, 255))
+        self.assertEqual((sofa.sofa_type, sofa.color_red, sofa.color_green, sofa.color_blue), ('Sofa', 255, 255, 255))
+        self.assertAlmostEqual(sofa.lab_l, 100, places=2)
+
+        sofa.features = None
+        sofa.save()
+        sofa.refresh_from_db()
+        self.assertIsNone(sofa.sofa_type)
+        self.assertIsNone(sofa.color_red)
+        self.assertEqual(search_database('Sofa', (255, 255, 255)), [])
+
+    def test_search_limit_keeps_best_matches(self):
+        index = CatalogIndex()
+        index.build()
+        expected = self.old_matches('Sofa', (120, 120, 120))
+        self.assertSameMatches(index.search('Sofa', (120, 120, 120), color_threshold=20, limit=3), expected[:3])
+
+    def test_unknown_type(self):
+        index = CatalogIndex()
+        index.build()
+        self.assertEqual(index.search('Armchair', (120, 120, 120)), [])
+
+    def test_empty_catalog(self):
+        index = CatalogIndex()
+        index.load([])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.search('Sofa', (120, 120, 120)), [])
+
+    def test_sync_and_remove(self):
+        index = CatalogIndex()
+        index.build()
+        sofa = Sofa.objects.filter(sofa_type='Sofa').first()
+        index.sync(sofa.pk, sofa.original_price, {'sofa_type': 'Sofa', 'rgb_color': [10, 10, 10]})
+        self.assertEqual([sofa_id for sofa_id, _ in index.search('Sofa', (10, 10, 10))], [sofa.pk])
+        index.remove(sofa.pk)
+        self.assertEqual(index.search('Sofa', (10, 10, 10)), [])
+
+    def test_reload_keeps_changes_synced_meanwhile(self):
+        index = CatalogIndex()
+        index.build()
+        sofas = Sofa.objects.filter(sofa_type='Sofa').order_by('id')
+        changed, removed = sofas.first(), sofas.last()
+        load = index.load
+
+        def load_after_changes(rows):
+            rows = list(rows)
+            index.sync(changed.pk, changed.original_price, {'sofa_type': 'Sofa', 'rgb_color': [10, 10, 10]})
+            index.remove(removed.pk)
+            load(rows)
+
+        with mock.patch.object(index, 'load', load_after_changes):
+            index.build()
+        self.assertEqual([sofa_id for sofa_id, _ in index.search('Sofa', (10, 10, 10))], [changed.pk])
+        matches = index.search('Sofa', (120, 120, 120), color_threshold=255)
+        self.assertNotIn(removed.pk, [sofa_id for sofa_id, _ in matches])
+        self.assertEqual(len(index), Sofa.objects.exclude(sofa_type=None).count() - 1)
+
+    @override_settings(CATALOG_INDEX_MAX_AGE=1)
+    def test_stale_index_is_reloaded(self):
+        index = CatalogIndex()
+        index.build()
+        sofa = self.create_sofa(rgb_color=(10, 10, 10))
+        self.assertEqual(index.search('Sofa', (10, 10, 10)), [])
+
+        with mock.patch('couch_management.catalog_index.time.monotonic', return_value=index._built_at + 2):
+            self.assertEqual([sofa_id for sofa_id, _ in index.search('Sofa', (10, 10, 10))], [sofa.pk])
+
+
+class FeatureJobTest(MediaTestCase):
+    def test_claim_sofas_takes_due_jobs_once(self):
+        due = self.create_sofa()
+        later = self.create_sofa(features_next_attempt_at=timezone.now() + timedelta(minutes=5))
+        self.create_sofa(features_status=FeatureStatus.DONE)
+
+        self.assertEqual([sofa.pk for sofa in claim_sofas(10)], [due.pk])
+        self.assertEqual(claim_sofas(10), [])
+        due.refresh_from_db()
+        later.refresh_from_db()
+        self.assertEqual(due.features_status, FeatureStatus.PROCESSING)
+        self.assertIsNotNone(due.features_claimed_at)
+        self.assertEqual(later.features_status, FeatureStatus.PENDING)
+
+    def test_claim_sofas_limit(self):
+        sofas = [self.create_sofa() for _ in range(3)]
+        self.assertEqual([sofa.pk for sofa in claim_sofas(2)], [sofa.pk for sofa in sofas[:2]])
+
+    @override_settings(FEATURE_MAX_ATTEMPTS=3, FEATURE_RETRY_BACKOFF=30)
+    def test_record_failure_backs_off_then_fails(self):
+        sofa = self.create_sofa()
+        for attempt, delay in [(1, 30), (2, 60)]:
+            [sofa] = claim_sofas(1)
+            before = timezone.now()
+            with self.assertLogs('couch_management.jobs', 'WARNING'):
+                record_failure(sofa, ValueError('broken image'))
+            sofa.refresh_from_db()
+            self.assertEqual(sofa.features_status, FeatureStatus.PENDING)
+            self.assertEqual(sofa.features_attempts, attempt)
+            self.assertEqual(sofa.features_error, 'broken image')
+            self.assertIsNone(sofa.features_claimed_at)
+            self.assertGreaterEqual(sofa.features_next_attempt_at, before + timedelta(seconds=delay))
+            self.assertLessEqual(sofa.features_next_attempt_at, timezone.now() + timedelta(seconds=delay))
+
+            # Not due before the backoff has passed.
+            self.assertEqual(claim_sofas(1), [])
+            Sofa.objects.filter(pk=sofa.pk).update(features_next_attempt_at=timezone.now())
+
+        [sofa] = claim_sofas(1)
+        with self.assertLogs('couch_management.jobs', 'WARNING'):
+            record_failure(sofa, 'still broken')
+        sofa.refresh_from_db()
+        self.assertEqual(sofa.features_status, FeatureStatus.FAILED)
+        self.assertEqual(sofa.features_attempts, 3)
+        self.assertIsNone(sofa.features_next_attempt_at)
+        self.assertEqual(claim_sofas(1), [])
+
+    @override_settings(FEATURE_CLAIM_TIMEOUT=600)
+    def test_release_stale_claims(self):
+        stale = self.create_sofa(features_status=FeatureStatus.PROCESSING)
+        fresh = self.create_sofa(features_status=FeatureStatus.PROCESSING)
+        Sofa.objects.filter(pk=stale.pk).update(features_claimed_at=timezone.now() - timedelta(seconds=601))
+        Sofa.objects.filter(pk=fresh.pk).update(features_claimed_at=timezone.now())
+
+        self.assertEqual(release_stale_claims(), 1)
+        self.assertEqual([sofa.pk for sofa in claim_sofas(10)], [stale.pk])
+
+
+class EmbeddingIndexTest(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = normalize_embeddings(rng.normal(size=(500, 16)))
+        self.index = EmbeddingIndex(from_database=False)
+        self.index.load(np.arange(500, dtype=np.int64), self.vectors, np.arange(500, dtype=np.float64))
+
+    def test_exact_search(self):
+        expected = np.argsort(-(self.vectors @ self.vectors[7]), kind='stable')[:5].tolist()
+        self.assertEqual([sofa_id for sofa_id, _ in self.index.search(self.vectors[7], limit=5, exact=True)], expected)
+
+    def test_budget(self):
+        matches = self.index.search(self.vectors[7], limit=10, budget=100, exact=True)
+        self.assertTrue(matches)
+        self.assertTrue(all(sofa_id <= 100 for sofa_id, _ in matches))
+
+    @override_settings(CATALOG_INDEX_MAX_AGE=1)
+    def test_standalone_index_is_not_reloaded(self):
+        with mock.patch.object(self.index, 'build') as build, \
+                mock.patch('couch_management.embeddings.time.monotonic', return_value=self.index._built_at + 2):
+            self.assertEqual(self.index.search(self.vectors[7], limit=1, exact=True)[0][0], 7)
+        build.assert_not_called()
+
+
+@override_settings(MATCH_CACHE_ENABLED=True)
+class CatalogVersionTest(MediaTestCase):
+    def test_version_changes_on_save_and_delete(self):
+        match_cache = MatchCache()
+        sofa = self.create_sofa()
+        versions = [match_cache.catalog_version()]
+
+        sofa.price = 450
+        sofa.save()
+        versions.append(match_cache.catalog_version())
+
+        self.create_sofa()
+        versions.append(match_cache.catalog_version())
+
+        sofa.delete()
+        versions.append(match_cache.catalog_version())
+
+        self.assertEqual(len(set(versions)), len(versions))
+        self.assertEqual(match_cache.catalog_version(), versions[-1])
+
+    def test_stale_results_are_not_reused(self):
+        match_cache = MatchCache()
+        match_cache.cache.clear()
+        sofa = self.create_sofa()
+        version = match_cache.catalog_version()
+        match_cache.set_results('color', 'sabc', None, version, [(sofa.pk, 90.0)])
+        self.assertEqual(match_cache.get_results('color', 'sabc', None, version), [(sofa.pk, 90.0)])
+
+        Sofa.objects.filter(pk=sofa.pk).update(updated_at=timezone.now() + timedelta(seconds=1))
+        self.assertIsNone(match_cache.get_results('color', 'sabc', None, match_cache.catalog_version()))
+
+    @override_settings(MATCH_CACHE_ENABLED=False)
+    def test_disabled(self):
+        self.assertIsNone(MatchCache().catalog_version())
+
+
+class MatchPaginationTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.pagination = MatchPagination()
+        self.matches = [(1, 90.0), (4, 80.0), (2, 80.0), (7, 80.0), (3, 50.0)]
+        self.matches.sort(key=lambda match: (-match[1], match[0]))
+        self.features = {'embedding': b'\x00\x01\xfe\xff'}
+
+    def paginate(self, request, after=None):
+        return self.pagination.paginate_matches(
+            self.matches, request, 'embedding', 'sabc', 300.0, self.features, after=after
+        )
+
+    def test_continuation_round_trip(self):
+        request = self.factory.post('/api/sofas/matching/?mode=embedding&page_size=2')
+        pages = []
+        after = None
+        while request is not None:
+            page, next_url = self.paginate(request, after)
+            pages.append(page)
+            if next_url is None:
+                break
+            request = self.factory.post(next_url)
+            state = self.pagination.decode_token(request)
+            self.assertEqual(state['mode'], 'embedding')
+            self.assertEqual(state['image_key'], 'sabc')
+            self.assertEqual(state['budget'], 300.0)
+            self.assertEqual(state['features'], self.features)
+            self.assertEqual(request.GET['page_size'], '2')
+            after = state['after']
+
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([match for page in pages for match in page], self.matches)
+
+    def test_no_token(self):
+        self.assertIsNone(self.pagination.decode_token(self.factory.post('/api/sofas/matching/')))
+
+    def test_tampered_token_is_rejected(self):
+        token = self.pagination.encode_token('color', 'sabc', None, {'sofa_type': 'Sofa'}, (80.0, 2))
+        payload, signature = token.rsplit(':', 1)
+        for tampered in [payload + 'x:' + signature, payload + ':' + signature[::-1], 'not-a-token']:
+            with self.subTest(token=tampered):
+                request = self.factory.post(f'/api/sofas/matching/?continuation={tampered}')
+                with self.assertRaisesMessage(ValueError, "Invalid continuation token."):
+                    self.pagination.decode_token(request)
+
+    def test_streaming_json_response(self):
+        for items in [[], [{'id': 1, 'score': 90.0}, {'id': 2, 'score': 80.5}]]:
+            with self.subTest(items=items):
+                response = streaming_json_response(iter(items))
+                self.assertEqual(json.loads(b''.join(response.streaming_content)), items)
+
+    def test_page_size_is_bounded(self):
+        with override_settings(MAX_PAGE_SIZE=3):
+            self.assertEqual(self.pagination.get_page_size(self.factory.get('/?page_size=100')), 3)
+        self.assertEqual(self.pagination.get_page_size(self.factory.get('/?page_size=0')), 1)
+        with self.assertRaises(ValueError):
+            self.pagination.get_page_size(self.factory.get('/?page_size=many'))
+
+
+class SofaListETagTest(MediaTestCase):
+    def setUp(self):
+        self.sofas = [self.create_sofa() for _ in range(3)]
+        self.url = reverse('sofa-list') + '?page_size=2'
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_on_edit(self):
+        etag = self.client.get(self.url)['ETag']
+        sofa = self.sofas[0]
+        sofa.name = 'Renamed'
+        sofa.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['results'][0]['name'], 'Renamed')
+
+    def test_etag_of_other_page_changes_on_delete(self):
+        # The second page holds only the third sofa; deleting a sofa of the first page changes its ETag too.
+        next_url = self.client.get(self.url).json()['next']
+        etag = self.client.get(next_url)['ETag']
+        self.sofas[0].delete()
+        self.assertEqual(self.client.get(next_url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_etag_changes_when_page_gets_a_next_link(self):
+        url = reverse('sofa-list') + '?page_size=3'
+        response = self.client.get(url)
+        self.assertIsNone(response.json()['next'])
+        etag = response['ETag']
+
+        self.create_sofa()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.json()['next'])
+
+    def test_no_full_table_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertFalse([query['sql'] for query in queries if 'COUNT(' in query['sql'].upper()])
+
+    def test_deletions_are_counted_by_any_process(self):
+        stamp = Sofa.objects.version_stamp()
+        Sofa.objects.filter(pk=self.sofas[-1].pk).delete()
+        self.assertNotEqual(Sofa.objects.version_stamp(), stamp)
+
+
+class MatchingBackpressureTest(TestCase):
+    def busy_limiter(self):
+        limiter = InFlightLimiter(1)
+        limiter.acquire()
+        return limiter
+
+    def test_busy_worker_rejects_matches(self):
+        for name in ['sofa-matching', 'sofa-matching-async']:
+            with self.subTest(name=name), \
+                    mock.patch('couch_management.views.get_match_limiter', return_value=self.busy_limiter()):
+                response = self.client.post(reverse(name), {'image': image_file()})
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response['Retry-After'], str(settings.MATCH_RETRY_AFTER))
+
+    def test_limiter_is_released(self):
+        limiter = InFlightLimiter(1)
+        with mock.patch('couch_management.views.get_match_limiter', return_value=limiter):
+            self.assertEqual(self.client.post(reverse('sofa-matching')).status_code, 200)
+            self.assertEqual(self.client.post(reverse('sofa-matching-async')).status_code, 400)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_async_upload_is_read_off_the_event_loop(self):
+        threads = []
+        read_upload = MatchingMixin.read_upload
+
+        def record_thread(view, request):
+            threads.append(threading.current_thread().name)
+            return read_upload(view, request)
+
+        with mock.patch.object(MatchingMixin, 'read_upload', record_thread), \
+                mock.patch.object(MatchingMixin, 'resolve_query', side_effect=BackgroundRemovalError('unavailable')):
+            response = self.client.post(reverse('sofa-matching-async'), {'image': image_file()})
+        self.assertEqual(response.status_code, 402)
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('match'))
+
+
+class DerivativesTest(TestCase):
+    def encode(self, image, image_format, **kwargs):
+        output = io.BytesIO()
+        image.save(output, format=image_format, **kwargs)
+        return output.getvalue()
+
+    def decode(self, data):
+        with Image.open(io.BytesIO(data)) as image:
+            return image.convert('RGB')
+
+    def test_sizes(self):
+        rendered = render_derivatives(self.encode(Image.new('RGB', (1600, 800), (120, 60, 30)), 'JPEG'))
+        self.assertEqual(set(rendered), set(settings.IMAGE_DERIVATIVES))
+        for name, (size, _) in settings.IMAGE_DERIVATIVES.items():
+            self.assertEqual(self.decode(rendered[name][0]).size, (size, size // 2))
+
+    def test_exif_orientation_is_applied(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90 degrees clockwise.
+        data = self.encode(Image.new('RGB', (400, 200), (120, 60, 30)), 'JPEG', exif=exif.tobytes())
+
+        for name, (content, _) in render_derivatives(data).items():
+            with self.subTest(name=name):
+                width, height = self.decode(content).size
+                self.assertEqual(height, 2 * width)
+
+    def test_transparency_becomes_white(self):
+        for mode, color in [('RGBA', (0, 0, 0, 0)), ('LA', (0, 0))]:
+            with self.subTest(mode=mode):
+                rendered = render_derivatives(self.encode(Image.new(mode, (64, 64), color), 'PNG'))
+                for content, _ in rendered.values():
+                    self.assertTrue(all(channel >= 250 for channel in self.decode(content).getpixel((32, 32))))
+
+
+class UploadSizeTest(TestCase):
+    @override_settings(UPLOAD_MAX_BYTES=1024)
+    def test_check_upload_size(self):
+        check_upload_size(1024)
+        with self.assertRaises(UploadTooLargeError):
+            check_upload_size(1025)
+
+    @override_settings(UPLOAD_MAX_BYTES=0)
+    def test_unlimited(self):
+        check_upload_size(10 ** 9)
+
+    @override_settings(UPLOAD_MAX_BYTES=1024)
+    def test_matching_endpoint_rejects_large_upload(self):
+        upload = SimpleUploadedFile('large.png', b'\x00' * 2048, content_type='image/png')
+        response = self.client.post(reverse('sofa-matching'), {'image': upload})
+        self.assertEqual(response.status_code, 413)
+
+    @override_settings(UPLOAD_MAX_PIXELS=10_000)
+    def test_pixel_limit_is_checked_before_decoding(self):
+        data = image_file(color=(0, 0, 0)).read()
+        self.assertEqual(decode_upload(data).shape, (8, 8, 3))
+        output = io.BytesIO()
+        Image.new('RGB', (200, 100)).save(output, format='PNG')
+        with self.assertRaises(UploadTooLargeError):
+            decode_upload(output.getvalue())
+
+    @override_settings(UPLOAD_WORKING_SIZE=64)
+    def test_upload_is_downscaled(self):
+        output = io.BytesIO()
+        Image.new('RGB', (400, 200), (120, 60, 30)).save(output, format='JPEG')
+        self.assertEqual(decode_upload(output.getvalue()).shape, (32, 64, 3))
+
+
+@override_settings(FEATURE_STORE_ENABLED=True)
+class FeatureStoreTest(TestCase):
+    def test_stored_features_skip_the_pipeline(self):
+        data = b'encoded image'
+        digest = hashlib.sha256(data).hexdigest()
+        store_features([build_record(
+            digest, 'Sofa', 0.9, [((120, 60, 30), 0.7), ((10, 10, 10), 0.3)], b'\x00\x3c' * 4,
+            np.full((4, 4), 255, dtype=np.uint8),
+        )])
+
+        def decode(data):
+            raise AssertionError('stored images must not be decoded')
+
+        with mock.patch('couch_management.features.predict_image_classes') as predict:
+            records = extract_image_features([(digest, data)], decode=decode)
+        predict.assert_not_called()
+
+        record = records[digest]
+        self.assertEqual(record.pipeline_version, pipeline_version())
+        self.assertEqual(record.sofa_type, 'Sofa')
+        self.assertEqual(record.dominant_color, (120, 60, 30))
+
+    @override_settings(FEATURE_STORE_ENABLED=False)
+    def test_disabled_store_is_not_consulted(self):
+        data = b'encoded image'
+        digest = hashlib.sha256(data).hexdigest()
+        with self.settings(FEATURE_STORE_ENABLED=True):
+            store_features([build_record(
+                digest, 'Sofa', 0.9, [((120, 60, 30), 1.0)], b'\x00\x3c' * 4, np.zeros((4, 4), dtype=np.uint8),
+            )])
+
+        def decode(data):
+            raise ValueError('decoded')
+
+        with self.assertRaisesMessage(ValueError, 'decoded'):
+            extract_image_features([(digest, data)], decode=decode)
+
+    def extract(self, store):
+        data = image_file(color=(0, 0, 200)).read()
+        digest = hashlib.sha256(data).hexdigest()
+        cutout = np.zeros((8, 8, 4), dtype=np.uint8)
+        cutout[...] = (0, 0, 200, 255)
+        with mock.patch('couch_management.features.remove_background', return_value=cutout), \
+                mock.patch('couch_management.features.predict_image_classes',
+                           return_value=([('Sofa', 0.9)], np.ones((1, 8), dtype=np.float32))):
+            record = extract_image_features([(digest, data)], store=store)[digest]
+        self.assertEqual(record.sofa_type, 'Sofa')
+        self.assertEqual(record.dominant_color, (0, 0, 200))
+        return digest
+
+    def test_computed_features_are_stored(self):
+        digest = self.extract(store=True)
+        self.assertTrue(ImageFeatures.objects.filter(digest=digest, pipeline_version=pipeline_version()).exists())
+
+    def test_query_features_are_not_stored(self):
+        self.extract(store=False)
+        self.assertFalse(ImageFeatures.objects.exists())
+
+
+class ReprocessFeaturesTest(MediaTestCase):
+    def test_dry_run_counts(self):
+        version = pipeline_version()
+        for _ in range(2):
+            self.create_sofa(features_status=FeatureStatus.DONE, features_version='0' * 16)
+        for _ in range(3):
+            self.create_sofa(features_status=FeatureStatus.DONE)
+        self.create_sofa(features_status=FeatureStatus.DONE, features_version=version)
+        self.create_sofa(features_status=FeatureStatus.PENDING, features_version='0' * 16)
+
+        output = io.StringIO()
+        with mock.patch('couch_management.management.commands.reprocess_features.reprocess_sofas') as reprocess:
+            call_command('reprocess_features', dry_run=True, stdout=output)
+        reprocess.assert_not_called()
+
+        self.assertIn(
+            f'Pipeline version {version}: 2 sofas have features of an older version, 3 have unversioned features\n',
+            output.getvalue(),
+        )
+        self.assertIn('5 sofas would be reprocessed', output.getvalue())
+
+    def test_dry_run_verify_images(self):
+        version = pipeline_version()
+        changed = self.create_sofa(features_status=FeatureStatus.DONE, features_version=version, image_hash='0' * 64)
+        with changed.image.open('rb') as image:
+            current = hashlib.sha256(image.read()).hexdigest()
+        self.create_sofa(features_status=FeatureStatus.DONE, features_version=version, image_hash=current)
+
+        output = io.StringIO()
+        call_command('reprocess_features', dry_run=True, verify_images=True, stdout=output)
+        self.assertIn('0 have unversioned features and 1 have a changed image', output.getvalue())
+        self.assertIn('1 sofas would be reprocessed', output.getvalue())
+
+    def test_replaced_image_is_queued_again(self):
+        sofa = self.create_sofa(features_status=FeatureStatus.DONE, features_version=pipeline_version())
+        sofa.image = image_file('replaced.png', color=(0, 0, 0))
+        sofa.save()
+        sofa.refresh_from_db()
+        self.assertEqual(sofa.features_status, FeatureStatus.PENDING)
+        self.assertEqual(sofa.features_attempts, 0)
+
+
+class FakeRegistry:
+    labels = ['Sofa', 'Couch']
+
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, data):
+        self.calls.append(('predict', len(data)))
+        return np.tile([0.25, 0.75], (len(data), 1))
+
+    def predict_with_embeddings(self, data):
+        self.calls.append(('predict_with_embeddings', len(data)))
+        return np.tile([0.25, 0.75], (len(data), 1)), np.ones((len(data), 4), dtype=np.float32)
+
+
+@override_settings(INFERENCE_BATCHING=True, INFERENCE_BATCH_MAX_WAIT_MS=0, INFERENCE_BATCH_TIMEOUT_MS=2000)
+class InferenceBatchingTest(TestCase):
+    def setUp(self):
+        self.registry = FakeRegistry()
+        patches = [
+            mock.patch('couch_management.keras.get_model_registry', return_value=self.registry),
+            mock.patch('couch_management.keras._batcher', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.image = np.zeros((8, 8, 3), dtype=np.uint8)
+
+    def test_embeddings_only_when_requested(self):
+        from couch_management.keras import predict_image_classes
+
+        self.assertEqual(predict_image_classes([self.image], micro_batch=True), [('Couch', 0.75)])
+        self.assertEqual(self.registry.calls, [('predict', 1)])
+
+        _, embeddings = predict_image_classes([self.image], return_embeddings=True, micro_batch=True)
+        self.assertEqual(embeddings.shape, (1, 4))
+        self.assertEqual(self.registry.calls[-1], ('predict_with_embeddings', 1))
+
+    def test_only_single_query_images_are_micro_batched(self):
+        from couch_management import keras
+
+        with mock.patch('couch_management.keras.predict_micro_batched') as micro_batched:
+            keras.predict_image_classes([self.image] * 3, micro_batch=True)
+            keras.predict_image_classes([self.image])
+        micro_batched.assert_not_called()
+        self.assertEqual(self.registry.calls, [('predict', 3), ('predict', 1)])
+
+    @override_settings(INFERENCE_BATCH_TIMEOUT_MS=50)
+    def test_timeout_falls_back_to_direct_prediction(self):
+        from couch_management import keras
+
+        release = threading.Event()
+
+        def wedged(items):
+            release.wait()
+            return [(np.zeros(2), None)] * len(items)
+
+        stuck = keras.MicroBatcher('stuck', wedged, max_batch_size=1, max_wait=0)
+        with mock.patch('couch_management.keras.get_inference_batcher', return_value=stuck):
+            prediction, embeddings = keras.predict_micro_batched(np.zeros((1, 224, 224, 3)), return_embeddings=True)
+        release.set()
+        self.assertEqual(prediction.shape, (1, 2))
+        self.assertEqual(embeddings.shape, (1, 4))
+        self.assertEqual(self.registry.calls, [('predict_with_embeddings', 1)])
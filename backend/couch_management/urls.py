@@ -1,8 +1,14 @@
 from django.urls import path
 
-from couch_management.views import SofaFilterAPIView, SofaListView
+from couch_management.views import (AsyncSofaFilterView, DiagnosticsView,
+                                     MetricsView, ReadinessView,
+                                     SofaFilterAPIView, SofaListView)
 
 urlpatterns = [
     path('api/sofas/', SofaListView.as_view(), name='sofa-list'),
     path('api/sofas/matching/', SofaFilterAPIView.as_view(), name='sofa-matching'),
+    path('api/sofas/matching/async/', AsyncSofaFilterView.as_view(), name='sofa-matching-async'),
+    path('api/health/ready/', ReadinessView.as_view(), name='health-ready'),
+    path('api/health/diagnostics/', DiagnosticsView.as_view(), name='health-diagnostics'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
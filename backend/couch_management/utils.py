@@ -1,6 +1,15 @@
-import cv2
+import functools
+import os
+from collections import namedtuple
+
 import numpy as np
 import webcolors
+from django.conf import settings
+
+from couch_management.lazy import lazy_import
+from couch_management.runtime import configure_opencv
+
+cv2 = lazy_import('cv2', on_import=configure_opencv)
 
 
 def calculate_original_price(price, discount):
@@ -17,93 +26,333 @@ def calculate_original_price(price, discount):
     return price - (price * discount / 100)
 
 
-def get_dominant_color(image_path, k=3):
+def load_rgb_image(image):
     """
-    Detect the dominant color in an image while ignoring transparent or white background.
+    Load an image as an RGB or RGBA array.
 
     Args:
-        image_path (str): Path to the input image.
-        k (int): Number of clusters for K-means.
+        image (str | np.ndarray): Path to the image, or an RGB/RGBA uint8 array which is returned as is.
 
     Returns:
-        tuple: The dominant color in RGB format.
+        np.ndarray: The image in RGB (or RGBA if it has transparency) channel order.
     """
-    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if isinstance(image, np.ndarray):
+        return image
+
+    image_path = str(image)
+    bgr_image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
 
-    if image is None:
+    if bgr_image is None:
         raise ValueError(f"Image at path '{image_path}' could not be loaded.")
 
+    if bgr_image.ndim == 3 and bgr_image.shape[2] == 4:
+        return cv2.cvtColor(bgr_image, cv2.COLOR_BGRA2RGBA)
+    return cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
+
+
+def get_foreground_pixels(image, max_pixels=None):
+    """
+    Collect the foreground pixels of an image, ignoring transparent or white background.
+
+    Args:
+        image (str | np.ndarray): Path to the input image, or an RGB/RGBA uint8 array.
+        max_pixels (int): If set, the image is sampled on a regular grid so that at most
+            about this many pixels are examined.
+
+    Returns:
+        np.ndarray: An (N, 3) uint8 array of RGB pixels.
+    """
+    image = load_rgb_image(image)
+
+    if max_pixels:
+        height, width = image.shape[:2]
+        step = int(np.ceil(np.sqrt(height * width / max_pixels)))
+        if step > 1:
+            image = image[::step, ::step]
+
     if image.shape[2] == 4:
-        bgr, alpha = image[:, :, :3], image[:, :, 3]
+        rgb_image, alpha = image[:, :, :3], image[:, :, 3]
         mask = alpha > 0
     else:
-        bgr = image
-        mask = np.all(bgr != [255, 255, 255], axis=-1)
+        rgb_image = image
+        mask = np.all(rgb_image != [255, 255, 255], axis=-1)
 
-    rgb_image = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
     sofa_pixels = rgb_image[mask]
 
     if sofa_pixels.size == 0:
         raise ValueError("No sofa pixels found. Ensure the sofa is present in the image.")
 
-    sofa_pixels = np.float32(sofa_pixels)
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
-    _, labels, palette = cv2.kmeans(sofa_pixels, k, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+    return sofa_pixels
 
-    _, counts = np.unique(labels, return_counts=True)
 
-    dominant_color = palette[np.argmax(counts)]
+def _weighted_kmeans(points, weights, k, seed, iterations=20):
+    """
+    Cluster weighted points with k-means++ initialization from a seeded generator.
 
-    return tuple(map(int, dominant_color))
+    Returns:
+        tuple: The (k, 3) cluster centers and the cluster label of each point.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(points))
+
+    centers = [points[rng.choice(len(points), p=weights / weights.sum())]]
+    for _ in range(1, k):
+        distances = ((points[:, np.newaxis, :] - np.array(centers)[np.newaxis]) ** 2).sum(axis=-1).min(axis=1)
+        probabilities = weights * distances
+        if probabilities.sum() == 0:
+            break
+        centers.append(points[rng.choice(len(points), p=probabilities / probabilities.sum())])
+    centers = np.array(centers)
+
+    for _ in range(iterations):
+        labels = ((points[:, np.newaxis, :] - centers[np.newaxis]) ** 2).sum(axis=-1).argmin(axis=1)
+        cluster_weights = np.bincount(labels, weights=weights, minlength=len(centers))
+        new_centers = centers.copy()
+        for channel in range(points.shape[1]):
+            channel_sums = np.bincount(labels, weights=weights * points[:, channel], minlength=len(centers))
+            np.divide(channel_sums, cluster_weights, out=new_centers[:, channel], where=cluster_weights > 0)
+        converged = np.abs(new_centers - centers).max() < 0.5
+        centers = new_centers
+        if converged:
+            break
+
+    labels = ((points[:, np.newaxis, :] - centers[np.newaxis]) ** 2).sum(axis=-1).argmin(axis=1)
+    return centers, labels
+
+
+def _histogram_palette(pixels, k, bits, seed):
+    """
+    Quantize pixels into a `bits`-per-channel color histogram and cluster the occupied bins.
 
+    Each bin is represented by the mean color of its pixels, so the quantization only
+    limits how pixels are grouped, not the precision of the resulting colors.
+    """
+    pixels = pixels.astype(np.int64)
+    quantized = pixels >> (8 - bits)
+    bins = (quantized[:, 0] << (2 * bits)) | (quantized[:, 1] << bits) | quantized[:, 2]
 
-def closest_css3_color(rgb_color):
+    counts = np.bincount(bins, minlength=1 << (3 * bits))
+    occupied = np.flatnonzero(counts)
+    weights = counts[occupied].astype(np.float64)
+    bin_colors = np.stack(
+        [np.bincount(bins, weights=pixels[:, channel], minlength=len(counts))[occupied] for channel in range(3)],
+        axis=1,
+    ) / weights[:, np.newaxis]
+
+    centers, labels = _weighted_kmeans(bin_colors, weights, k, seed)
+    proportions = np.bincount(labels, weights=weights, minlength=len(centers)) / weights.sum()
+    return centers, proportions
+
+
+def _kmeans_palette(pixels, k, seed, attempts=3):
     """
-    Find the closest CSS3 color name for a given RGB color.
+    Cluster pixels with OpenCV k-means using k-means++ centers and a fixed RNG seed.
+    """
+    k = min(k, len(pixels))
+    cv2.setRNGSeed(seed)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.5)
+    _, labels, centers = cv2.kmeans(np.float32(pixels), k, None, criteria, attempts, cv2.KMEANS_PP_CENTERS)
+    counts = np.bincount(labels.ravel(), minlength=k)
+    return centers, counts / counts.sum()
+
+
+def get_color_palette(image, k=3, method=None, max_pixels=None, bits=5, seed=0):
+    """
+    Extract the main colors of an image while ignoring transparent or white background.
+
+    The result is deterministic for a given image and settings.
+
+    Args:
+        image (str | np.ndarray): Path to the input image, or an RGB/RGBA uint8 array.
+        k (int): Number of colors to extract.
+        method (str): "histogram" clusters a quantized color histogram, "kmeans" clusters
+            the sampled pixels. Defaults to settings.DOMINANT_COLOR_METHOD.
+        max_pixels (int): Approximate number of pixels sampled from the image.
+            Defaults to settings.DOMINANT_COLOR_MAX_PIXELS, 0 uses every pixel.
+        bits (int): Bits per channel of the histogram used by the "histogram" method.
+        seed (int): Seed for the cluster initialization.
+
+    Returns:
+        list: (RGB tuple, proportion) pairs sorted by decreasing proportion.
+    """
+    method = method or settings.DOMINANT_COLOR_METHOD
+    max_pixels = settings.DOMINANT_COLOR_MAX_PIXELS if max_pixels is None else max_pixels
+
+    sofa_pixels = get_foreground_pixels(image, max_pixels=max_pixels)
+
+    if method == "histogram":
+        centers, proportions = _histogram_palette(sofa_pixels, k, bits, seed)
+    elif method == "kmeans":
+        centers, proportions = _kmeans_palette(sofa_pixels, k, seed)
+    else:
+        raise ValueError(f"Unknown color extraction method '{method}'.")
+
+    order = np.argsort(-proportions, kind="stable")
+    return [
+        (tuple(int(round(channel)) for channel in centers[index]), float(proportions[index]))
+        for index in order
+        if proportions[index] > 0
+    ]
+
+
+def get_dominant_color(image, k=3):
+    """
+    Detect the dominant color in an image while ignoring transparent or white background.
+
+    Args:
+        image (str | np.ndarray): Path to the input image, or an RGB/RGBA uint8 array.
+        k (int): Number of color clusters.
+
+    Returns:
+        tuple: The dominant color in RGB format.
+    """
+    return get_color_palette(image, k=k)[0][0]
+
+
+def rgb_to_lab(rgb_color):
+    """
+    Convert an sRGB color to CIE L*a*b* (D65 white point).
 
     Args:
         rgb_color (tuple): The RGB color (R, G, B).
 
     Returns:
-        str: The closest CSS3 color name.
+        tuple: The (L*, a*, b*) color.
     """
-    min_distance = float('inf')
-    closest_name = None
+    rgb = np.asarray(rgb_color, dtype=np.float64) / 255.0
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = np.array([
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]) @ linear / np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return (float(116 * f[1] - 16), float(500 * (f[0] - f[1])), float(200 * (f[1] - f[2])))
+
+
+ColorDescription = namedtuple('ColorDescription', ['name', 'hex', 'rgb'])
+
+CSS3_LUT_BITS = 6
+
 
+@functools.lru_cache(maxsize=None)
+def get_css3_palette():
+    """
+    Build the CSS3 color palette once per process.
+
+    Returns:
+        tuple: The color names and an (N, 3) int32 array of their RGB values, in the same order.
+    """
+    names = []
+    colors = []
     for name in webcolors.names():
         try:
-            r_c, g_c, b_c = webcolors.name_to_rgb(name)
-            distance = ((r_c - rgb_color[0]) ** 2 +
-                        (g_c - rgb_color[1]) ** 2 +
-                        (b_c - rgb_color[2]) ** 2)**0.5
-            if distance < min_distance:
-                min_distance = distance
-                closest_name = name
+            colors.append(tuple(webcolors.name_to_rgb(name)))
+            names.append(name)
         except ValueError:
             continue
+    return tuple(names), np.array(colors, dtype=np.int32)
 
-    return closest_name
 
+def _nearest_palette_indices(rgb_colors, palette):
+    """
+    Return the index of the nearest palette color for each row of an (N, 3) array.
+    """
+    distances = ((rgb_colors[:, np.newaxis, :] - palette[np.newaxis]) ** 2).sum(axis=-1)
+    return distances.argmin(axis=1)
 
-def rgb_to_color_description(rgb_color):
+
+@functools.lru_cache(maxsize=None)
+def get_css3_lut():
     """
-    Convert an RGB color to a human-readable description (name and hex).
+    Load or build the quantized RGB to CSS3 name lookup table.
+
+    The table maps each cell of a CSS3_LUT_BITS-per-channel RGB grid to the palette
+    color nearest to the cell center. It is cached at settings.CSS3_COLOR_LUT_PATH.
+
+    Returns:
+        np.ndarray: A (2**bits, 2**bits, 2**bits) array of palette indices.
+    """
+    names, palette = get_css3_palette()
+    lut_path = settings.CSS3_COLOR_LUT_PATH
+    # np.savez appends .npz to other paths, so the cache would never be found.
+    if not lut_path.endswith('.npz'):
+        lut_path += '.npz'
+
+    if os.path.exists(lut_path):
+        with np.load(lut_path) as cached:
+            if tuple(cached['names']) == names and cached['lut'].shape[0] == 1 << CSS3_LUT_BITS:
+                return cached['lut']
+
+    size = 1 << CSS3_LUT_BITS
+    centers = (np.arange(size, dtype=np.int32) << (8 - CSS3_LUT_BITS)) + (1 << (7 - CSS3_LUT_BITS))
+    lut = np.empty((size, size, size), dtype=np.uint8)
+    for red_index, red in enumerate(centers):
+        green, blue = np.meshgrid(centers, centers, indexing='ij')
+        cells = np.stack([np.full(green.size, red), green.ravel(), blue.ravel()], axis=1)
+        lut[red_index] = _nearest_palette_indices(cells, palette).reshape(size, size)
+
+    os.makedirs(os.path.dirname(lut_path) or '.', exist_ok=True)
+    np.savez(lut_path, names=np.array(names), lut=lut)
+    return lut
+
+
+def closest_css3_color(rgb_color):
+    """
+    Find the closest CSS3 color name for a given RGB color.
+
+    Uses the cached lookup table when settings.CSS3_COLOR_LUT_PATH is set,
+    otherwise an exact nearest-neighbour search over the palette.
 
     Args:
         rgb_color (tuple): The RGB color (R, G, B).
 
     Returns:
-        str: A description of the color (name and hex code).
+        str: The closest CSS3 color name.
     """
+    names, palette = get_css3_palette()
+
+    if settings.CSS3_COLOR_LUT_PATH:
+        red, green, blue = (int(channel) >> (8 - CSS3_LUT_BITS) for channel in rgb_color)
+        return names[get_css3_lut()[red, green, blue]]
+
+    rgb_color = np.asarray(rgb_color, dtype=np.int32).reshape(1, 3)
+    return names[_nearest_palette_indices(rgb_color, palette)[0]]
+
+
+def describe_color(rgb_color):
+    """
+    Describe an RGB color with its CSS3 name and hex code.
+
+    Args:
+        rgb_color (tuple): The RGB color (R, G, B).
+
+    Returns:
+        ColorDescription: The color name, the hex code of the named color and the input RGB color.
+    """
+    rgb_color = tuple(int(channel) for channel in rgb_color)
     try:
-      color_name = webcolors.rgb_to_name(rgb_color)
-      hex_color = webcolors.rgb_to_hex(rgb_color)
+        color_name = webcolors.rgb_to_name(rgb_color)
+        hex_color = webcolors.rgb_to_hex(rgb_color)
     except ValueError:
-      color_name = closest_css3_color(rgb_color)
-      hex_color = webcolors.name_to_hex(color_name)
+        color_name = closest_css3_color(rgb_color)
+        hex_color = webcolors.name_to_hex(color_name)
+
+    return ColorDescription(color_name, hex_color, rgb_color)
+
+
+def rgb_to_color_description(rgb_color):
+    """
+    Convert an RGB color to a human-readable description (name and hex).
 
-    return f"{color_name} (Hex: {hex_color}, RGB: {rgb_color})"
+    Args:
+        rgb_color (tuple): The RGB color (R, G, B).
 
+    Returns:
+        str: A description of the color (name and hex code).
+    """
+    description = describe_color(rgb_color)
+    return f"{description.name} (Hex: {description.hex}, RGB: {description.rgb})"
 
 
 def calculate_color_similarity(rgb1, rgb2):
@@ -1,51 +1,316 @@
-
-import os
-
 from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from drf_spectacular.utils import OpenApiParameter, extend_schema
-from rembg import remove
-import io
 from rest_framework import generics, status
 from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 
-from couch_management.keras import predict_image_class
+from couch_management.catalog_index import search_catalog
+from couch_management.embeddings import decode_embedding, get_embedding_index
+from couch_management.features import extract_image_features
+from couch_management.imaging import (BackgroundRemovalError,
+                                      UploadTooLargeError, check_upload_size,
+                                      decode_upload, is_rembg_session_loaded)
+from couch_management.keras import get_model_registry, is_model_ready
+from couch_management.match_cache import content_hash, get_match_cache
+from couch_management.metrics import render_metrics, span
 from couch_management.models import Sofa
+from couch_management.offload import get_match_limiter, run_in_match_executor
+from couch_management.pagination import (MatchPagination,
+                                         SofaCursorPagination,
+                                         page_etag,
+                                         streaming_json_response)
+from couch_management.runtime import thread_diagnostics
 from couch_management.serializers import SofaSerializer
-from couch_management.utils import (calculate_sofa_similarity,
-                                    get_dominant_color)
 
-import numpy as np
+# Number of sofas read and serialized at a time when streaming results.
+STREAM_CHUNK_SIZE = 500
 
-def calculate_color_distance(color1, color2):
-    """
-    Calculate the Euclidean distance between two colors in RGB space.
-    """
-    color1 = np.array(color1)
-    color2 = np.array(color2)
-    return np.linalg.norm(color1 - color2)
+# Allowance for the multipart boundaries and headers around an uploaded image.
+MULTIPART_OVERHEAD = 16 * 1024
+
+BACKGROUND_REMOVAL_FAILED = "Background removal failed. Please check the API or payment status."
 
 
 class SofaListView(generics.ListAPIView):
     """
     View to list all sofas with pagination.
+
+    Pages are read with keyset pagination and only the serialized columns. Each
+    page carries an ETag, so clients and HTTP caches can revalidate it and get
+    a 304 without the page being serialized again. There is no Last-Modified:
+    no modification time reflects a deleted sofa.
     """
-    queryset = Sofa.objects.all()
+    queryset = Sofa.objects.only('id', 'updated_at', *SofaSerializer.Meta.fields)
     serializer_class = SofaSerializer
+    pagination_class = SofaCursorPagination
+
+    def list(self, request, *args, **kwargs):
+        sofas = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(sofas)
+        etag = page_etag(request, page, self.paginator.get_next_link(), sofas.version_stamp())
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+class ReadinessView(APIView):
+    """
+    Readiness probe for load balancers.
+
+    Returns 200 once the classifier is loaded and warmed up in this worker, 503 otherwise.
+    The response also reports this worker's matching cache hits and misses.
+    """
+
+    @extend_schema(
+        summary="Check whether this worker is ready to serve matching requests",
+        responses={200: "Worker is ready", 503: "Classifier is not loaded yet"},
+    )
+    def get(self, request, *args, **kwargs):
+        match_cache = get_match_cache().stats()
+        if is_model_ready():
+            return Response({"status": "ready", "match_cache": match_cache})
+        return Response({"status": "loading", "match_cache": match_cache}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class DiagnosticsView(APIView):
+    """
+    Reports the CPUs, thread pool sizes, inference backend and loaded ML runtimes of this worker.
+    """
+
+    @extend_schema(
+        summary="Report the thread and model configuration of this worker",
+        responses={200: "Thread counts, inference backend and loaded ML modules"},
+    )
+    def get(self, request, *args, **kwargs):
+        registry = get_model_registry()
+        return Response({
+            **thread_diagnostics(),
+            "server": request.META.get('SERVER_SOFTWARE'),
+            "inference_backend": registry.backend.name if is_model_ready() else None,
+            "classifier_ready": is_model_ready(),
+            "rembg_session_loaded": is_rembg_session_loaded(),
+        })
 
 
-class SofaFilterAPIView(APIView):
+class MetricsView(View):
+    """
+    Prometheus metrics of this worker: request counts and latencies per view,
+    pipeline stage latencies and errors, and matching cache lookups.
+    """
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MatchingMixin:
+    """
+    The matching pipeline shared by the synchronous and asynchronous matching views.
+    """
+
+    def check_request_size(self, request):
+        """
+        Reject an oversized upload from its Content-Length, before the request body is parsed.
+
+        Raises:
+            UploadTooLargeError: If the request body is larger than an allowed upload.
+        """
+        check_upload_size(int(request.META.get('CONTENT_LENGTH') or 0) - MULTIPART_OVERHEAD)
+
+    def busy_response(self, response_class):
+        """
+        Return the 503 response of a request rejected by the in-flight limiter of matching requests.
+
+        Args:
+            response_class: Response or JsonResponse.
+        """
+        response = response_class({"error": "Too many images are being matched. Please retry shortly."}, status=503)
+        response['Retry-After'] = str(settings.MATCH_RETRY_AFTER)
+        return response
+
+    def read_upload(self, request):
+        """
+        Parse the request body and read the uploaded image.
+
+        Returns:
+            bytes: The encoded image, or None if the request has no image.
+
+        Raises:
+            UploadTooLargeError: If the image is larger than an allowed upload.
+        """
+        image_file = request.FILES.get('image', None)
+        if image_file is None:
+            return None
+        check_upload_size(image_file.size)
+        with span('upload'):
+            return image_file.read()
+
+    def get_mode(self, params):
+        mode = params.get('mode', 'features')
+        if mode not in ('features', 'embedding'):
+            raise ValueError("mode must be 'features' or 'embedding'.")
+        return mode
+
+    def resolve_query(self, data, mode):
+        """
+        Return the cache key and query features of an uploaded image.
+
+        The features come from the matching cache or the feature store when
+        possible; otherwise the background is removed and the features are
+        extracted and cached. They are not saved in the feature store, which
+        only holds features of full-resolution images.
+
+        Args:
+            data (bytes): The encoded uploaded image.
+            mode (str): "features" or "embedding".
+
+        Returns:
+            tuple: The image cache key and the query features.
+
+        Raises:
+            BackgroundRemovalError: If the background of the image could not be removed.
+        """
+        image = None
+        if settings.MATCH_CACHE_PERCEPTUAL_HASH:
+            with span('decode'):
+                image = decode_upload(data)
+
+        match_cache = get_match_cache()
+        image_key = match_cache.image_key(data, image)
+
+        query_features = match_cache.get_features(mode, image_key)
+        if query_features is None:
+            digest = content_hash(data)
+            record = extract_image_features(
+                [(digest, data)], decode=decode_upload, store=False, micro_batch=True,
+            )[digest]
+            query_features = self.query_features(mode, record)
+            match_cache.set_features(mode, image_key, query_features)
+
+        return image_key, query_features
+
+    def query_features(self, mode, record):
+        """
+        Select the features of an uploaded image that matching compares against the catalog.
+
+        Args:
+            mode (str): "features" or "embedding".
+            record (ImageFeatures): The feature store record of the image.
+
+        Returns:
+            dict: The sofa type and color, or the encoded image embedding.
+        """
+        if mode == 'embedding':
+            return {"embedding": bytes(record.embedding)}
+        return {"sofa_type": record.sofa_type, "rgb_color": list(record.dominant_color)}
+
+    def rank_sofas(self, mode, query_features, budget):
+        """
+        Rank the catalog against the features of an uploaded image.
+
+        Args:
+            mode (str): "features" or "embedding".
+            query_features (dict): The features returned by `query_features`.
+            budget (float): Maximum price, or None for no limit.
+
+        Returns:
+            list: (sofa id, similarity percentage) pairs sorted by decreasing similarity.
+        """
+        if mode == 'embedding':
+            return [
+                (sofa_id, similarity * 100)
+                for sofa_id, similarity in get_embedding_index().search(
+                    decode_embedding(query_features["embedding"]),
+                    limit=settings.EMBEDDING_MATCH_LIMIT,
+                    budget=budget,
+                )
+            ]
+
+        return search_catalog(query_features["sofa_type"], query_features["rgb_color"], budget=budget)
+
+    def ranked_matches(self, mode, image_key, query_features, budget):
+        """
+        Return the ranked matches of an image, from the matching cache when possible.
+        """
+        match_cache = get_match_cache()
+        catalog_version = match_cache.catalog_version()
+        matches = match_cache.get_results(mode, image_key, budget, catalog_version)
+        if matches is None:
+            with span('ranking'):
+                matches = self.rank_sofas(mode, query_features, budget)
+            match_cache.set_results(mode, image_key, budget, catalog_version, matches)
+        return matches
+
+    def serialize_matches(self, matches, request):
+        """
+        Serialize ranked matches in chunks, reading each chunk of sofas with one query.
+
+        When the result is streamed, the `db` and `serialize` spans are recorded
+        after the Server-Timing header was sent, so they only reach the stage metrics.
+
+        Args:
+            matches (list): (sofa id, score) pairs.
+            request: The current request.
+
+        Yields:
+            dict: The serialized sofa with its similarity score.
+        """
+        for start in range(0, len(matches), STREAM_CHUNK_SIZE):
+            chunk = matches[start:start + STREAM_CHUNK_SIZE]
+            with span('db'):
+                sofas_by_id = Sofa.objects.in_bulk([sofa_id for sofa_id, _ in chunk])
+            with span('serialize'):
+                serialized = [
+                    self.serialize_match(sofas_by_id[sofa_id], score, request)
+                    for sofa_id, score in chunk if sofa_id in sofas_by_id
+                ]
+            yield from serialized
+
+    def serialize_match(self, sofa, score, request):
+        return {
+            "sofa": {
+                **SofaSerializer(sofa, context={'request': request}).data,
+                "similarity_score": score
+            }
+        }
+
+
+class SofaFilterAPIView(MatchingMixin, APIView):
     """
     API endpoint to retrieve sofas based on image similarity and/or budget.
+
+    It shares the in-flight limit of AsyncSofaFilterView: beyond
+    settings.MATCH_MAX_IN_FLIGHT concurrent requests per worker, requests are
+    rejected at once with a 503 and a Retry-After header.
     """
     parser_classes = [MultiPartParser]
 
     @extend_schema(
         summary="Retrieve sofas based on image similarity and/or budget with pagination",
-        description="Uploads an image to find similar sofas based on stored features, and/or filters by price range. Each sofa includes a similarity score (if image provided) in the response.",
+        description=(
+            "Uploads an image to find similar sofas based on stored features, and/or filters by price range. "
+            "Each sofa includes a similarity score (if image provided) in the response. Results are paginated: "
+            "POST to the returned `next` URL (without an image) for the following page. "
+            "With `stream=true` all results are streamed as one JSON array instead."
+        ),
         parameters=[
             OpenApiParameter(name='budget', type=int, location=OpenApiParameter.QUERY, required=False, description='Maximum budget for sofas'),
+            OpenApiParameter(name='mode', type=str, location=OpenApiParameter.QUERY, required=False, enum=['features', 'embedding'], description="'features' matches on sofa type and color, 'embedding' ranks by visual similarity of the image embeddings"),
+            OpenApiParameter(name='page_size', type=int, location=OpenApiParameter.QUERY, required=False, description='Number of results per page'),
+            OpenApiParameter(name='cursor', type=str, location=OpenApiParameter.QUERY, required=False, description='Page cursor of the sofa list (without image)'),
+            OpenApiParameter(name='continuation', type=str, location=OpenApiParameter.QUERY, required=False, description='Continuation token of the matches (with image)'),
+            OpenApiParameter(name='stream', type=bool, location=OpenApiParameter.QUERY, required=False, description='Stream every result as a JSON array instead of paginating'),
         ],
         request={
             "multipart/form-data": {
@@ -55,83 +320,140 @@ class SofaFilterAPIView(APIView):
                 },
             }
         },
-        responses={200: "List of sofas with similarity scores and pagination"},
+        responses={200: "Page of sofas with similarity scores and the URL of the next page"},
     )
     def post(self, request, *args, **kwargs):
-        try:
-            budget = request.query_params.get('budget', None)
-            image_file = request.FILES.get('image', None)
+        limiter = get_match_limiter()
+        if not limiter.acquire():
+            return self.busy_response(Response)
 
-            sofas = Sofa.objects.all()
+        try:
+            return self.match(request)
+        finally:
+            limiter.release()
 
-            if budget:
-                sofas = sofas.filter(original_price__lte=float(budget))
-            
-            if image_file:
-                temp_image_path = os.path.join(settings.MEDIA_ROOT, image_file.name)
-                with open(temp_image_path, 'wb') as f:
-                    for chunk in image_file.chunks():
-                        f.write(chunk)
+    def match(self, request):
+        try:
+            self.check_request_size(request)
+            budget = request.query_params.get('budget', None)
+            data = self.read_upload(request)
+            stream = request.query_params.get('stream', '').lower() in ('1', 'true', 'yes')
 
-                predicted_class, _ = predict_image_class(temp_image_path)
+            match_pagination = MatchPagination()
+            continuation = match_pagination.decode_token(request)
 
+            if continuation:
+                mode = continuation['mode']
+                image_key = continuation['image_key']
+                budget = continuation['budget']
+                query_features = continuation['features']
+            elif data is not None:
+                mode = self.get_mode(request.query_params)
+                budget = float(budget) if budget else None
                 try:
-                    with open(temp_image_path, 'rb') as input_file:
-                        input_data = input_file.read()
-
-                        output_data = remove(input_data)
+                    image_key, query_features = self.resolve_query(data, mode)
+                except BackgroundRemovalError:
+                    return Response({"error": BACKGROUND_REMOVAL_FAILED}, status=402)
+            else:
+                sofas = Sofa.objects.all()
+                if budget:
+                    sofas = sofas.filter(original_price__lte=float(budget))
 
-                    output_image = io.BytesIO(output_data)
-                    bg_removed_path = f"{temp_image_path}_no_bg.png"
-                    output_image.seek(0)
-                    with open(bg_removed_path, 'wb') as f:
-                        f.write(output_data)
-                except Exception as e:
-                    return Response({"error": "Background removal failed. Please check the API or payment status."}, status=402)
+                if stream:
+                    return streaming_json_response(
+                        SofaSerializer(sofa, context={'request': request}).data
+                        for sofa in sofas.order_by('id').iterator(chunk_size=STREAM_CHUNK_SIZE)
+                    )
 
+                paginator = SofaCursorPagination()
+                page = paginator.paginate_queryset(sofas, request, view=self)
+                serializer = SofaSerializer(page, many=True, context={'request': request})
+                return paginator.get_paginated_response(serializer.data)
 
-                dominant_color = get_dominant_color(bg_removed_path)
-                dominant_color = list(dominant_color)
+            matches = self.ranked_matches(mode, image_key, query_features, budget)
+            if not matches and not continuation:
+                return Response({"message": "No match data found"}, status=status.HTTP_404_NOT_FOUND)
 
-                sofas = sofas.filter(features__sofa_type=predicted_class)
+            if stream:
+                return streaming_json_response(self.serialize_matches(matches, request))
 
-                sofas_with_similarity = []
-                for sofa in sofas:
-                    sofa_rgb_color = sofa.features.get('rgb_color')
-                    if sofa_rgb_color:
-                        color_distance = calculate_color_distance(dominant_color, sofa_rgb_color)
+            page, next_url = match_pagination.paginate_matches(
+                matches, request, mode, image_key, budget, query_features,
+                after=continuation['after'] if continuation else None,
+            )
+            return match_pagination.get_paginated_response(list(self.serialize_matches(page, request)), next_url)
 
-                        color_threshold = 20
+        except UploadTooLargeError as e:
+            return Response({"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
 
-                        if color_distance <= color_threshold:
-                            similarity_percentage = calculate_sofa_similarity(predicted_class, dominant_color, sofa)
-                            sofas_with_similarity.append((sofa, similarity_percentage))
 
-                sofas_with_similarity.sort(key=lambda x: x[1], reverse=True)
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncSofaFilterView(MatchingMixin, View):
+    """
+    Asynchronous variant of the image matching endpoint for ASGI servers.
 
-                data = []
-                for sofa, score in sofas_with_similarity:
-                    data.append({
-                        "sofa": {
-                            **SofaSerializer(sofa, context={'request': request}).data,
-                            "similarity_score": score
-                        }
-                    })
+    Reading the upload, background removal, classification, color extraction
+    and ranking run in a bounded thread pool and the matched sofas are read
+    with the async ORM, so the event loop keeps serving other requests in the
+    meantime. Beyond settings.MATCH_MAX_IN_FLIGHT concurrent matches per
+    worker, requests are rejected at once with a 503 and a Retry-After header.
 
-                if not data:
-                    return Response({"message": "No match data found"}, status=status.HTTP_404_NOT_FOUND)
+    Accepts the same image, budget, mode, page_size and continuation parameters
+    as SofaFilterAPIView, but always requires an image or a continuation token.
+    """
 
-                return Response(data)
-            else:
-                serializer = SofaSerializer(sofas, many=True, context={'request': request})
-                return Response(serializer.data)
+    async def post(self, request, *args, **kwargs):
+        limiter = get_match_limiter()
+        if not limiter.acquire():
+            return self.busy_response(JsonResponse)
 
+        try:
+            self.check_request_size(request)
+            return await self.match(request)
+        except UploadTooLargeError as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         except ValueError as e:
-            return Response({"error": str(e)}, status=400)
-
+            return JsonResponse({"error": str(e)}, status=400)
         finally:
-            if os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
+            limiter.release()
+
+    async def match(self, request):
+        match_pagination = MatchPagination()
+        continuation = match_pagination.decode_token(request)
+
+        if continuation:
+            mode = continuation['mode']
+            image_key = continuation['image_key']
+            budget = continuation['budget']
+            query_features = continuation['features']
+        else:
+            mode = self.get_mode(request.GET)
+            budget = request.GET.get('budget', None)
+            budget = float(budget) if budget else None
+            # Parsing the multipart body and reading the upload block, so they run off the event loop too.
+            data = await run_in_match_executor(self.read_upload, request)
+            if data is None:
+                raise ValueError("An image or a continuation token is required.")
+            try:
+                image_key, query_features = await run_in_match_executor(self.resolve_query, data, mode)
+            except BackgroundRemovalError:
+                return JsonResponse({"error": BACKGROUND_REMOVAL_FAILED}, status=402)
+
+        matches = await run_in_match_executor(self.ranked_matches, mode, image_key, query_features, budget)
+        if not matches and not continuation:
+            return JsonResponse({"message": "No match data found"}, status=status.HTTP_404_NOT_FOUND)
 
-            if os.path.exists(bg_removed_path):
-                os.remove(bg_removed_path)
+        page, next_url = match_pagination.paginate_matches(
+            matches, request, mode, image_key, budget, query_features,
+            after=continuation['after'] if continuation else None,
+        )
+        with span('db'):
+            sofas_by_id = await Sofa.objects.ain_bulk([sofa_id for sofa_id, _ in page])
+        with span('serialize'):
+            results = [
+                self.serialize_match(sofas_by_id[sofa_id], score, request)
+                for sofa_id, score in page if sofa_id in sofas_by_id
+            ]
+        return JsonResponse({"next": next_url, "results": results}, encoder=JSONEncoder)
@@ -54,6 +54,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'couch_management.middleware.ServerTimingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -118,6 +119,8 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
 }
+# Largest page a client may request with `page_size`.
+MAX_PAGE_SIZE = env.int("MAX_PAGE_SIZE", 100)
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -156,9 +159,136 @@ USE_TZ = True
 STATIC_URL = 'static/'
 
 # Media files (user uploaded files)
-MEDIA_URL = '/media/'
+# Set to the absolute URL of a web server or CDN serving MEDIA_ROOT to stop serving media through Django.
+MEDIA_URL = env.str("MEDIA_URL", '/media/')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploaded query images: largest accepted file and resolution, and the longest side they are
+# downscaled to for matching. Background removal works at 320px and the classifier at 224px.
+UPLOAD_MAX_BYTES = env.int("UPLOAD_MAX_BYTES", 15 * 1024 * 1024)
+UPLOAD_MAX_PIXELS = env.int("UPLOAD_MAX_PIXELS", 50_000_000)
+UPLOAD_WORKING_SIZE = env.int("UPLOAD_WORKING_SIZE", 512)
+# Keep accepted uploads in memory instead of spooling them to a temporary file.
+FILE_UPLOAD_MAX_MEMORY_SIZE = UPLOAD_MAX_BYTES
+
+# Resized copies of every sofa image: name -> (longest side in pixels, format).
+IMAGE_DERIVATIVES = {
+    'thumbnail': (240, 'JPEG'),
+    'thumbnail_webp': (240, 'WEBP'),
+    'card': (720, 'JPEG'),
+    'card_webp': (720, 'WEBP'),
+}
+IMAGE_DERIVATIVE_QUALITY = env.int("IMAGE_DERIVATIVE_QUALITY", 82)
+
+# Image classifier
+KERAS_MODEL_PATH = os.path.join(BASE_DIR, 'couch_management/keras_model.h5')
+KERAS_LABELS_PATH = os.path.join(BASE_DIR, 'couch_management/labels.txt')
+# "auto" runs the models exported by `manage.py export_inference_model` when their runtime is installed,
+# and falls back to Keras. "onnx" and "tflite" never import TensorFlow (TFLite without tflite_runtime does).
+INFERENCE_BACKEND = env.str("INFERENCE_BACKEND", "auto")
+ONNX_MODEL_PATH = env.str("ONNX_MODEL_PATH", os.path.join(BASE_DIR, 'couch_management/keras_model.onnx'))
+TFLITE_MODEL_PATH = env.str("TFLITE_MODEL_PATH", os.path.join(BASE_DIR, 'couch_management/keras_model.tflite'))
+# Threads per inference call of the classifier and rembg runtimes (0 = the runtime's default, usually one per core).
+# With several server workers per machine, keep workers x threads at or below the number of cores.
+INFERENCE_THREADS = env.int("INFERENCE_THREADS", 0)
+# Threads used by OpenCV and by the BLAS library behind numpy (0 = the library's default).
+OPENCV_THREADS = env.int("OPENCV_THREADS", 0)
+BLAS_THREADS = env.int("BLAS_THREADS", 0)
+# Load the classifier and run a dummy inference when the app starts instead of on the first request.
+KERAS_WARMUP_ON_READY = env.bool("KERAS_WARMUP_ON_READY", False)
+# Images per forward pass and threads used to decode/resize them for batched classification.
+KERAS_BATCH_SIZE = env.int("KERAS_BATCH_SIZE", 32)
+KERAS_PREPROCESS_WORKERS = env.int("KERAS_PREPROCESS_WORKERS", os.cpu_count() or 1)
+# Classify the query images of concurrent match requests together: each waits up to INFERENCE_BATCH_MAX_WAIT_MS
+# for others to join its forward pass, which runs once INFERENCE_BATCH_MAX_SIZE images are waiting. An image whose
+# batch has not completed after INFERENCE_BATCH_TIMEOUT_MS is classified directly instead.
+INFERENCE_BATCHING = env.bool("INFERENCE_BATCHING", False)
+INFERENCE_BATCH_MAX_WAIT_MS = env.float("INFERENCE_BATCH_MAX_WAIT_MS", 5.0)
+INFERENCE_BATCH_MAX_SIZE = env.int("INFERENCE_BATCH_MAX_SIZE", 16)
+INFERENCE_BATCH_TIMEOUT_MS = env.float("INFERENCE_BATCH_TIMEOUT_MS", 2000.0)
+
+# Background removal
+REMBG_MODEL_NAME = env.str("REMBG_MODEL_NAME", "u2net")
+# Compute the foreground mask on a copy whose longest side is at most this many pixels (0 = full resolution).
+REMBG_MASK_MAX_SIZE = env.int("REMBG_MASK_MAX_SIZE", 0)
+
+# Dominant color extraction: "kmeans" (seeded k-means on sampled pixels, closest to the colors stored by earlier
+# versions) or "histogram" (quantized color histogram, faster). Switching methods changes the colors compared with
+# MATCH_COLOR_THRESHOLD, so reprocess the catalog features after changing it.
+DOMINANT_COLOR_METHOD = env.str("DOMINANT_COLOR_METHOD", "kmeans")
+# Approximate number of pixels sampled per image (0 = every pixel).
+DOMINANT_COLOR_MAX_PIXELS = env.int("DOMINANT_COLOR_MAX_PIXELS", 50000)
+
+# Optional cache file for the quantized RGB to CSS3 color name lookup table (empty = exact search).
+CSS3_COLOR_LUT_PATH = env.str("CSS3_COLOR_LUT_PATH", "")
+# Matching
+# Maximum RGB distance between the query color and a matching sofa.
+MATCH_COLOR_THRESHOLD = env.float("MATCH_COLOR_THRESHOLD", 20)
+# Where match candidates are filtered: "index" (in-memory CatalogIndex) or "database" (indexed SQL columns).
+MATCH_BACKEND = env.str("MATCH_BACKEND", "index")
+# Seconds after which a worker reloads its in-memory catalog index (0 = only signal updates).
+CATALOG_INDEX_MAX_AGE = env.int("CATALOG_INDEX_MAX_AGE", 300)
+# Persisted centroids of the approximate nearest-neighbour index over image embeddings.
+EMBEDDING_INDEX_PATH = env.str("EMBEDDING_INDEX_PATH", os.path.join(BASE_DIR, 'embedding_index.npz'))
+# Number of index lists scanned per embedding query; higher is more accurate and slower.
+EMBEDDING_INDEX_NPROBE = env.int("EMBEDDING_INDEX_NPROBE", 8)
+# Number of sofas returned by embedding matching.
+EMBEDDING_MATCH_LIMIT = env.int("EMBEDDING_MATCH_LIMIT", 20)
+
+# Threads that run the matching pipeline for the async matching endpoint, and the number of
+# matching requests a worker accepts at once, on either endpoint, before answering 503 with
+# Retry-After (0 = unlimited).
+MATCH_EXECUTOR_WORKERS = env.int("MATCH_EXECUTOR_WORKERS", min(4, os.cpu_count() or 1))
+MATCH_MAX_IN_FLIGHT = env.int("MATCH_MAX_IN_FLIGHT", 8)
+MATCH_RETRY_AFTER = env.int("MATCH_RETRY_AFTER", 2)
+
+# Matching cache
+MATCH_CACHE_ENABLED = env.bool("MATCH_CACHE_ENABLED", True)
+# Key uploads by a perceptual hash instead of their bytes, so re-encoded or resized copies of a photo also hit.
+MATCH_CACHE_PERCEPTUAL_HASH = env.bool("MATCH_CACHE_PERCEPTUAL_HASH", False)
+# Seconds query features (type, color, embedding) and ranked matches are kept.
+MATCH_CACHE_FEATURES_TTL = env.int("MATCH_CACHE_FEATURES_TTL", 3600)
+MATCH_CACHE_RESULTS_TTL = env.int("MATCH_CACHE_RESULTS_TTL", 300)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Local memory evicts the least recently used entries; use a file or shared backend so that workers
+    # share entries. Ranked matches are keyed by a catalog version read from the database, so they go stale
+    # in every worker when any process changes a sofa.
+    'matching': {
+        'BACKEND': env.str("MATCH_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        'LOCATION': env.str("MATCH_CACHE_LOCATION", "couch-matching"),
+        'TIMEOUT': MATCH_CACHE_RESULTS_TTL,
+        'OPTIONS': {
+            'MAX_ENTRIES': env.int("MATCH_CACHE_MAX_ENTRIES", 1000),
+        },
+    },
+}
+
+# Feature extraction jobs
+# Queue feature extraction for `manage.py run_feature_workers` instead of running it inside Sofa saves.
+FEATURE_EXTRACTION_ASYNC = env.bool("FEATURE_EXTRACTION_ASYNC", True)
+FEATURE_WORKERS = env.int("FEATURE_WORKERS", 1)
+FEATURE_WORKER_BATCH_SIZE = env.int("FEATURE_WORKER_BATCH_SIZE", 8)
+FEATURE_WORKER_POLL_INTERVAL = env.float("FEATURE_WORKER_POLL_INTERVAL", 2.0)
+FEATURE_MAX_ATTEMPTS = env.int("FEATURE_MAX_ATTEMPTS", 3)
+# Seconds before the first retry, doubled after every further failure.
+FEATURE_RETRY_BACKOFF = env.int("FEATURE_RETRY_BACKOFF", 30)
+# Seconds after which a job claimed by a worker that died is queued again.
+FEATURE_CLAIM_TIMEOUT = env.int("FEATURE_CLAIM_TIMEOUT", 600)
+
+# Feature store
+# Keep the features of every processed image, by SHA-256 of its bytes, so duplicate images skip the models.
+FEATURE_STORE_ENABLED = env.bool("FEATURE_STORE_ENABLED", True)
+# Least recently used records are evicted beyond this size (0 = unbounded).
+FEATURE_STORE_MAX_MB = env.int("FEATURE_STORE_MAX_MB", 1024)
+
+# Observability
+# Return the pipeline stage timings of each request in a Server-Timing header.
+SERVER_TIMING_HEADER = env.bool("SERVER_TIMING_HEADER", True)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,67 @@
+"""
+Production server configuration: `gunicorn -c gunicorn.conf.py`.
+
+Serves couch_matcher.wsgi with threaded workers, or couch_matcher.asgi with
+uvicorn workers when SERVER_ASGI is set. One worker is started per
+INFERENCE_THREADS available CPUs, and the thread pools of the ML libraries
+are sized so that the workers together do not use more threads than there
+are CPUs. When it is fork-safe, the classifier and the rembg session are
+loaded in the master before the workers are forked, so their read-only
+weights are shared copy-on-write; otherwise every worker loads them before
+it accepts requests.
+"""
+import os
+import sys
+
+# Gunicorn adds the working directory to the path only after reading this file.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'couch_matcher.settings')
+
+from couch_management.runtime import (available_cpus,  # noqa: E402
+                                      default_worker_count)
+
+bind = os.environ.get('SERVER_BIND', '0.0.0.0:8000')
+timeout = int(os.environ.get('SERVER_TIMEOUT', 120))
+preload_app = True
+
+if os.environ.get('SERVER_ASGI', '').lower() in ('1', 'true', 'yes'):
+    wsgi_app = 'couch_matcher.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'couch_matcher.wsgi:application'
+    worker_class = 'gthread'
+    threads = int(os.environ.get('SERVER_THREADS', 4))
+
+workers = int(os.environ.get('SERVER_WORKERS', 0)) or default_worker_count(int(os.environ.get('INFERENCE_THREADS', 1)))
+
+# Read by the Django settings when the application is preloaded below.
+THREADS_PER_WORKER = str(max(available_cpus() // workers, 1))
+for variable in ('INFERENCE_THREADS', 'OPENCV_THREADS', 'BLAS_THREADS'):
+    os.environ.setdefault(variable, THREADS_PER_WORKER)
+os.environ['SERVER_WORKERS'] = str(workers)
+
+PRELOAD_MODELS = os.environ.get('SERVER_PRELOAD_MODELS', 'true').lower() in ('1', 'true', 'yes')
+
+
+def when_ready(server):
+    # Runs in the master after the application is loaded and before the workers are forked.
+    from couch_management.runtime import can_preload_before_fork, preload_models
+
+    if PRELOAD_MODELS and can_preload_before_fork():
+        try:
+            preload_models()
+        except Exception:
+            server.log.exception('Preloading the models failed, the workers load them on first use')
+        else:
+            server.log.info('Preloaded the models before forking %s workers', workers)
+
+
+def post_fork(server, worker):
+    from couch_management.runtime import preload_models
+
+    if PRELOAD_MODELS:
+        # A no-op if the models were preloaded in the master.
+        try:
+            preload_models()
+        except Exception:
+            server.log.exception('Preloading the models failed, they are loaded on first use')
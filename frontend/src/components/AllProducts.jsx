@@ -18,6 +18,7 @@ const AllProducts = () => {
   const [loading, setLoading] = useState(false);
   const [page, setPage] = useState(1);
   const [hasMore, setHasMore] = useState(true);
+  const [nextUrl, setNextUrl] = useState("http://localhost:8000/api/sofas/");
   const navigate = useNavigate();
   useEffect(() => {
     fetchSofas();
@@ -30,10 +31,9 @@ const AllProducts = () => {
     if (loading) return;
     setLoading(true);
     try {
-      const { data } = await axios.get(
-        `http://localhost:8000/api/sofas/?page=${page}`
-      );
+      const { data } = await axios.get(nextUrl);
       setSofas((prev) => [...prev, ...data.results]);
+      setNextUrl(data.next);
       setHasMore(data.next !== null); 
     } catch (error) {
       console.error("Error fetching sofas:", error);
@@ -69,7 +69,7 @@ const AllProducts = () => {
         {sofas.map((sofa, index) => (
           <Grid item xs={12} sm={12} md={4} lg={4} key={index}>
             <ProductCard
-              image={sofa.image}
+              image={sofa.image_derivatives?.card_webp || sofa.image}
               title={sofa.name}
               brand={`Discount: ${sofa.discount}%`}
               description={sofa.description || "No description available"}
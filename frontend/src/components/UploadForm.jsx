@@ -14,6 +14,8 @@ const UploadForm = () => {
   const [border, setBorder] = useState(false);
   const [openModal, setOpenModal] = useState(false);
   const [cardData, setCardData]=useState([])
+  const [nextUrl, setNextUrl] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [imageFile, setImageFile] = useState(null);
   const [errorMessage, setErrorMessage] = useState("");
   const [formData, setFormData] = useState({
@@ -41,7 +43,8 @@ const UploadForm = () => {
       });
   
       if (response?.data) {
-        setCardData(response?.data);
+        setCardData(response?.data?.results);
+        setNextUrl(response?.data?.next);
         setLoading(false);
       }
     } catch (error) {
@@ -50,6 +53,25 @@ const UploadForm = () => {
       setLoading(false);
     }
   };
+
+  // The next page of matches is requested with the continuation token of the `next` URL, without the image.
+  const loadMoreMatches = async () => {
+    if (!nextUrl || loadingMore) return;
+    setLoadingMore(true);
+    try {
+      const { data } = await axios.post(nextUrl, new FormData(), {
+        headers: {
+          "Content-Type": "multipart/form-data",
+        },
+      });
+      setCardData((prev) => [...prev, ...data.results]);
+      setNextUrl(data.next);
+    } catch (error) {
+      console.error("Error fetching more matches:", error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
   
   
   
@@ -100,6 +122,7 @@ const UploadForm = () => {
     e.preventDefault();
     setOpenModal(true);
     setCardData([])
+    setNextUrl(null);
   };
 
   const navigateToViewAll = () => {
@@ -226,7 +249,7 @@ const submitData=()=>{
           
             <Grid item xs={12} sm={12} md={4} lg={4} key={index}>
               <ProductCard
-                image={sofa.image}
+                image={sofa.image_derivatives?.card_webp || sofa.image}
                 title={sofa.name}
                 brand={`Discount: ${sofa.discount}%`}
                 description={sofa.description || "No description available"}
@@ -239,6 +262,18 @@ const submitData=()=>{
           );
         })}
       </Grid>
+      {nextUrl && (
+        <Box sx={{ display: "flex", justifyContent: "center", mt: 4 }}>
+          <Button
+            variant="contained"
+            style={{ background: "black", color: "white", borderRadius: "20px" }}
+            onClick={loadMoreMatches}
+            disabled={loadingMore}
+          >
+            {loadingMore ? <CircularProgress size={24} style={{ color: "white" }} /> : "Load more matches"}
+          </Button>
+        </Box>
+      )}
       
         </Container>
      